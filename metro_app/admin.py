@@ -2,6 +2,15 @@ from django.contrib import admin
 
 from metro_app import models
 
+
+class RunPhaseAdmin(admin.ModelAdmin):
+    # Report of the resources used by the phases of the runs.
+    list_display = ('run', 'name', 'start_time', 'wall_time', 'cpu_time',
+                    'max_rss', 'read_bytes', 'write_bytes', 'exit_code')
+    list_filter = ('name', 'exit_code')
+    ordering = ('-start_time', )
+
+
 admin.site.register(models.Matrices)
 admin.site.register(models.Network)
 admin.site.register(models.FunctionSet)
@@ -20,6 +29,7 @@ admin.site.register(models.Path)
 admin.site.register(models.Policy)
 admin.site.register(models.Simulation)
 admin.site.register(models.SimulationRun)
+admin.site.register(models.RunPhase, RunPhaseAdmin)
 admin.site.register(models.Vector)
 
 admin.site.register(models.Event)
@@ -1,103 +1,202 @@
-"""Implemented a External Script for the Batch Process.
-Date: 20 December 2020
-Author: Shubham"""
-
-import os
-import sys
-import django
-from django.utils import timezone
-
-# Load the django website.
-PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-sys.path.append(PROJECT_ROOT)
-os.environ.setdefault(
-    "DJANGO_SETTINGS_MODULE", "metropolis_web_interface.settings")
-django.setup()
-
-from metro_app import models, functions
-
-print('Starting script...')
-
-# Read argument of the script call.
-try:
-    batch_id = int(sys.argv[1])
-except IndexError:
-    raise SystemExit('MetroArgError: This script must be executed with the id '
-                     + 'of the batch has an argument.')
-
-try:
-    batch = models.Batch.objects.get(pk=batch_id)
-except models.Batch.DoesNotExist:
-    raise SystemExit('MetroDoesNotExist: No Batch object corresponding'
-                     + ' to the given id.')
-
-batch.status = 'Running'
-batch.save()
-
-simulation = batch.simulation
-
-for i, batch_run in enumerate(batch.batchrun_set.all()):
-
-    if batch_run.canceled:
-        print('Run {} has been canceled, skipping...'.format(i+1))
-        continue
-
-    print('Importing files for run {}'.format(i+1))
-
-    try:
-        if batch_run.centroid_file:
-            functions.object_import_function(
-                batch_run.centroid_file.file, simulation, "centroid")
-
-        if batch_run.crossing_file:
-            functions.object_import_function(
-                batch_run.crossing_file.file, simulation, "crossing")
-
-        if batch_run.link_file:
-            functions.object_import_function(
-                batch_run.link_file.file, simulation, "link")
-
-        if batch_run.function_file:
-            functions.object_import_function(
-                batch_run.function_file.file, simulation, "function")
-
-        if batch_run.public_transit_file:
-            functions.public_transit_import_function(
-                batch_run.public_transit_file.file, simulation)
-
-        if batch_run.traveler_file:
-            functions.traveler_zip_file(
-                simulation, batch_run.traveler_file)
-
-        if batch_run.pricing_file:
-            functions.pricing_import_function(
-                batch_run.pricing_file.file, simulation)
-
-        if batch_run.zip_file:
-            functions.simulation_import(
-                simulation, batch_run.zip_file)
-    except Exception as e:
-        print('Exception when importing files: {}'.format(e))
-        batch_run.failed = True
-        batch_run.save()
-    else:
-        print('Imports finished')
-
-        batch_run.refresh_from_db()
-        if batch_run.canceled:
-            print('Run {} has been canceled, skipping...'.format(i+1))
-            continue
-        run_name = '{} - {}'.format(batch.name, batch_run.name)
-        run = models.SimulationRun(name=run_name, simulation=simulation)
-        run.save()
-        batch_run.run = run
-        batch_run.save()
-        print('Starting run {}'.format(i+1))
-        functions.run_simulation(run, background=False)
-        print('Run finished')
-
-batch.end_time = timezone.now()
-batch.running_time = batch.end_time - batch.start_time
-batch.status = "Finished"
-batch.save()
-print("Batch Completed")
+"""Implemented a External Script for the Batch Process.
+Date: 20 December 2020
+Author: Shubham"""
+
+import os
+import sys
+import django
+from django.utils import timezone
+
+# Load the django website.
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_ROOT)
+os.environ.setdefault(
+    "DJANGO_SETTINGS_MODULE", "metropolis_web_interface.settings")
+django.setup()
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+
+from metro_app import models, functions, forms
+
+# Input files of a batch run which modify the supply or the demand of the
+# simulation.
+SUPPLY_FILES = ('centroid_file', 'crossing_file', 'link_file',
+                'function_file', 'public_transit_file', 'zip_file')
+DEMAND_FILES = ('traveler_file', 'zip_file')
+
+
+def set_status(batch_run, status):
+    """Save the status of a BatchRun (before the start of its
+    SimulationRun)."""
+    batch_run.status = status
+    batch_run.save(update_fields=['status'])
+
+
+def is_canceled(batch_run):
+    """Return True if the BatchRun has been canceled by the user."""
+    batch_run.refresh_from_db(fields=['canceled'])
+    return batch_run.canceled
+
+
+def create_copy(batch, batch_run):
+    """Return a copy of the simulation of the batch, where the input files of
+    the batch run can be imported without modifying the other runs.
+
+    The copy shares the supply and the demand of the simulation (see
+    functions.share_simulation) unless the input files modify them. In this
+    case, a full copy is made because the concurrent runs cannot detach the
+    same supply or demand at the same time.
+    The copy is private and it is deleted with the batch.
+    """
+    simulation = batch.simulation
+    name = '{} - {}'.format(batch.name, batch_run.name)
+    form = forms.BaseSimulationForm(simulation.user, {
+        'name': name[:models.Simulation._meta.get_field('name').max_length],
+        'comment': 'Batch run {}'.format(batch_run.id),
+        'public': False,
+        'contact': simulation.contact,
+    })
+    if not form.is_valid():
+        raise ValueError('Invalid copy of the simulation: {}'.format(
+            form.errors.as_text()))
+    copy = functions.create_simulation(simulation.user, form)
+    copy.environment = simulation.environment
+    copy.parent_batch = batch
+    copy.save()
+    if any(getattr(batch_run, f) for f in SUPPLY_FILES + DEMAND_FILES):
+        functions.copy_simulation(simulation, copy)
+    else:
+        functions.share_simulation(simulation, copy)
+    return copy
+
+
+def import_files(batch_run, simulation):
+    """Import the input files of a BatchRun in a simulation."""
+    if batch_run.centroid_file:
+        functions.object_import_function(
+            batch_run.centroid_file.file, simulation, "centroid")
+
+    if batch_run.crossing_file:
+        functions.object_import_function(
+            batch_run.crossing_file.file, simulation, "crossing")
+
+    if batch_run.link_file:
+        functions.object_import_function(
+            batch_run.link_file.file, simulation, "link")
+
+    if batch_run.function_file:
+        functions.object_import_function(
+            batch_run.function_file.file, simulation, "function")
+
+    if batch_run.public_transit_file:
+        functions.public_transit_import_function(
+            batch_run.public_transit_file.file, simulation)
+
+    if batch_run.traveler_file:
+        functions.traveler_zip_file(
+            simulation, batch_run.traveler_file)
+
+    if batch_run.pricing_file:
+        functions.pricing_import_function(
+            batch_run.pricing_file.file, simulation)
+
+    if batch_run.zip_file:
+        functions.simulation_import(
+            simulation, batch_run.zip_file)
+
+
+def fail(batch_run):
+    """Mark a BatchRun as failed."""
+    batch_run.failed = True
+    batch_run.status = 'Failed'
+    batch_run.save(update_fields=['failed', 'status'])
+
+
+def execute(batch, batch_run, i):
+    """Copy the simulation, import the input files and run Metrosim for one
+    BatchRun (executed in a thread of the pool).
+
+    The exceptions are caught so that a failed BatchRun does not stop the
+    other runs of the batch.
+    """
+    try:
+        if is_canceled(batch_run):
+            print('Run {} has been canceled, skipping...'.format(i+1))
+            return
+
+        print('Copying simulation for run {}'.format(i+1))
+        set_status(batch_run, 'Copying simulation')
+        try:
+            simulation = create_copy(batch, batch_run)
+            print('Importing files for run {}'.format(i+1))
+            set_status(batch_run, 'Importing files')
+            import_files(batch_run, simulation)
+            functions.invalidate_stats(simulation)
+        except Exception as e:
+            print('Exception when importing files for run {}: {}'.format(
+                i+1, e))
+            fail(batch_run)
+            return
+        print('Imports finished for run {}'.format(i+1))
+
+        if is_canceled(batch_run):
+            print('Run {} has been canceled, skipping...'.format(i+1))
+            return
+        run_name = '{} - {}'.format(batch.name, batch_run.name)
+        run = models.SimulationRun(name=run_name, simulation=simulation)
+        run.save()
+        batch_run.run = run
+        batch_run.status = 'Started'
+        batch_run.save(update_fields=['run', 'status'])
+        print('Starting run {}'.format(i+1))
+        functions.run_simulation(run, background=False)
+        print('Run {} finished'.format(i+1))
+    except Exception as e:
+        print('Exception in run {}: {}'.format(i+1, e))
+        fail(batch_run)
+    finally:
+        # Each thread has its own database connection.
+        connection.close()
+
+
+print('Starting script...')
+
+# Read argument of the script call.
+try:
+    batch_id = int(sys.argv[1])
+except IndexError:
+    raise SystemExit('MetroArgError: This script must be executed with the id '
+                     + 'of the batch has an argument.')
+
+try:
+    batch = models.Batch.objects.get(pk=batch_id)
+except models.Batch.DoesNotExist:
+    raise SystemExit('MetroDoesNotExist: No Batch object corresponding'
+                     + ' to the given id.')
+
+batch.status = 'Running'
+batch.save()
+
+# Each run is executed in its own copy of the simulation so that up to
+# BATCH_WORKERS runs can import their files and run Metrosim at the same time.
+# The status of the batch is always set at the end, even if the script fails.
+try:
+    batch_runs = list(batch.batchrun_set.all())
+    with ThreadPoolExecutor(max_workers=settings.BATCH_WORKERS) as executor:
+        futures = [executor.submit(execute, batch, batch_run, i)
+                   for i, batch_run in enumerate(batch_runs)]
+        for future in futures:
+            future.result()
+except BaseException:
+    batch.status = 'Failed'
+    raise
+else:
+    batch.status = "Finished"
+finally:
+    batch.end_time = timezone.now()
+    batch.running_time = batch.end_time - batch.start_time
+    batch.save()
+print("Batch Completed")
@@ -17,14 +17,21 @@ import csv
 import json
 import codecs
 import gzip
+import io
+import shutil
+import subprocess
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 
 import django
 from django.utils import timezone
 from django.conf import settings
-from django.db import connection
+from django.db import connection, connections
 
-from matplotlib.colors import LinearSegmentedColormap
 import numpy as np
+import pandas as pd
 
 # Load the django website.
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -33,22 +40,28 @@ os.environ.setdefault(
     "DJANGO_SETTINGS_MODULE", "metropolis_web_interface.settings")
 django.setup()
 
-from metro_app import models, functions
+from metro_app import models, functions, plots
 from metro_app.views import LINK_THRESHOLD, NETWORK_THRESHOLD
 
-print('Starting script...')
-
 # Set matplotlib config directory.
 mplconfigdir = '/home/metropolis/matplotlib'
 if os.path.isdir(mplconfigdir):
     os.environ['MPLCONFIGDIR'] = mplconfigdir
 
+# Number of rows of the output files read at the same time.
+OUTPUT_CHUNK_SIZE = 10000
+# Number of rows of the events file read at the same time.
+EVENTS_CHUNK_SIZE = 1000000
+
 
 def import_output(run):
     """Import the results of the SimulationRun.
 
     Return a dictionary with the ids of the links and a numpy array with the
     results for each type.
+    The phi_in_H file is read once, by chunks, and gives the ids of the
+    links, the number of links and the number of periods. The other files
+    are read by chunks and parsed directly into preallocated numpy arrays.
     """
     simulation = run.simulation
     output_dir = settings.BASE_DIR + '/metrosim_files/output/'
@@ -56,49 +69,78 @@ def import_output(run):
     db_name = settings.DATABASES['default']['NAME']
     output = dict()
 
-    # Store the ids of the links in a list.
-    output['link_ids'] = []
+    # Read the phi_in_H file.
+    # Each row has the link id, one value for each period and an empty last
+    # column.
     current_output_file = output_file.format('phi_in_H', db_name,
                                              simulation.id)
-    with open(current_output_file, newline='') as tsv_file:
-        reader = csv.reader(tsv_file, delimiter='\t')
-        for row in reader:
-            output['link_ids'].append(row[0])
+    nb_periods = 0
+    link_ids = []
+    values = []
+    try:
+        reader = pd.read_csv(
+            current_output_file, sep='\t', header=None, engine='c',
+            chunksize=OUTPUT_CHUNK_SIZE,
+        )
+        for chunk in reader:
+            if not values:
+                # The empty last column is the only column with no value.
+                nb_periods = chunk.dropna(axis=1, how='all').shape[1] - 1
+            chunk = chunk.iloc[:, :nb_periods+1].to_numpy(dtype=np.int64)
+            link_ids.append(chunk[:, 0])
+            values.append(chunk[:, 1:].astype(np.int16))
+    except pd.errors.EmptyDataError:
+        # The file is empty.
+        pass
+    if values:
+        output['link_ids'] = np.concatenate(link_ids)
+        output['phi_in_H'] = np.concatenate(values)
+    else:
+        output['link_ids'] = np.empty(0, dtype=np.int64)
+        output['phi_in_H'] = np.empty((0, nb_periods), dtype=np.int16)
+    nb_links = len(output['link_ids'])
 
-    if len(output['link_ids']) >= LINK_THRESHOLD:
+    if nb_links >= LINK_THRESHOLD:
         # Large network, only store one type of results (phi_in_H).
-        output_types = ['phi_in_H', 'ttime_H']
+        output_types = ['ttime_H']
     else:
         # Small network, we can store everything.
-        output_types = ['phi_in_H', 'phi_in_S', 'phi_out_H', 'phi_out_S',
-                        'ttime_H', 'ttime_S']
+        output_types = ['phi_in_S', 'phi_out_H', 'phi_out_S', 'ttime_H',
+                        'ttime_S']
 
     for output_type in output_types:
-        # Build a list for each output type.
-        output[output_type] = []
-        current_output_file = output_file.format(output_type, db_name,
-                                                 simulation.id)
-        with open(current_output_file, newline='') as tsv_file:
-            reader = csv.reader(tsv_file, delimiter='\t')
-            for row in reader:
-                # Create a list to store the output of this link.
-                link_output = []
-                # Store link id (only once).
-                for period in range(1, len(row) - 1):  # Last column is empty.
-                    link_output.append(row[period])
-                output[output_type].append(link_output)
-        # Convert the list to a numpy array.
-        # There is a numpy array for each output type.
         # The numpy array has one row for each link and one column for each
         # period.
-        output[output_type] = np.array(output[output_type], dtype=np.int16)
+        output[output_type] = np.empty((nb_links, nb_periods), dtype=np.int16)
+        if not nb_links:
+            continue
+        current_output_file = output_file.format(output_type, db_name,
+                                                 simulation.id)
+        reader = pd.read_csv(
+            current_output_file, sep='\t', header=None, engine='c',
+            usecols=range(nb_periods + 1), dtype=np.int64,
+            chunksize=OUTPUT_CHUNK_SIZE,
+        )
+        row = 0
+        for chunk in reader:
+            chunk_values = chunk.values
+            if row + len(chunk_values) > nb_links:
+                raise ValueError(
+                    'Too many rows in the {} file'.format(output_type))
+            output[output_type][row:row+len(chunk_values)] = \
+                chunk_values[:, 1:]
+            row += len(chunk_values)
+        # All the rows of the array must be filled.
+        if row != nb_links:
+            raise ValueError(
+                'Wrong number of rows in the {} file'.format(output_type))
     return output
 
 
 def export_link_results(output, export_file):
     # Create a dictionary to map the link ids with the link user ids.
     link_mapping = dict()
-    links = functions.get_query('link', SIMULATION.id)
+    links = functions.get_query('link', SIMULATION)
     for link in links:
         link_mapping[link.id] = link.user_id
     # Check size of network.
@@ -137,26 +179,20 @@ def export_link_results(output, export_file):
 
 
 def build_results(output):
-    """Convert the results to color values.
+    """Compute the stats of the results.
 
-    Return a dictionary with the same structure as the network output with the
-    results for each links, a colorscale and stats for each output type.
+    Return a dictionary with the output types, the palette used for the colors
+    and stats for each output type.
+    The colors of the links are not stored, they are computed from the values
+    when the results are read.
     """
     link_ids = output['link_ids']
     results = dict()
     results['stats'] = dict()
 
-    # Create a colorscale.
-    cmap = congestion_colormap()
-    transparency = .8
-    size = 500
-    colorscale_values = np.arange(0, size, 1)
-    colorscale = [cmap(val / (size - 1)) for val in colorscale_values]
-    colorscale = [
-        'rgba({0}, {1}, {2}, {3})'.format(color[0] * 255, color[1] * 255,
-                                          color[2] * 255, transparency)
-        for color in colorscale]
-    results['colorscale'] = colorscale
+    # The colorscale is a palette of the plots module, referenced by name.
+    results['palette'] = 'congestion'
+    results['palette_size'] = plots.PALETTE_SIZE
 
     if len(link_ids) > NETWORK_THRESHOLD:
         # Large network.
@@ -165,10 +201,10 @@ def build_results(output):
         # Small network.
         output_types = ['phi_in_H', 'phi_in_S', 'phi_out_H', 'phi_out_S',
                         'ttime_H', 'ttime_S']
+    results['output_types'] = output_types
 
     for output_type in output_types:
         type_results = output[output_type]
-        periods = np.arange(0, np.shape(type_results)[1])
 
         # Add aggregated results for the output type.
         results['stats'][output_type] = dict()
@@ -179,33 +215,12 @@ def build_results(output):
         type_average = np.mean(type_results)
         results['stats'][output_type]['average'] = float(type_average)
 
-        results[output_type] = dict()
-        results[output_type]['values'] = dict()
-        results[output_type]['colors'] = dict()
-        for i, link_id in enumerate(link_ids):
-            link_id = str(link_id)
-            results[output_type]['values'][link_id] = dict()
-            results[output_type]['colors'][link_id] = dict()
-            for period in periods:
-                period = int(period)
-                # Add the values.
-                results[output_type]['values'][link_id][str(period)] = \
-                    int(type_results[i, period])
-                # Add the colors.
-                results[output_type]['colors'][link_id][str(period)] = \
-                    value_to_color(type_results[i, period], cmap, 0, type_max)
-
     return results
 
 
-def export_network_results(run, results):
-    """Store the built results to a json file."""
-    simulation = run.simulation
-    output_file = (
-        '{0}/website_files/network_output/results_{1}_{2}.json'
-    ).format(settings.BASE_DIR, simulation.id, run.id)
-    with open(output_file, 'w') as f:
-        json.dump(results, f)
+def export_network_results(run, output, results):
+    """Store the results of the run in binary files."""
+    functions.write_run_results(run, output['link_ids'], output, results)
 
 
 def clean_files(run):
@@ -253,33 +268,6 @@ def end_run(run, failed=False):
     run.save()
 
 
-def congestion_colormap():
-    """Return a matplotlib colormap that looks good to visualize congestion."""
-    cmap_name = 'congestion_colormap'
-    colors = [
-        (153 / 255, 255 / 255, 102 / 255),  # light green
-        (255 / 255, 219 / 255, 77 / 255),  # yellowish
-        (255 / 255, 0, 0),  # red
-    ]
-    cmap = LinearSegmentedColormap.from_list(cmap_name, colors)
-    return cmap
-
-
-def value_to_color(val, cmap, min_val, max_val):
-    """Return the rgb color of a value using a color map."""
-    # Express value in percentage of the interval [min_val, max_val].
-    val = (val - min_val) / (max_val - min_val)
-    # Find the color corresponding to the value. The result is in format
-    # (1, 1, 1).
-    color = cmap(val)
-    # Convert the result to a format compatible with javascript:
-    # 'rgb(255, 255, 255)'.
-    color = 'rgb({0}, {1}, {2})'.format(int(color[0] * 255),
-                                        int(color[1] * 255),
-                                        int(color[2] * 255))
-    return color
-
-
 def clean_database(simulation):
     """Drop from the database the tables created for the run."""
     matrices = functions.get_query('matrices', simulation)
@@ -292,83 +280,33 @@ def clean_database(simulation):
             ).format(id=matrice_id)
 
 
-print('Reading the script argument')
+def export_user_results(run):
+    """Write a tsv file with a readable user-specific cost output.
 
-# Read argument of the script call.
-try:
-    RUN_ID = int(sys.argv[1])
-except IndexError:
-    raise SystemExit('MetroArgError: This script must be executed with the id '
-                     + 'of the SimulationRun has an argument.')
-
-print('Finding SimulationRun')
-
-# Get the SimulationRun object of the argument.
-try:
-    RUN = models.SimulationRun.objects.get(pk=RUN_ID)
-except models.SimulationRun.DoesNotExist:
-    raise SystemExit('MetroDoesNotExist: No SimulationRun object corresponding'
-                     + ' to the given id.')
-
-SIMULATION = RUN.simulation
-# Change the status of the run.
-RUN.status = 'Ending'
-RUN.save()
-
-try:
-    print('Importing output...')
-    OUTPUT = import_output(RUN)
-    print('Writing link-specific results file...')
-    EXPORT_FILE = (
-        '{0}/website_files/network_output/link_results_{1}_{2}.txt'
-    ).format(settings.BASE_DIR, SIMULATION.id, RUN.id)
-    export_link_results(OUTPUT, EXPORT_FILE)
-    print('Preparing the network view...')
-    RESULTS = build_results(OUTPUT)
-    print('Exporting results...')
-    export_network_results(RUN, RESULTS)
-    print('Cleaning files...')
-    clean_files(RUN)
-    # print('Cleaning database...')
-    # clean_database(SIMULATION)
-except (FileNotFoundError, json.decoder.JSONDecodeError, Exception) as e:
-    # Catch any error (I explicitely write the two most common errors).
-    print('Ending run with error(s)...')
-    end_run(RUN, failed=True)
-    raise e
-
-print('Checking if network results are correctly stored...')
-FILE = (
-    '{0}/website_files/network_output/results_{1}_{2}.json'
-).format(settings.BASE_DIR, SIMULATION.id, RUN.id)
-if os.path.isfile(FILE):
-    RUN.network_output = True
-if os.path.isfile(EXPORT_FILE):
-    RUN.link_output = True
-
-DB_NAME = settings.DATABASES['default']['NAME']
-
-# Create a tsv file with a readable user-specific cost output.
-print('Writing traveler-specific cost output...')
-FILE = (
-    '{0}/metrosim_files/output/metrosim_users_{1}_{2}.txt'
-).format(settings.BASE_DIR, DB_NAME, SIMULATION.id)
-if os.path.isfile(FILE):
+    Return True if the file was written.
+    """
+    simulation = run.simulation
+    db_name = settings.DATABASES['default']['NAME']
+    input_file = (
+        '{0}/metrosim_files/output/metrosim_users_{1}_{2}.txt'
+    ).format(settings.BASE_DIR, db_name, simulation.id)
+    if not os.path.isfile(input_file):
+        return False
     try:
-        EXPORT_FILE = (
+        export_file = (
             '{0}/website_files/network_output/user_results_{1}_{2}.txt'
-        ).format(settings.BASE_DIR, SIMULATION.id, RUN.id)
+        ).format(settings.BASE_DIR, simulation.id, run.id)
         # Create a dictionary to map the centroid ids with the centroid user
         # ids.
         centroid_mapping = dict()
-        centroids = functions.get_query('centroid', SIMULATION.id)
+        centroids = functions.get_query('centroid', simulation)
         for centroid in centroids:
             centroid_mapping[centroid.id] = centroid.user_id
         # Create a dictionary to map the demandsegment ids with the name of the
         # usertype.
         usertype_mapping = dict()
         demandsegments = models.DemandSegment.objects.filter(
-            demand__scenario__simulation=SIMULATION
+            demand__scenario__simulation=simulation
         )
         for demandsegment in demandsegments:
             name = demandsegment.usertype.name
@@ -376,8 +314,8 @@ if os.path.isfile(FILE):
                 usertype_mapping[demandsegment.id] = name
             else:
                 usertype_mapping[demandsegment.id] = demandsegment.usertype.id
-        with codecs.open(FILE, 'r', encoding='utf8') as f:
-            with codecs.open(EXPORT_FILE, 'w', encoding='utf8') as g:
+        with codecs.open(input_file, 'r', encoding='utf8') as f:
+            with codecs.open(export_file, 'w', encoding='utf8') as g:
                 reader = csv.reader(f, delimiter='\t')
                 writer = csv.writer(g, delimiter='\t')
                 # Writer a custom header.
@@ -395,48 +333,218 @@ if os.path.isfile(FILE):
                         row[4], row[5], row[6], row[7], row[8], row[9],
                         row[10], row[11], row[12], row[13], row[14]
                     ])
-        os.remove(FILE)
-        RUN.user_output = True
+        os.remove(input_file)
+        return True
     except Exception as e:
         print('Error while writing user-specific costs file')
         print(e)
+        return False
 
-# Create a tsv file with a readable user-specific path output.
-print('Writing traveler-specific path output...')
-FILE = (
-    '{0}/metrosim_files/output/metrosim_events_{1}_{2}.txt'
-).format(settings.BASE_DIR, DB_NAME, SIMULATION.id)
-if os.path.isfile(FILE):
+
+def export_user_paths(run):
+    """Write a gzip tsv file with a readable user-specific path output.
+
+    Return True if the file was written.
+    """
+    simulation = run.simulation
+    db_name = settings.DATABASES['default']['NAME']
+    input_file = (
+        '{0}/metrosim_files/output/metrosim_events_{1}_{2}.txt'
+    ).format(settings.BASE_DIR, db_name, simulation.id)
+    if not os.path.isfile(input_file):
+        return False
     try:
-        EXPORT_FILE = (
+        export_file = (
             '{0}/website_files/network_output/user_paths_{1}_{2}.tsv.gz'
-        ).format(settings.BASE_DIR, SIMULATION.id, RUN.id)
-        # Create a dictionary to map the link ids with the link user ids.
-        link_mapping = dict()
-        links = functions.get_query('link', SIMULATION.id)
-        for link in links:
-            link_mapping[link.id] = link.user_id
-        with codecs.open(FILE, 'r', encoding='utf8') as f:
-            with gzip.open(EXPORT_FILE, 'wt') as g:
-                reader = csv.reader(f, delimiter='\t')
-                writer = csv.writer(g, delimiter='\t')
-                # Writer a custom header.
-                writer.writerow(['traveler_id', 'in_time', 'link_id'])
-                for row in reader:
-                    link_id = link_mapping[int(row[2])]
-                    # Traveler's id start at 2 in Metrosim.
-                    # I substract 1 here so that they start at 1.
-                    writer.writerow([int(row[0])-1, row[1], link_id])
-        os.remove(FILE)
-        RUN.user_path = True
+        ).format(settings.BASE_DIR, simulation.id, run.id)
+        # Create an array to map the link ids with the link user ids (the
+        # user id of the link with id i is stored at index i).
+        links = functions.get_query('link', simulation)
+        link_ids, link_user_ids = zip(*links.values_list('id', 'user_id'))
+        link_ids = np.array(link_ids, dtype=np.int64)
+        link_mapping = np.zeros(link_ids.max() + 1, dtype=np.int64)
+        link_mapping[link_ids] = link_user_ids
+        is_link = np.zeros(link_ids.max() + 1, dtype=bool)
+        is_link[link_ids] = True
+        reader = pd.read_csv(
+            input_file, sep='\t', header=None, engine='c', usecols=[0, 1, 2],
+            dtype={0: np.int64, 1: str, 2: np.int64},
+            chunksize=EVENTS_CHUNK_SIZE,
+        )
+        with open_compressed(export_file) as g:
+            # Writer a custom header.
+            g.write('traveler_id\tin_time\tlink_id\n')
+            for chunk in reader:
+                links_in = chunk[2].values
+                if (links_in.max() >= len(is_link)
+                        or not is_link[links_in].all()):
+                    raise KeyError('Unknown link id in the events file')
+                chunk[2] = link_mapping[links_in]
+                # Traveler's id start at 2 in Metrosim.
+                # I substract 1 here so that they start at 1.
+                chunk[0] -= 1
+                chunk.to_csv(g, sep='\t', header=False, index=False)
+        os.remove(input_file)
+        return True
     except Exception as e:
         print('Error while writing user-specific paths file')
         print(e)
+        return False
 
-RUN.save()
 
-print('Ending run...')
+@contextmanager
+def open_compressed(filename):
+    """Open a gzip file in text mode for writing.
 
-end_run(RUN)
+    The file is compressed with pigz (multi-threaded) if it is installed and
+    with the gzip module otherwise.
+    """
+    pigz = shutil.which('pigz')
+    if pigz:
+        with open(filename, 'wb') as f:
+            process = subprocess.Popen(
+                [pigz, '-c', '-p', str(settings.RESULTS_WORKERS)],
+                stdin=subprocess.PIPE, stdout=f,
+            )
+            g = io.TextIOWrapper(process.stdin, encoding='utf8')
+            try:
+                yield g
+            finally:
+                g.close()
+                process.wait()
+        if process.returncode:
+            raise OSError('pigz exited with code {}'.format(
+                process.returncode))
+    else:
+        with gzip.open(filename, 'wt', encoding='utf8', compresslevel=6) as g:
+            yield g
+
+
+def run_stage(stage):
+    """Run a stage of the post-processing of the run.
+
+    The stages are run in forked processes so they can use the global
+    variables RUN, OUTPUT and LINK_EXPORT_FILE without copying them.
+    Return the name of the stage, its duration in seconds and its result.
+    """
+    start = time.perf_counter()
+    if stage == 'link_results':
+        export_link_results(OUTPUT, LINK_EXPORT_FILE)
+        result = os.path.isfile(LINK_EXPORT_FILE)
+    elif stage == 'network_results':
+        export_network_results(RUN, OUTPUT, build_results(OUTPUT))
+        result = functions.has_run_results(RUN)
+    elif stage == 'user_results':
+        result = export_user_results(RUN)
+    elif stage == 'user_paths':
+        result = export_user_paths(RUN)
+    else:
+        raise ValueError('Unknown stage: {}'.format(stage))
+    # Close the database connection of the process (if any), the connection
+    # cannot be shared with the other processes.
+    connections.close_all()
+    return stage, time.perf_counter() - start, result
+
+
+def run_stages(stages, max_workers):
+    """Run the post-processing stages concurrently in a process pool.
+
+    Return a dictionary with the result of each stage.
+    Errors raised in a stage are raised again once all the stages are over.
+    """
+    # The database connections must not be shared with the forked processes.
+    connections.close_all()
+    results = dict()
+    errors = []
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             mp_context=context) as executor:
+        futures = [executor.submit(run_stage, stage) for stage in stages]
+        for future in as_completed(futures):
+            try:
+                stage, duration, result = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            print('Stage {0} done in {1:.2f} seconds'.format(stage, duration))
+            results[stage] = result
+    if errors:
+        raise errors[0]
+    return results
+
+
+def main(run_id):
+    """Build the results of the SimulationRun with the given id (this function
+    is also called by the run dispatcher, without starting a new
+    interpreter).
+
+    The run, its simulation, the output and the link export file are stored
+    in global variables, read by the stages (see run_stage).
+    """
+    global RUN, SIMULATION, OUTPUT, LINK_EXPORT_FILE
+
+    print('Finding SimulationRun')
+
+    # Get the SimulationRun object of the argument.
+    try:
+        RUN = models.SimulationRun.objects.get(pk=run_id)
+    except models.SimulationRun.DoesNotExist:
+        raise SystemExit('MetroDoesNotExist: No SimulationRun object '
+                         + 'corresponding to the given id.')
+
+    SIMULATION = RUN.simulation
+    # Change the status of the run.
+    RUN.status = 'Ending'
+    RUN.save()
+
+    LINK_EXPORT_FILE = (
+        '{0}/website_files/network_output/link_results_{1}_{2}.txt'
+    ).format(settings.BASE_DIR, SIMULATION.id, RUN.id)
+
+    try:
+        print('Importing output...')
+        OUTPUT = import_output(RUN)
+        # The link-specific results, the network view and the
+        # traveler-specific outputs are independent so they are built
+        # concurrently.
+        print('Building the results...')
+        stage_results = run_stages(
+            ['link_results', 'network_results', 'user_results', 'user_paths'],
+            settings.RESULTS_WORKERS,
+        )
+        print('Cleaning files...')
+        clean_files(RUN)
+        # print('Cleaning database...')
+        # clean_database(SIMULATION)
+    except (FileNotFoundError, json.decoder.JSONDecodeError, Exception) as e:
+        # Catch any error (I explicitely write the two most common errors).
+        print('Ending run with error(s)...')
+        end_run(RUN, failed=True)
+        raise e
+
+    RUN.network_output = stage_results['network_results']
+    RUN.link_output = stage_results['link_results']
+    RUN.user_output = stage_results['user_results']
+    RUN.user_path = stage_results['user_paths']
+    RUN.save()
+
+    print('Ending run...')
+
+    end_run(RUN)
+
+    print('Done.')
+
+
+if __name__ == '__main__':
+    print('Starting script...')
+
+    print('Reading the script argument')
+
+    # Read argument of the script call.
+    try:
+        run_id = int(sys.argv[1])
+    except IndexError:
+        raise SystemExit('MetroArgError: This script must be executed with '
+                         + 'the id of the SimulationRun has an argument.')
 
-print('Done.')
+    main(run_id)
@@ -1,6 +1,6 @@
 import django_filters
 
-from metro_app import models
+from metro_app import models, functions
 
 
 def get_functions(request):
@@ -9,10 +9,7 @@ def get_functions(request):
             pk=request.resolver_match.kwargs['simulation_id']
     )
     # Get the functions.
-    functions = models.Function.objects.filter(
-            functionset__supply__scenario__simulation=simulation
-    )
-    return functions
+    return functions.get_query('function', simulation)
 
 
 def get_usertypes(request):
@@ -21,10 +18,7 @@ def get_usertypes(request):
             pk=request.resolver_match.kwargs['simulation_id']
     )
     # Get the usertypes.
-    usertypes = models.UserType.objects.filter(
-        demandsegment__demand__scenario__simulation=simulation
-    )
-    return usertypes
+    return functions.get_query('usertype', simulation)
 
 
 class CentroidFilter(django_filters.FilterSet):
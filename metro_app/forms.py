@@ -1,3 +1,6 @@
+import json
+import math
+
 from django import forms
 from django.forms import BaseModelFormSet
 from django.forms import modelformset_factory
@@ -101,6 +104,19 @@ class BaseSimulationForm(forms.ModelForm):
         fields = ['name', 'comment', 'environment', 'contact', 'public']
 
 
+class CopySimulationForm(BaseSimulationForm):
+    """Form to copy a simulation (name, comment and public of the copy)."""
+    shared = forms.BooleanField(
+        required=False,
+        label='Share network and demand',
+        help_text=(
+            'Create the copy instantly, using the network and the demand of '
+            'the copied simulation until one of the simulations modifies '
+            'them'
+        ),
+    )
+
+
 class SimulationImportForm(forms.ModelForm):
     """Form to edit basic variables of a simulation (name, comment and public).
 
@@ -366,12 +382,29 @@ class UserTypeForm(forms.ModelForm):
         }
 
 
-class MatrixForm(forms.ModelForm):
-    """Form to edit an OD pair."""
+class MatrixChangesForm(forms.Form):
+    """Form with the OD pairs modified in the edit page of an OD matrix.
 
-    class Meta:
-        model = models.Matrix
-        fields = ['r']
+    The field is filled by javascript with a JSON list of [origin id,
+    destination id, value] for the cells changed by the user.
+    """
+    changes = forms.CharField(widget=forms.HiddenInput, required=False)
+
+    def clean_changes(self):
+        data = self.cleaned_data['changes']
+        if not data:
+            return []
+        try:
+            changes = json.loads(data)
+            changes = [(int(p), int(q), float(r)) for p, q, r in changes]
+        except (ValueError, TypeError, OverflowError):
+            raise forms.ValidationError('Invalid OD pairs.')
+        for p, q, r in changes:
+            # Infinite and NaN values are rejected.
+            if r < 0 or not math.isfinite(r):
+                raise forms.ValidationError(
+                    'The values of the OD pairs must be positive numbers.')
+        return changes
 
 
 class PolicyForm(forms.ModelForm):
@@ -464,9 +497,8 @@ class LinkForm(forms.ModelForm):
         self.fields['origin'].choices = node_choices
         self.fields['destination'].choices = node_choices
         # The choices for vdf are the functions of the associated function set.
-        self.fields['vdf'].queryset = models.Function.objects.filter(
-            functionset__supply__scenario__simulation=simulation
-        )
+        self.fields['vdf'].queryset = functions.get_query(
+            'function', simulation)
         # Add tooltips.
         for bound_field in self:
             bound_field.field.widget.attrs['title'] = bound_field.help_text
@@ -716,12 +748,6 @@ class BatchForm(forms.ModelForm):
 # FormSets
 # ====================
 
-MatrixFormSet = modelformset_factory(
-    models.Matrix,
-    form=MatrixForm,
-    extra=0
-)
-
 PolicyFormSet = modelformset_factory(
     models.Policy,
     form=PolicyForm,
@@ -9,53 +9,90 @@ import sys
 import subprocess
 import re
 import csv
+import json
 from io import StringIO
+from collections import Counter
 import codecs
+import time
+import datetime
+import uuid
 import zipfile
 import numpy as np
 import pandas as pd
 import magic
 
 from django.conf import settings
-from django.db.models import Sum
-from django.db import connection
+from django.core.cache import cache
+from django.db.models import F, Q, Sum
+from django.db import connection, transaction
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 from metro_app import models
 
+# Objects whose changes affect the network output file of a simulation.
+NETWORK_OBJECTS = ('centroid', 'crossing', 'link', 'function', 'demand',
+                   'all')
+
+# Number of seconds a zone demand profile is kept in the cache.
+DEMAND_PROFILE_TIMEOUT = 3600
+
+# Number of seconds between two heartbeats of the import script and number
+# of seconds without heartbeat after which a running import is considered
+# dead.
+IMPORT_HEARTBEAT = 10
+IMPORT_HEARTBEAT_TIMEOUT = 120
+
+# Status of the runs started by the run dispatcher and not finished yet.
+RUN_IN_PROGRESS = ('Preparing', 'Running', 'Ending')
+
+# Coefficients used to estimate the memory used by Metrosim for a run (in
+# MB): fixed memory, memory per link and memory per traveler.
+RUN_BASE_MEMORY = 200
+RUN_MEMORY_PER_LINK = 0.05
+RUN_MEMORY_PER_TRAVELER = 0.002
+
 
 def get_query(object_name, simulation):
     """Function used to return all instances of an object related to a
     simulation.
+
+    The network objects, the functions and the demand segments are selected
+    with their owner key (e.g. Link.owner_network) so that the many-to-many
+    tables are not joined.
     """
     query = None
+    if object_name in ('centroid', 'crossing', 'link', 'function'):
+        supply = get_supply(simulation)
+    elif object_name in ('usertype', 'demandsegment', 'matrices'):
+        demand_id = get_demand_id(simulation)
     if object_name == 'centroid':
         query = models.Centroid.objects.filter(
-            network__supply__scenario__simulation=simulation
+            owner_network_id=supply.network_id
         )
     elif object_name == 'crossing':
         query = models.Crossing.objects.filter(
-            network__supply__scenario__simulation=simulation
+            owner_network_id=supply.network_id
         )
     elif object_name == 'link':
         query = models.Link.objects.filter(
-            network__supply__scenario__simulation=simulation
+            owner_network_id=supply.network_id
         )
     elif object_name == 'function':
         query = models.Function.objects.filter(
-            functionset__supply__scenario__simulation=simulation
+            owner_functionset_id=supply.functionset_id
         )
     elif object_name == 'usertype':
         query = models.UserType.objects.filter(
-            demandsegment__demand__scenario__simulation=simulation
+            demandsegment__owner_demand_id=demand_id
         ).order_by('user_id')
     elif object_name == 'demandsegment':
         query = models.DemandSegment.objects.filter(
-            demand__scenario__simulation=simulation
+            owner_demand_id=demand_id
         )
     elif object_name == 'matrices':
         query = models.Matrices.objects.filter(
-            demandsegment__demand__scenario__simulation=simulation
+            demandsegment__owner_demand_id=demand_id
         )
     elif object_name == 'run':
         query = models.SimulationRun.objects.filter(
@@ -73,6 +110,145 @@ def get_query(object_name, simulation):
     return query
 
 
+def get_supply(simulation):
+    """Function used to return the Supply object of a simulation.
+
+    The supply is cached in the Simulation object (the views load it with
+    the simulation, see views.public_required). Simulation can also be the
+    id of a simulation.
+    """
+    if isinstance(simulation, models.Simulation):
+        return simulation.scenario.supply
+    return models.Supply.objects.get(scenario__simulation=simulation)
+
+
+def get_demand_id(simulation):
+    """Function used to return the id of the Demand object of a simulation
+    (simulation can also be the id of a simulation).
+    """
+    if isinstance(simulation, models.Simulation):
+        return simulation.scenario.demand_id
+    return models.Scenario.objects.values_list(
+        'demand_id', flat=True).get(simulation=simulation)
+
+
+def simulation_changed(simulation, object_name='all', ids=None):
+    """Function used to mark that some objects of a simulation changed.
+
+    The changed objects are recorded so that the network output file can be
+    patched instead of being generated again (see plots.get_network_output).
+    Object name is 'centroid', 'crossing', 'link', 'function', 'demand' or
+    'all' (the network output file is generated again), ids is a list of ids
+    of the changed objects.
+    Changes of other objects (e.g. 'policy') do not affect the network
+    output and are not recorded.
+    """
+    invalidate_stats(simulation)
+    if object_name not in NETWORK_OBJECTS:
+        return
+    if ids is None:
+        changes = [models.NetworkChange(simulation=simulation,
+                                        object_name=object_name)]
+    else:
+        changes = [models.NetworkChange(simulation=simulation,
+                                        object_name=object_name,
+                                        object_id=object_id)
+                   for object_id in ids]
+    models.NetworkChange.objects.bulk_create(changes)
+    # The fields are updated without saving the whole simulation so that the
+    # other fields are not overwritten with stale values.
+    fields = {'has_changed': True}
+    if object_name in ('all', 'centroid', 'demand'):
+        cache.delete('zone_demand_profile_{}'.format(simulation.id))
+        fields['demand_version'] = F('demand_version') + 1
+    models.Simulation.objects.filter(pk=simulation.id).update(**fields)
+    simulation.refresh_from_db(fields=list(fields))
+
+
+def network_has_changed(simulation):
+    """Return True if the network output file of a simulation is not up to
+    date (see plots.get_network_output)."""
+    return (simulation.has_changed
+            or models.NetworkChange.objects.filter(
+                simulation=simulation).exists())
+
+
+def invalidate_stats(simulation):
+    """Function used to mark that the SimulationStats of a simulation must be
+    computed again."""
+    models.SimulationStats.objects.filter(
+        simulation=simulation).update(stale=True)
+
+
+def get_simulation_stats(simulation):
+    """Return the SimulationStats of a simulation, computed again if they are
+    stale (or if they do not exist yet)."""
+    stats, created = models.SimulationStats.objects.get_or_create(
+        simulation=simulation)
+    if not stats.stale:
+        return stats
+    # The row is marked as up to date before the counts so that a change made
+    # during the counts marks it as stale again.
+    models.SimulationStats.objects.filter(
+        simulation=simulation).update(stale=False)
+    stats.centroids = get_query('centroid', simulation).count()
+    stats.crossings = get_query('crossing', simulation).count()
+    stats.links = get_query('link', simulation).count()
+    stats.functions = get_query('function', simulation).count()
+    usertypes = get_query('usertype', simulation)
+    stats.usertypes = usertypes.count()
+    stats.mode_choice = usertypes.filter(modeChoice='true').exists()
+    matrices = get_query('matrices', simulation)
+    stats.travelers = int(matrices.aggregate(Sum('total'))['total__sum'] or 0)
+    stats.public_transit = get_query('public_transit', simulation).exists()
+    stats.save(update_fields=['centroids', 'crossings', 'links', 'functions',
+                              'usertypes', 'mode_choice', 'travelers',
+                              'public_transit'])
+    stats.stale = False
+    return stats
+
+
+def get_zone_demand_profile(simulation, refresh=False):
+    """Function used to return the number of departures and arrivals at each
+    centroid of a simulation.
+
+    Return a dictionary with the ids of the centroids (sorted) and two numpy
+    arrays with the departures and the arrivals at these centroids.
+    The profile is computed with two grouped queries and is cached until the
+    demand or the centroids of the simulation change (or if refresh is True).
+    """
+    cache_key = 'zone_demand_profile_{}'.format(simulation.id)
+    # The cache is not shared with the scripts modifying the simulations so
+    # the cached profile is only valid if the demand version of the
+    # simulation is the same (see simulation_changed).
+    version = simulation.demand_version
+    profile = cache.get(cache_key)
+    if not refresh and profile is not None and profile['version'] == version:
+        return profile
+    centroids = get_query('centroid', simulation).order_by('id')
+    centroid_ids = np.array(centroids.values_list('id', flat=True),
+                            dtype=np.int64)
+    points = models.Matrix.objects.filter(
+        matrices__demandsegment__demand=simulation.scenario.demand)
+    profile = {'version': version, 'centroids': centroid_ids}
+    for name, field in (('departures', 'p'), ('arrivals', 'q')):
+        values = np.zeros(len(centroid_ids))
+        sums = points.values(field).annotate(total=Sum('r')).order_by()
+        sums = list(sums.values_list(field, 'total'))
+        if sums and len(centroid_ids):
+            ids, totals = zip(*sums)
+            ids = np.array(ids, dtype=np.int64)
+            totals = np.array(totals, dtype=float)
+            # Find the position of the centroids in the sorted array of ids.
+            positions = np.searchsorted(centroid_ids, ids)
+            positions = np.minimum(positions, len(centroid_ids) - 1)
+            known = centroid_ids[positions] == ids
+            values[positions[known]] = totals[known]
+        profile[name] = values
+    cache.set(cache_key, profile, DEMAND_PROFILE_TIMEOUT)
+    return profile
+
+
 def can_view(user, simulation):
     """Check if the user can view a specific simulation.
 
@@ -141,28 +317,83 @@ def get_node_choices(simulation):
 
     These nodes can be origin or destination of links.
     """
-    centroids = models.Centroid.objects.filter(
-        network__supply__scenario__simulation=simulation
-    )
-    crossings = models.Crossing.objects.filter(
-        network__supply__scenario__simulation=simulation
-    )
+    centroids = get_query('centroid', simulation)
+    crossings = get_query('crossing', simulation)
     centroid_choices = [(centroid.id, str(centroid)) for centroid in centroids]
     crossing_choices = [(crossing.id, str(crossing)) for crossing in crossings]
     node_choices = centroid_choices + crossing_choices
     return node_choices
 
 
+def get_run_size(simulation):
+    """Return the number of links and the number of travelers of a
+    simulation."""
+    nb_links = get_query('link', simulation).count()
+    matrices = get_query('matrices', simulation)
+    nb_travelers = matrices.aggregate(Sum('total'))['total__sum'] or 0
+    return nb_links, nb_travelers
+
+
+def estimate_run_memory(simulation):
+    """Return the estimated memory used by Metrosim to run a simulation (in
+    MB)."""
+    nb_links, nb_travelers = get_run_size(simulation)
+    return int(RUN_BASE_MEMORY
+               + nb_links * RUN_MEMORY_PER_LINK
+               + nb_travelers * RUN_MEMORY_PER_TRAVELER)
+
+
 def run_simulation(run, background=True):
-    """Function to start a SimulationRun.
+    """Function to add a SimulationRun to the run queue.
 
-    This function writes the argument file of Metropolis, then runs two scripts
-    and Metrosim.
+    The run is started by the run dispatcher (see run_dispatcher.py) when
+    there are enough free resources on the server. If background is False,
+    the function waits for the end of the run.
     """
-    # Write the argument file used by metrosim.
+    run.status = 'Queued'
+    run.memory = estimate_run_memory(run.simulation)
+    run.save()
+    if not background:
+        while run.status in ('Queued', ) + RUN_IN_PROGRESS:
+            time.sleep(settings.DISPATCHER_INTERVAL)
+            run.refresh_from_db()
+
+
+def run_queue():
+    """Return the queued SimulationRun objects, in the order in which they
+    are started by the run dispatcher.
+
+    The users are served in turn: the next run is the oldest queued run of
+    the user with the fewest runs in progress or ahead in the queue.
+    """
+    in_progress = models.SimulationRun.objects.filter(
+        status__in=RUN_IN_PROGRESS)
+    users = Counter(in_progress.values_list('simulation__user_id', flat=True))
+    queued = models.SimulationRun.objects.filter(
+        status='Queued').select_related('simulation').order_by('id')
+    keys = dict()
+    for run in queued:
+        user = run.simulation.user_id
+        keys[run] = (users[user], run.id)
+        users[user] += 1
+    return sorted(keys, key=keys.get)
+
+
+def queue_position(run):
+    """Return the position of a queued SimulationRun in the run queue
+    (starting at 1) or None if the run is not in the queue anymore (e.g. it
+    has just been started by the run dispatcher)."""
+    queue = [queued.id for queued in run_queue()]
+    if run.id not in queue:
+        return None
+    return queue.index(run.id) + 1
+
+
+def write_arg_file(run):
+    """Write the argument file used by Metrosim for a SimulationRun and
+    return its path."""
     simulation = run.simulation
     metrosim_dir = settings.BASE_DIR + '/metrosim_files/'
-    metrosim_file = '{0}execs/metrosim'.format(metrosim_dir)
     arg_file = (
         '{0}arg_files/simulation_{1!s}_run_{2!s}.txt'
     ).format(metrosim_dir, simulation.id, run.id)
@@ -187,46 +418,7 @@ def run_simulation(run, background=True):
             db_host, db_name, db_user, db_pass, log, tmp, stop, simulation.id,
             run.id, random_seed)
         f.write(arguments)
-
-    # Run the script 'prepare_run.py' then run metrosim then run the script
-    # 'run_end.py'.
-    # The two scripts are run with the run.id as an argument.
-    prepare_run_file = settings.BASE_DIR + '/metro_app/prepare_run.py'
-    build_results_file = settings.BASE_DIR + '/metro_app/build_results.py'
-    log_file = (
-        '{0}/website_files/script_logs/run_{1}.txt'.format(
-            settings.BASE_DIR, run.id
-        )
-    )
-
-    # Command looks like:
-    #
-    # python3 ./metro_app/prepare_results.py y &&
-    # ./metrosim_files/execs/metrosim
-    # ./metrosim_files/arg_files/simulation_x_run_y.txt
-    # && python3 ./metro_app/build_results.py y
-    #
-    # The python executable is the same as the one used by Django (i.e.
-    # sys.executable).
-    command = (
-        '{executable} {first_script} {run_id} && '
-        '{metrosim} {argfile} && '
-        '{executable} {second_script} {run_id}'
-    )
-    command = command.format(
-        executable=sys.executable, first_script=prepare_run_file,
-        run_id=run.id, metrosim=metrosim_file, argfile=arg_file,
-        second_script=build_results_file,
-    )
-    # Call the command in a shell and redirect stdout and stderr to the log
-    # file.
-    with open(log_file, 'w') as f:
-        if background:
-            # Run the command in a background process.
-            subprocess.Popen(command, shell=True, stdout=f, stderr=f)
-        else:
-            # Wait for the command to end before terminating.
-            subprocess.call(command, shell=True, stdout=f, stderr=f)
+    return arg_file
 
 
 def run_batch(batch):
@@ -248,18 +440,203 @@ def run_batch(batch):
         subprocess.Popen(command, shell=True, stderr=f, stdout=f)
 
 
+def queue_import(simulation, kind, import_file, demandsegment=None):
+    """Function to create an ImportJob for an uploaded file and start the
+    background import.
+
+    The function returns immediately with the ImportJob. See run_import.
+    """
+    job = models.ImportJob(simulation=simulation, kind=kind,
+                           demandsegment=demandsegment,
+                           import_file=import_file)
+    job.save()
+    run_import(job)
+    return job
+
+
+def run_import(job):
+    """Function to start the background import of the files of a simulation.
+
+    The script 'import_run.py' imports all the queued ImportJob of the
+    simulation, one after the other. The script is not started if another
+    import is already running for the simulation (the running script will
+    import the job once it is done with the previous ones).
+    The running jobs without recent heartbeat are marked as failed first: the
+    script importing them has died (e.g. it was killed or the server was
+    restarted).
+    """
+    simulation = job.simulation
+    running_jobs = models.ImportJob.objects.filter(
+        simulation=simulation, status='Running'
+    )
+    limit = timezone.now() - datetime.timedelta(
+        seconds=IMPORT_HEARTBEAT_TIMEOUT)
+    running_jobs.filter(
+        Q(heartbeat__lt=limit) | Q(heartbeat__isnull=True)
+    ).update(status='Failed', end_time=timezone.now())
+    if running_jobs.exists():
+        return
+    import_run_file = settings.BASE_DIR + '/metro_app/import_run.py'
+    log_file = (
+        '{0}/website_files/script_logs/import_{1}.txt'.format(
+            settings.BASE_DIR, job.id)
+    )
+
+    command = '{executable} {script} {simulation_id}'
+    command = command.format(
+        executable=sys.executable, script=import_run_file,
+        simulation_id=simulation.id,
+    )
+    # Call the command in a shell and redirect stdout and stderr to the log
+    # file.
+    with open(log_file, "w") as f:
+        subprocess.Popen(command, shell=True, stderr=f, stdout=f)
+
+
 def stop_run(run):
-    if run.status == 'Running':
-        # Create the stop file.
-        # The simulation will stop at the end of the current iteration.
-        stop_file = '{0}/metrosim_files/stop_files/run_{1}.stop'.format(
-            settings.BASE_DIR, run.id)
-        open(stop_file, 'a').close()
+    if run.status in ('Queued', ) + RUN_IN_PROGRESS:
         # Change the status of the run.
+        # The run dispatcher kills the current phase of the run (if the run
+        # has started).
         run.status = 'Aborted'
         run.save()
 
 
+def get_results_directory(run):
+    """Return the directory where the network results of a SimulationRun are
+    stored.
+
+    The directory contains a file meta.json (stats, palette and output
+    types), a file link_ids.npy with the ids of the links and one file
+    <output_type>.npy for each output type, with one row for each link and
+    one column for each period.
+    """
+    return '{0}/website_files/network_output/results_{1}_{2}'.format(
+        settings.BASE_DIR, run.simulation.id, run.id)
+
+
+def has_run_results(run):
+    """Return True if the network results of a SimulationRun are stored."""
+    return os.path.isfile(get_results_directory(run) + '/meta.json')
+
+
+def write_run_results(run, link_ids, output, meta):
+    """Store the network results of a SimulationRun as binary numpy files.
+
+    The argument output is a dictionary with a numpy array for each output
+    type listed in meta['output_types'].
+    """
+    dir_name = get_results_directory(run)
+    os.makedirs(dir_name, exist_ok=True)
+    np.save(dir_name + '/link_ids.npy', np.asarray(link_ids, dtype=np.int64))
+    for output_type in meta['output_types']:
+        np.save('{0}/{1}.npy'.format(dir_name, output_type),
+                np.asarray(output[output_type], dtype=np.int16))
+    # The meta file is written last so that the results are considered as
+    # stored only when all the arrays are written.
+    with open(dir_name + '/meta.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def convert_run_results(run, palette, palette_size):
+    """Store as binary numpy files the network results of a SimulationRun
+    built before the results were stored this way (the results were stored
+    in a json file with the values and the colors of each link and period).
+
+    Return False if the run has no results in the old format.
+    """
+    old_file = '{0}/website_files/network_output/results_{1}_{2}.json'.format(
+        settings.BASE_DIR, run.simulation.id, run.id)
+    if not os.path.isfile(old_file):
+        return False
+    with open(old_file, 'r') as f:
+        old_results = json.load(f)
+    output_types = [output_type for output_type in old_results['stats']
+                    if output_type in old_results]
+    if not output_types or not old_results[output_types[0]]['values']:
+        return False
+    # The links are in the same order for all output types.
+    link_ids = list(old_results[output_types[0]]['values'])
+    output = dict()
+    for output_type in output_types:
+        values = old_results[output_type]['values']
+        output[output_type] = np.array(
+            [[values[link_id][period]
+              for period in sorted(values[link_id], key=int)]
+             for link_id in link_ids],
+            dtype=np.int16,
+        )
+    meta = {
+        'palette': palette,
+        'palette_size': palette_size,
+        'output_types': output_types,
+        'stats': {output_type: old_results['stats'][output_type]
+                  for output_type in output_types},
+    }
+    write_run_results(run, [int(link_id) for link_id in link_ids], output,
+                      meta)
+    return True
+
+
+def read_run_results(run):
+    """Return the stored network results of a SimulationRun.
+
+    Return a dictionary with the content of the meta file, the ids of the
+    links and the arrays of each output type.
+    The arrays are memory-mapped so that only the slices which are used are
+    read from the disk.
+    """
+    dir_name = get_results_directory(run)
+    with open(dir_name + '/meta.json', 'r') as f:
+        results = json.load(f)
+    results['link_ids'] = np.load(dir_name + '/link_ids.npy')
+    results['arrays'] = dict()
+    for output_type in results['output_types']:
+        results['arrays'][output_type] = np.load(
+            '{0}/{1}.npy'.format(dir_name, output_type), mmap_mode='r')
+    return results
+
+
+def slice_run_results(results, output_type, periods=None, links=None):
+    """Return the values and the colors of an output type for some periods
+    and some links.
+
+    The argument results is the dictionary returned by read_run_results.
+    Periods and links are slices or arrays of indices (by default, all
+    periods and all links are returned).
+    The colors are given as indices of the palette of the results.
+    """
+    array = results['arrays'][output_type]
+    if links is None:
+        links = slice(None)
+    if periods is None:
+        periods = slice(None)
+    values = np.asarray(array[links, periods])
+    colors = value_to_color_index(
+        values, 0, results['stats'][output_type]['max'],
+        results['palette_size'])
+    return values, colors
+
+
+def value_to_color_index(values, min_val, max_val, size):
+    """Return the index of the color of each value in a colorscale with the
+    given number of colors.
+
+    The values can be a numpy array of any shape, the returned array has the
+    same shape.
+    """
+    values = np.asarray(values, dtype=float)
+    if max_val == min_val:
+        # All values have the first color of the colorscale.
+        return np.zeros(values.shape, dtype=np.int16)
+    # Express values in percentage of the interval [min_val, max_val].
+    values = (values - min_val) / (max_val - min_val)
+    # Find the closest color of the colorscale (values outside the interval
+    # have the color of the closest bound).
+    indices = np.rint(values * (size - 1))
+    return np.clip(indices, 0, size - 1).astype(np.int16)
+
+
 def get_export_directory():
     """Function to create a new directory used to export files."""
     # To avoid conflict if two users export a file at the same time, we put
@@ -303,7 +680,9 @@ def create_simulation(user, form):
     function_set.save()
     # Add defaults functions.
     function = models.Function(
-        name='Free flow', user_id=1, expression='3600*(length/speed)')
+        name='Free flow', user_id=1, expression='3600*(length/speed)',
+        owner_functionset=function_set,
+    )
     function.save()
     function.vdf_id = function.id
     function.save()
@@ -314,6 +693,7 @@ def create_simulation(user, form):
             '3600*((dynVol<=(lanes*capacity*length/speed))*(length/speed)+'
             '(dynVol>(lanes*capacity*length/speed))*(dynVol/(capacity*lanes)))'
         ),
+        owner_functionset=function_set,
     )
     function.save()
     function.vdf_id = function.id
@@ -341,45 +721,633 @@ def create_simulation(user, form):
     return simulation
 
 
-def simulation_import(simulation, f):
+def count_copy_rows(simulation):
+    """Return the number of rows copied by copy_simulation (objects of the
+    network, OD pairs and policies), used to report the progress of a copy.
+    """
+    nb_rows = 0
+    for object_name in ('link', 'function', 'centroid', 'crossing', 'policy',
+                        'public_transit'):
+        query = get_query(object_name, simulation)
+        if query is not None:
+            nb_rows += query.count()
+    nb_rows += models.Matrix.objects.filter(
+        matrices__in=get_query('matrices', simulation)).count()
+    return nb_rows
+
+
+def copy_supply(cursor, supply, copied=None):
+    """Function to copy a supply (network, functions and public transit).
+
+    Returns the new supply, the batch tag of the new centroids and the batch
+    tag of the new link selections. The new centroids and link selections
+    keep their tag and the id of the object they are a copy of, so that the
+    OD matrices and the policies can be updated, until clear_copy_tags is
+    called.
+
+    The function copied is called with the cursor after each query
+    inserting rows (it is used to report progress).
+    """
+    # (1) Supply.
+    functionset = models.FunctionSet.objects.get(pk=supply.functionset.id)
+    functionset.pk = None
+    functionset.save()
+    network = models.Network.objects.get(pk=supply.network.id)
+    network.pk = None
+    network.save()
+    # (1.1) Links.
+    link_tag = new_batch_tag()
+    # Copy all links of the old network.
+    cursor.execute(
+        "INSERT INTO Link (name, destination, lanes, length, origin, "
+        "speed, ul1, ul2, ul3, capacity, dynVol, dynFlo, staVol, vdf, "
+        "user_id, batch_tag, copy_of) "
+        "SELECT Link.name, Link.destination, Link.lanes, "
+        "Link.length, Link.origin, Link.speed, Link.ul1, Link.ul2, "
+        "Link.ul3, Link.capacity, Link.dynVol, Link.dynFlo, "
+        "Link.staVol, Link.vdf, Link.user_id, %s, Link.id "
+        "FROM Link "
+        "JOIN Network_Link "
+        "ON Link.id = Network_Link.link_id "
+        "WHERE Network_Link.network_id = %s;",
+        [link_tag, supply.network.id]
+    )
+    if copied is not None:
+        copied(cursor)
+    # (1.2) Functions.
+    tag = new_batch_tag()
+    # Copy all functions.
+    cursor.execute(
+        "INSERT INTO `Function` (name, expression, user_id, vdf_id, "
+        "batch_tag, copy_of) "
+        "SELECT `Function`.name, `Function`.expression, "
+        "`Function`.user_id, `Function`.vdf_id, %s, `Function`.id "
+        "FROM `Function` JOIN FunctionSet_Function "
+        "ON `Function`.id = FunctionSet_Function.function_id "
+        "WHERE FunctionSet_Function.functionset_id = %s;",
+        [tag, supply.functionset.id]
+    )
+    if copied is not None:
+        copied(cursor)
+    # Set vdf_id equal to the id of the functions.
+    cursor.execute(
+        "UPDATE `Function` SET vdf_id = id WHERE batch_tag = %s;",
+        [tag]
+    )
+    # Update the function of the new links using the old function ids.
+    cursor.execute(
+        "UPDATE Link "
+        "JOIN `Function` "
+        "ON `Function`.batch_tag = %s "
+        "AND `Function`.copy_of = Link.vdf "
+        "SET Link.vdf = `Function`.id "
+        "WHERE Link.batch_tag = %s;",
+        [tag, link_tag]
+    )
+    # Add the many-to-many relations betweens functions and functionset.
+    add_tagged_relations(cursor, 'function', functionset, tag)
+    # (1.3) Centroids and crossings.
+    # The tag of the centroids is kept until the OD matrices are copied.
+    centroid_tag = new_batch_tag()
+    cursor.execute(
+        "INSERT INTO Centroid (name, x, y, uz1, uz2, uz3, user_id, "
+        "batch_tag, copy_of) "
+        "SELECT Centroid.name, Centroid.x, Centroid.y, Centroid.uz1, "
+        "Centroid.uz2, Centroid.uz3, Centroid.user_id, %s, Centroid.id "
+        "FROM Centroid "
+        "JOIN Network_Centroid "
+        "ON Centroid.id = Network_Centroid.centroid_id "
+        "WHERE Network_Centroid.network_id = %s;",
+        [centroid_tag, supply.network.id]
+    )
+    if copied is not None:
+        copied(cursor)
+    tag = new_batch_tag()
+    cursor.execute(
+        "INSERT INTO Crossing (name, x, y, un1, un2, un3, user_id, "
+        "batch_tag, copy_of) "
+        "SELECT Crossing.name, Crossing.x, Crossing.y, Crossing.un1, "
+        "Crossing.un2, Crossing.un3, Crossing.user_id, %s, Crossing.id "
+        "FROM Crossing "
+        "JOIN Network_Crossing "
+        "ON Crossing.id = Network_Crossing.crossing_id "
+        "WHERE Network_Crossing.network_id = %s;",
+        [tag, supply.network.id]
+    )
+    if copied is not None:
+        copied(cursor)
+    # Update the origin and destination of the new links using the old
+    # node ids (a node is either a centroid or a crossing). Both tables
+    # are joined in the same query so that a node is never updated twice.
+    for column in ('origin', 'destination'):
+        cursor.execute(
+            "UPDATE Link "
+            "LEFT JOIN Centroid "
+            "ON Centroid.batch_tag = %s "
+            "AND Centroid.copy_of = Link.{0} "
+            "LEFT JOIN Crossing "
+            "ON Crossing.batch_tag = %s "
+            "AND Crossing.copy_of = Link.{0} "
+            "SET Link.{0} = COALESCE(Centroid.id, Crossing.id, Link.{0}) "
+            "WHERE Link.batch_tag = %s;".format(column),
+            [centroid_tag, tag, link_tag]
+        )
+    # Add the many-to-many relations between crossings and network.
+    add_tagged_relations(cursor, 'crossing', network, tag)
+    # (1.4) Link selections (used as location of the policies).
+    selection_tag = new_batch_tag()
+    cursor.execute(
+        "INSERT INTO LinkSelection (name, network, storetype, definition, "
+        "user_id, batch_tag, copy_of) "
+        "SELECT name, %s, storetype, definition, user_id, %s, id "
+        "FROM LinkSelection WHERE network = %s;",
+        [network.id, selection_tag, supply.network.id]
+    )
+    cursor.execute(
+        "INSERT INTO LinkSelection_Link (linkselection_id, link_id) "
+        "SELECT LinkSelection.id, Link.id "
+        "FROM LinkSelection "
+        "JOIN LinkSelection_Link "
+        "ON LinkSelection_Link.linkselection_id = LinkSelection.copy_of "
+        "JOIN Link "
+        "ON Link.batch_tag = %s "
+        "AND Link.copy_of = LinkSelection_Link.link_id "
+        "WHERE LinkSelection.batch_tag = %s;",
+        [link_tag, selection_tag]
+    )
+    # Add the many-to-many relations between links and network (the links
+    # are not modified anymore).
+    add_tagged_relations(cursor, 'link', network, link_tag)
+    # (1.5) Public transit.
+    pttimes = None
+    if supply.pttimes:
+        pttimes = models.Matrices.objects.get(pk=supply.pttimes.id)
+        pttimes.pk = None
+        pttimes.save()
+        copy_matrix(cursor, supply.pttimes, pttimes, centroid_tag)
+        if copied is not None:
+            copied(cursor)
+    supply = models.Supply.objects.get(pk=supply.id)
+    supply.pk = None
+    supply.network = network
+    supply.functionset = functionset
+    supply.pttimes = pttimes
+    supply.save()
+    return supply, centroid_tag, selection_tag
+
+
+def copy_demand(cursor, demand, centroid_tag=None, copied=None):
+    """Function to copy a demand (demand segments, usertypes and OD
+    matrices).
+
+    If centroid_tag is given, the origins and destinations of the OD pairs
+    are replaced by the centroids inserted with this tag (see copy_supply),
+    else the OD pairs are copied as is (the copy uses the same network).
+    Returns the new demand and a dictionary mapping the old usertype ids to
+    the new ones.
+    """
+    demand = models.Demand.objects.get(pk=demand.id)
+    demand_segments = demand.demandsegment_set.all()
+    demand.pk = None
+    demand.save()
+    usertype_ids = dict()
+    for demand_segment in demand_segments:
+        # (2.1) UserType.
+        usertype = models.UserType.objects.get(pk=demand_segment.usertype.id)
+        old_usertype_id = usertype.id
+        usertype.pk = None
+        # Copy all distributions.
+        for distribution in ('alphaTI', 'alphaTP', 'beta', 'delta',
+                             'departureMu', 'gamma', 'modeMu', 'penaltyTP',
+                             'routeMu', 'tstar'):
+            instance = getattr(usertype, distribution)
+            instance.pk = None
+            instance.save()
+            setattr(usertype, distribution, instance)
+        usertype.save()
+        usertype_ids[old_usertype_id] = usertype.id
+        # (2.2) OD Matrix.
+        matrix = models.Matrices.objects.get(pk=demand_segment.matrix.id)
+        matrix.pk = None
+        matrix.save()
+        # (2.3) OD Matrix pairs.
+        copy_matrix(cursor, demand_segment.matrix, matrix, centroid_tag)
+        if copied is not None:
+            copied(cursor)
+        # (2.4) Demand Segment.
+        demand_segment.pk = None
+        demand_segment.usertype = usertype
+        demand_segment.matrix = matrix
+        demand_segment.owner_demand = demand
+        demand_segment.save()
+        # (2.5) Add the relations.
+        demand_segment.demand.clear()
+        demand_segment.demand.add(demand)
+    return demand, usertype_ids
+
+
+def copy_matrix(cursor, matrix, new_matrix, centroid_tag=None):
+    """Function to copy the OD pairs of a matrix in another matrix.
+
+    If centroid_tag is given, the origins and destinations are replaced by
+    the copies of the centroids (the centroids inserted with the batch tag
+    centroid_tag).
+    """
+    if centroid_tag is None:
+        cursor.execute(
+            "INSERT INTO Matrix (r, p, q, matrices_id) "
+            "SELECT r, p, q, %s FROM Matrix WHERE matrices_id = %s;",
+            [new_matrix.id, matrix.id]
+        )
+        return
+    cursor.execute(
+        "INSERT INTO Matrix (r, p, q, matrices_id) "
+        "SELECT Matrix.r, origin.id, destination.id, %s "
+        "FROM Matrix "
+        "JOIN Centroid AS origin "
+        "ON origin.batch_tag = %s AND origin.copy_of = Matrix.p "
+        "JOIN Centroid AS destination "
+        "ON destination.batch_tag = %s AND destination.copy_of = Matrix.q "
+        "WHERE Matrix.matrices_id = %s;",
+        [new_matrix.id, centroid_tag, centroid_tag, matrix.id]
+    )
+
+
+def remap_matrix(cursor, matrix, centroid_tag):
+    """Function to replace, in place, the origins and destinations of the OD
+    pairs of a matrix by the copies of the centroids (the centroids inserted
+    with the batch tag centroid_tag).
+    """
+    for column in ('p', 'q'):
+        cursor.execute(
+            "UPDATE Matrix "
+            "JOIN Centroid "
+            "ON Centroid.batch_tag = %s AND Centroid.copy_of = Matrix.{0} "
+            "SET Matrix.{0} = Centroid.id "
+            "WHERE Matrix.matrices_id = %s;".format(column),
+            [centroid_tag, matrix.id]
+        )
+
+
+def copy_policies(cursor, scenario, new_scenario, copied=None):
+    """Function to copy the policies of a scenario in another scenario.
+
+    The vectors are never modified so they are shared by the copies.
+    """
+    tag = new_batch_tag()
+    cursor.execute(
+        "INSERT INTO Policy (usertype, location, baseValue, timeVector, "
+        "valueVector, type, parameter, dayStart, dayEnd, batch_tag) "
+        "SELECT Policy.usertype, Policy.location, Policy.baseValue, "
+        "Policy.timeVector, Policy.valueVector, Policy.type, "
+        "Policy.parameter, Policy.dayStart, Policy.dayEnd, %s "
+        "FROM Policy "
+        "JOIN Scenario_Policy "
+        "ON Scenario_Policy.policy_id = Policy.id "
+        "WHERE Scenario_Policy.scenario_id = %s;",
+        [tag, scenario.id]
+    )
+    if copied is not None:
+        copied(cursor)
+    cursor.execute(
+        "INSERT INTO Scenario_Policy (scenario_id, policy_id) "
+        "SELECT %s, id FROM Policy WHERE batch_tag = %s;",
+        [new_scenario.id, tag]
+    )
+    models.Policy.objects.filter(batch_tag=tag).update(batch_tag=None)
+
+
+def remap_policies(cursor, scenario, selection_tag=None, usertype_ids=None):
+    """Function to update the policies of a scenario after a copy of its
+    supply (the locations are replaced by the link selections inserted with
+    the batch tag selection_tag) or of its demand (the usertypes are replaced
+    using the mapping usertype_ids).
+    """
+    if selection_tag is not None:
+        cursor.execute(
+            "UPDATE Policy "
+            "JOIN Scenario_Policy "
+            "ON Scenario_Policy.policy_id = Policy.id "
+            "JOIN LinkSelection "
+            "ON LinkSelection.batch_tag = %s "
+            "AND LinkSelection.copy_of = Policy.location "
+            "SET Policy.location = LinkSelection.id "
+            "WHERE Scenario_Policy.scenario_id = %s;",
+            [selection_tag, scenario.id]
+        )
+    if usertype_ids:
+        policies = models.Policy.objects.filter(scenario=scenario)
+        for old_id, new_id in usertype_ids.items():
+            policies.filter(usertype_id=old_id).update(usertype_id=new_id)
+
+
+def clear_copy_tags(cursor, network, centroid_tag, selection_tag):
+    """Function to add the centroids copied by copy_supply to their network
+    and to reset the batch tags of the centroids and link selections."""
+    add_tagged_relations(cursor, 'centroid', network, centroid_tag)
+    models.LinkSelection.objects.filter(batch_tag=selection_tag).update(
+        batch_tag=None, copy_of=None)
+
+
+def replace_scenario(simulation, copy, scenario):
+    """Function to give a new scenario to a simulation created with
+    create_simulation.
+
+    The parameters of the simulation copy are set to the parameters of the
+    simulation (except the ones set by the user: name, comment, etc.) and
+    the empty objects created with the simulation copy are deleted.
+    """
+    old_scenario = copy.scenario
+    user_fields = ('id', 'user_id', 'name', 'comment', 'public',
+                   'environment_id', 'contact', 'pinned', 'scenario_id',
+                   'has_changed', 'parent_batch_id')
+    for field in simulation._meta.concrete_fields:
+        if field.attname not in user_fields:
+            setattr(copy, field.attname, getattr(simulation, field.attname))
+    copy.scenario = scenario
+    # Here, we could copy the json file of the copied simulation if the
+    # copied simulation has not changed. For now, I only put has_changed to
+    # True for the new simulation so that a new json file will be generated.
+    copy.has_changed = True
+    copy.save()
+    # Delete the empty objects created with the simulation (as in the
+    # simulation_delete view, the supply and the scenario are deleted in
+    # cascade).
+    models.Function.objects.filter(
+        functionset=old_scenario.supply.functionset).delete()
+    old_scenario.supply.network.delete()
+    old_scenario.supply.functionset.delete()
+    old_scenario.demand.delete()
+
+
+def copy_simulation(simulation, copy, progress=None):
+    """Function to copy the supply, the demand and the policies of a
+    simulation in another simulation.
+
+    Parameters
+    ----------
+    simulation: Simulation object.
+        Simulation to copy.
+    copy: Simulation object.
+        Simulation receiving the copy, created with create_simulation (see
+        replace_scenario).
+    progress: Function, optional.
+        Function called with the number of rows copied so far (see
+        count_copy_rows).
+
+    Django ORM is too slow for bulk operations on the database so we use
+    mainly raw SQL queries. The rows are copied with INSERT ... SELECT queries
+    and the new rows store the id of the row they are a copy of (with a batch
+    tag, see new_batch_tag) so that all the relations between the new objects
+    can be updated with joins. To copy the few other objects, we set their
+    primary key to None and we save them again.
+    Everything is done in a single transaction.
+    """
+    nb_rows = 0
+
+    def copied(cursor):
+        nonlocal nb_rows
+        nb_rows += max(cursor.rowcount, 0)
+        if progress is not None:
+            progress(nb_rows)
+
+    old_scenario = simulation.scenario
+    with transaction.atomic(), connection.cursor() as cursor:
+        supply, centroid_tag, selection_tag = copy_supply(
+            cursor, old_scenario.supply, copied)
+        demand, usertype_ids = copy_demand(
+            cursor, old_scenario.demand, centroid_tag, copied)
+        scenario = models.Scenario.objects.get(pk=old_scenario.id)
+        scenario.pk = None
+        scenario.supply = supply
+        scenario.demand = demand
+        scenario.save()
+        copy_policies(cursor, old_scenario, scenario, copied)
+        remap_policies(cursor, scenario, selection_tag, usertype_ids)
+        clear_copy_tags(cursor, supply.network, centroid_tag, selection_tag)
+        replace_scenario(simulation, copy, scenario)
+    return copy
+
+
+def share_simulation(simulation, copy):
+    """Function to make a copy-on-write copy of a simulation.
+
+    The copy gets a new scenario with a copy of the policies but it uses the
+    same supply and demand as the copied simulation. A private copy of the
+    supply or of the demand is made only when one of the simulations sharing
+    it modifies it (see detach).
+    """
+    old_scenario = simulation.scenario
+    with transaction.atomic(), connection.cursor() as cursor:
+        scenario = models.Scenario.objects.get(pk=old_scenario.id)
+        scenario.pk = None
+        scenario.save()
+        copy_policies(cursor, old_scenario, scenario)
+        replace_scenario(simulation, copy, scenario)
+    return copy
+
+
+def delete_simulation(simulation):
+    """Function to delete a simulation and all objects associated with it.
+
+    The supply and the demand are not deleted if they are shared with other
+    simulations. The simulations created for the runs of the batches of the
+    simulation are deleted too.
+    """
+    for copy in models.Simulation.objects.filter(
+            parent_batch__simulation=simulation):
+        delete_simulation(copy)
+    models.SimulationMOEs.objects.filter(simulation=simulation.id).delete()
+    get_query('policy', simulation).delete()
+    scenario = simulation.scenario
+    shared_supply = is_shared(simulation, 'supply')
+    shared_demand = is_shared(simulation, 'demand')
+    if not shared_supply:
+        scenario.supply.network.delete()
+        scenario.supply.functionset.delete()
+    if not shared_demand:
+        scenario.demand.delete()
+    if shared_supply and shared_demand:
+        # The simulation is deleted in cascade.
+        scenario.delete()
+
+
+def is_shared(simulation, part):
+    """Return True if the supply or the demand (part is 'supply' or
+    'demand') of the simulation is also used by other simulations."""
+    scenario = simulation.scenario
+    scenarios = models.Scenario.objects.filter(
+        **{part: getattr(scenario, part)}).exclude(pk=scenario.pk)
+    return scenarios.exists()
+
+
+def detach(simulation, part):
+    """Function to call before modifying the supply or the demand (part is
+    'supply' or 'demand') of a simulation, so that the other simulations
+    sharing it are not modified (copy on write).
+
+    The simulation keeps the objects (so the ids used in the pages of the
+    simulation remain valid) and the other simulations sharing them receive
+    a copy. As the OD matrices refer to the centroids of the network, the
+    other simulations also receive a copy of the demand when the supply is
+    copied (unless they do not share the demand with the simulation).
+
+    The copy is made synchronously, in the request of the view modifying the
+    simulation (see views.copy_on_write).
+    A ValidationError is raised if one of the other simulations has a run in
+    progress or a running batch, as the run would read the objects while they
+    are copied.
+    """
+    scenario = simulation.scenario
+    others = list(models.Scenario.objects.filter(
+        **{part: getattr(scenario, part)}).exclude(pk=scenario.pk))
+    if not others:
+        return
+    other_ids = [other.id for other in others]
+    with transaction.atomic(), connection.cursor() as cursor:
+        # The queued runs are locked so that the run dispatcher cannot start
+        # them before the end of the copy.
+        runs = list(models.SimulationRun.objects.select_for_update().filter(
+            simulation__scenario__in=other_ids,
+            status__in=('Queued', ) + RUN_IN_PROGRESS,
+        ).values_list('status', flat=True))
+        running_batch = models.Batch.objects.filter(
+            Q(simulation__scenario__in=other_ids)
+            | Q(copies__scenario__in=other_ids),
+            status='Running',
+        ).exists()
+        if running_batch or any(status in RUN_IN_PROGRESS for status in runs):
+            raise ValidationError(
+                'The {} of the simulation is shared with a simulation which '
+                'is running. Wait for the end of the run before modifying '
+                'it.'.format(part))
+        if part == 'supply':
+            supply, centroid_tag, selection_tag = copy_supply(
+                cursor, scenario.supply)
+            # Copy (or update) the demands of the other simulations.
+            demands = dict()
+            for other in others:
+                if other.demand_id not in demands:
+                    demand = other.demand
+                    shared_demand = models.Scenario.objects.filter(
+                        demand=demand).exclude(pk__in=other_ids).exists()
+                    if shared_demand:
+                        # The demand is also used by simulations keeping the
+                        # old supply.
+                        demands[demand.id] = copy_demand(cursor, demand,
+                                                         centroid_tag)
+                    else:
+                        for matrix in models.Matrices.objects.filter(
+                                demandsegment__demand=demand):
+                            remap_matrix(cursor, matrix, centroid_tag)
+                        demands[demand.id] = (demand, None)
+                demand, usertype_ids = demands[other.demand_id]
+                remap_policies(cursor, other, selection_tag, usertype_ids)
+                other.supply = supply
+                other.demand = demand
+                other.save()
+            clear_copy_tags(cursor, supply.network, centroid_tag,
+                            selection_tag)
+        else:
+            demand, usertype_ids = copy_demand(cursor, scenario.demand)
+            for other in others:
+                remap_policies(cursor, other, usertype_ids=usertype_ids)
+                other.demand = demand
+                other.save()
+    for other_simulation in models.Simulation.objects.filter(
+            scenario__in=other_ids):
+        if part == 'supply':
+            simulation_changed(other_simulation)
+        else:
+            simulation_changed(other_simulation, 'demand')
+
+
+def count_file_rows(f):
+    """Return the number of rows (header excluded) of a tsv or csv file, or
+    of all the tsv and csv files of a zip file.
+
+    The file is read from the beginning and rewound afterwards.
+    """
+    f.seek(0)
+    if zipfile.is_zipfile(f):
+        f.seek(0)
+        with zipfile.ZipFile(f) as z:
+            nb_rows = sum(
+                count_file_rows(z.open(filename))
+                for filename in z.namelist()
+                if re.search('[.][tc]sv$', filename)
+            )
+    else:
+        f.seek(0)
+        nb_rows = max(sum(1 for line in f) - 1, 0)
+    f.seek(0)
+    return nb_rows
+
+
+def zip_progress(f, progress=None):
+    """Return a function to call with the name of each file imported from the
+    zip file f.
+
+    The function calls progress with the total number of rows of the files
+    imported so far. It does nothing if progress is None.
+    """
+    nb_rows = 0
+
+    def imported(filename):
+        nonlocal nb_rows
+        if progress is not None:
+            nb_rows += count_file_rows(f.open(filename))
+            progress(nb_rows)
+
+    return imported
+
+
+def simulation_import(simulation, f, progress=None):
     """Method to import a simulation as a zip file in the Home Button"""
     f = zipfile.ZipFile(f)
     namelist = f.namelist()
+    imported = zip_progress(f, progress)
 
     for filename in namelist:
         if re.search('/zones.[tc]sv$', filename):
             object_import_function(
                 f.open(filename), simulation, 'centroid')
+            imported(filename)
             break
 
     for filename in namelist:
         if re.search('/intersections.[tc]sv$', filename):
             object_import_function(
                 f.open(filename), simulation, 'crossing')
+            imported(filename)
             break
 
     for filename in namelist:
         if re.search('/links.[tc]sv$', filename):
             object_import_function(
                 f.open(filename), simulation, 'link')
+            imported(filename)
             break
 
     for filename in namelist:
         if re.search('/congestion_functions.[tc]sv$', filename):
             object_import_function(
                 f.open(filename), simulation, 'function')
+            imported(filename)
             break
 
     for filename in namelist:
         if re.search('/public_transit.[tc]sv$', filename):
             public_transit_import_function(
                 f.open(filename), simulation)
+            imported(filename)
             break
 
     for filename in namelist:
         if re.search('/traveler_types.[tc]sv$', filename):
             usertype_import_function(
                 f.open(filename), simulation)
+            imported(filename)
             break
 
     demandsegments = get_query('demandsegment', simulation)
@@ -397,23 +1365,27 @@ def simulation_import(simulation, f):
             # Import the matrix file in the new demandsegment.
             matrix_import_function(
                 f.open(filename), simulation, demandsegment)
+            imported(filename)
 
     for filename in namelist:
         if re.search('/pricings.[tc]sv$', filename):
             pricing_import_function(
                 f.open(filename), simulation)
+            imported(filename)
             break
 
 
-def traveler_zip_file(simulation, f):
+def traveler_zip_file(simulation, f, progress=None):
     """Method to Implement the traveler zip file in the external script"""
     f = zipfile.ZipFile(f)
     namelist = f.namelist()
+    imported = zip_progress(f, progress)
 
     for filename in namelist:
         if re.search('/traveler_types.[tc]sv$', filename):
             usertype_import_function(
                 f.open(filename), simulation)
+            imported(filename)
             break
 
     demandsegments = get_query('demandsegment', simulation)
@@ -431,9 +1403,11 @@ def traveler_zip_file(simulation, f):
             # Import the matrix file in the new demandsegment.
             matrix_import_function(
                 f.open(filename), simulation, demandsegment)
+            imported(filename)
 
 
-def object_import_function(encoded_file, simulation, object_name):
+def object_import_function(encoded_file, simulation, object_name,
+                           progress=None):
     """Function to import a file representing the input of a simulation.
 
     Parameters
@@ -445,6 +1419,8 @@ def object_import_function(encoded_file, simulation, object_name):
     object_name: String.
         Name of the input to modify: 'centroid', 'crossing', 'link' or
         'function'.
+    progress: Function, optional.
+        Function called with the number of rows of the file processed so far.
 
     This function could be much more simple but I tried to use as little as
     possible Django ORM (the querysets) to speed up the view.
@@ -454,6 +1430,9 @@ def object_import_function(encoded_file, simulation, object_name):
     compares the values in the file with the values in the database to know if
     the instance needs to be updated.
     Python built-in set are used to perform comparison of arrays quickly.
+    The changed instances are updated with a single query (see
+    update_objects) and the new instances are inserted directly from the
+    columns of the DataFrame (see insert_rows).
     """
     # Convert imported file to a csv DictReader.
     tsv_file = StringIO(encoded_file.read().decode())
@@ -483,11 +1462,8 @@ def object_import_function(encoded_file, simulation, object_name):
                                    columns=cols)
         node_df = pd.concat([centroid_df, crossing_df])
         functions = get_query('function', simulation)
-        function_df = pd.DataFrame({
-            'user_id': list(functions.values_list('user_id', flat=True)),
-            'id': list(functions.values_list('id', flat=True)),
-            'instance': list(functions),
-        })
+        function_df = pd.DataFrame(list(functions.values_list(*cols)),
+                                   columns=cols)
     # Name column is optionnal.
     # Create the column if it does not exist.
     if 'name' in df.columns:
@@ -517,29 +1493,18 @@ def object_import_function(encoded_file, simulation, object_name):
         df = df.merge(node_df, left_on='destination',
                       right_on='user_id',
                       suffixes=('', '_destination'))
-        # Add column instance_function with the function object of the
-        # given user_id.
+        # Add column id_function with the id of the function.
         df = df.merge(function_df, left_on='function',
                       right_on='user_id', suffixes=('', '_function'))
         df = df[['id', 'name', 'id_origin', 'id_destination',
-                 'id_function', 'instance', 'length', 'lanes', 'speed',
-                 'capacity']]
+                 'id_function', 'length', 'lanes', 'speed', 'capacity']]
     # Remove duplicated ids.
     df = df.drop_duplicates(subset='id', keep='last')
     # Check if user_id already exists.
-    df['new'] = ~(df['id'].isin(user_id_set))
-    if not df['new'].all():
+    new = ~(df['id'].isin(user_id_set))
+    if not new.all():
         # Some existing objects needs to be updated.
-        if object_name == 'link':
-            new_values = set(
-                map(tuple, df.loc[~df['new']].drop(
-                    columns=['new', 'instance']
-                ).values)
-            )
-        else:
-            new_values = set(
-                map(tuple, df.loc[~df['new']].drop(columns='new').values)
-            )
+        new_values = set(map(tuple, df.loc[~new].values))
         if object_name in ('centroid', 'crossing'):
             old_values = set(
                 query.values_list('user_id', 'name', 'x', 'y')
@@ -557,106 +1522,369 @@ def object_import_function(encoded_file, simulation, object_name):
         # Find the instances that really need to be updated (i.e. the
         # values have changed).
         new_values = new_values.difference(old_values)
-        if object_name in ('centroid', 'crossing', 'function'):
-            # Update the objects (it would be faster to delete and
-            # re-create them but this would require to also change the
-            # foreign keys of the links).
-            for values in new_values:
-                # Index 0 of values is the id column i.e. the user_id.
-                instance = query.filter(user_id=values[0])
-                if object_name in ('centroid', 'crossing'):
-                    instance.update(
-                        name=values[1], x=values[2], y=values[3]
-                    )
-                else:  # Function
-                    instance.update(name=values[1], expression=values[2])
-        elif object_name == 'link':
-            # Delete the updated links.
-            user_ids = [values[0] for values in new_values]
-            old_links = query.filter(user_id__in=user_ids)
-            old_links.delete()
-            # Re-create the updated links with the new links.
-            df.loc[df['id'].isin(user_ids), 'new'] = True
-    if df['new'].any():
+        if new_values:
+            # Index 0 of values is the id column i.e. the user_id.
+            updated_ids = [values[0] for values in new_values]
+            update_objects(object_name, parent,
+                           df.loc[df['id'].isin(updated_ids)])
+    if progress is not None:
+        progress(num_lines - int(new.sum()))
+    if new.any():
         # Only keep the new objects.
-        df = df.loc[df['new']]
-        # Create the new objects in bulk.
-        # The chunk size is limited by the MySQL engine (timeout if it is
-        # too big).
-        chunk_size = 10000
-        new_objects = list()
-        if object_name == 'centroid':
-            for key, row in df.iterrows():
-                new_objects.append(
-                    models.Centroid(
-                        user_id=row['id'], name=row['name'],
-                        x=row['x'], y=row['y'],
-                    )
-                )
-        elif object_name == 'crossing':
-            for key, row in df.iterrows():
-                new_objects.append(
-                    models.Crossing(
-                        user_id=row['id'], name=row['name'],
-                        x=row['x'], y=row['y'],
-                    )
-                )
+        df = df.loc[new]
+        # Insert the new objects, directly from the columns of the
+        # DataFrame.
+        if object_name in ('centroid', 'crossing'):
+            columns = {'user_id': df['id'], 'name': df['name'],
+                       'x': df['x'], 'y': df['y']}
         elif object_name == 'function':
-            for key, row in df.iterrows():
-                new_objects.append(
-                    models.Function(
-                        user_id=row['id'], name=row['name'],
-                        expression=row['expression'],
-                    )
-                )
+            columns = {'user_id': df['id'], 'name': df['name'],
+                       'expression': df['expression']}
         elif object_name == 'link':
-            for key, row in df.iterrows():
-                new_objects.append(
-                    models.Link(
-                        user_id=row['id'], name=row['name'],
-                        origin=row['id_origin'],
-                        destination=row['id_destination'], vdf=row['instance'],
-                        length=row['length'], lanes=row['lanes'],
-                        speed=row['speed'], capacity=row['capacity'],
-                    )
-                )
-        chunks = [new_objects[x:x + chunk_size]
-                  for x in range(0, len(new_objects), chunk_size)]
-        for chunk in chunks:
-            # Create the new instances.
-            query.model.objects.bulk_create(chunk, chunk_size)
-        # Retrieve new ids.
-        last_id = query.model.objects.last().id
-        new_ids = np.arange(last_id - len(new_objects) + 1, last_id + 1)
+            columns = {'user_id': df['id'], 'name': df['name'],
+                       'origin': df['id_origin'],
+                       'destination': df['id_destination'],
+                       'vdf_id': df['id_function'], 'length': df['length'],
+                       'lanes': df['lanes'], 'speed': df['speed'],
+                       'capacity': df['capacity']}
+        if progress is not None:
+            offset = num_lines - len(df)
+
+            def insert_progress(rows):
+                progress(offset + rows)
+        else:
+            insert_progress = None
+        # The new objects are tagged so that their ids can be found even if
+        # other objects are inserted at the same time.
+        tag = new_batch_tag()
+        columns['batch_tag'] = np.repeat(tag, len(df))
+        insert_rows(query.model, columns, progress=insert_progress)
         # Add the many-to-many relation to Network or FunctionSet.
-        relations = list()
-        if object_name == 'function':
-            for new_id in new_ids:
-                relations.append(
-                    query.model.functionset.through(
-                        functionset_id=parent.id, function_id=new_id
-                    )
+        with connection.cursor() as cursor:
+            add_tagged_relations(cursor, object_name, parent, tag)
+    simulation_changed(simulation)
+
+
+def insert_rows(model, columns, chunk_size=10000, progress=None):
+    """Function to insert rows in the table of a model without creating any
+    Django object.
+
+    Parameters
+    ----------
+    model: Django model.
+        Model whose table is modified.
+    columns: dict.
+        Values of the rows to insert, as a Series or an array for each
+        attribute name of the model (e.g. 'vdf_id' for the function of a
+        link). The other fields take their default value.
+    chunk_size: int.
+        Number of rows inserted with each multi-row INSERT statement (the size
+        is limited by the MySQL engine).
+    progress: Function, optional.
+        Function called with the number of rows inserted so far.
+    """
+    nb_rows = len(next(iter(columns.values())))
+    names = list()
+    values = list()
+    for field in model._meta.concrete_fields:
+        if field.attname in columns:
+            names.append(field.column)
+            values.append(np.asarray(columns[field.attname]).tolist())
+        elif field.has_default():
+            names.append(field.column)
+            values.append([field.get_default()] * nb_rows)
+    rows = list(zip(*values))
+    query = 'INSERT INTO {table} ({columns}) VALUES ({values});'.format(
+        table=connection.ops.quote_name(model._meta.db_table),
+        columns=', '.join(map(connection.ops.quote_name, names)),
+        values=', '.join(['%s'] * len(names)),
+    )
+    with connection.cursor() as cursor:
+        for x in range(0, nb_rows, chunk_size):
+            cursor.executemany(query, rows[x:x + chunk_size])
+            if progress is not None:
+                progress(min(x + chunk_size, nb_rows))
+
+
+def new_batch_tag():
+    """Return a new random tag to identify the objects created by a bulk
+    insert.
+
+    Centroids, crossings, links and functions are inserted with a batch tag
+    so that the ids of the new rows can be retrieved with a query, even when
+    other imports or copies insert rows in the same table concurrently.
+    """
+    return uuid.uuid4().int >> 65
+
+
+def add_tagged_relations(cursor, object_name, parent, tag):
+    """Function to add the objects inserted with a batch tag to their
+    network (or function set), to set their owner key and to reset their
+    tag.
+
+    Parameters
+    ----------
+    cursor: Cursor object.
+        Cursor used to execute the queries.
+    object_name: String.
+        Name of the objects: 'centroid', 'crossing', 'link' or 'function'.
+    parent: Network or FunctionSet object.
+        Network (or FunctionSet for the functions) of the new objects.
+    tag: int.
+        Batch tag of the new objects (see new_batch_tag).
+    """
+    if object_name == 'function':
+        cursor.execute(
+            "INSERT INTO FunctionSet_Function (functionset_id, function_id) "
+            "SELECT %s, id FROM `Function` WHERE batch_tag = %s;",
+            [parent.id, tag]
+        )
+        table = '`Function`'
+        owner = 'owner_functionset_id'
+    else:
+        table = object_name.capitalize()
+        owner = 'owner_network_id'
+        cursor.execute(
+            "INSERT INTO Network_{0} (network_id, {1}_id) "
+            "SELECT %s, id FROM {0} WHERE batch_tag = %s;".format(
+                table, object_name),
+            [parent.id, tag]
+        )
+    cursor.execute(
+        "UPDATE {} SET {} = %s, batch_tag = NULL, copy_of = NULL "
+        "WHERE batch_tag = %s;".format(table, owner),
+        [parent.id, tag]
+    )
+
+
+def update_objects(object_name, parent, df):
+    """Function to update the network objects of a simulation with a
+    single UPDATE statement.
+
+    Parameters
+    ----------
+    object_name: String.
+        Name of the objects to update: 'centroid', 'crossing', 'link' or
+        'function'.
+    parent: Network or FunctionSet object.
+        Network (or FunctionSet for the functions) of the objects.
+    df: DataFrame.
+        New values of the objects, with the columns of the DataFrame built in
+        object_import_function (the first column is the user id).
+
+    The rows are inserted in a temporary staging table, then the objects are
+    updated with one query joining the staging table and the table of the
+    objects (on the owner key and the user id).
+    """
+    if object_name in ('centroid', 'crossing'):
+        staging_columns = ('user_id BIGINT NOT NULL, name VARCHAR(50), '
+                           'x DOUBLE, y DOUBLE')
+        set_columns = ('name', 'x', 'y')
+    elif object_name == 'function':
+        staging_columns = ('user_id BIGINT NOT NULL, name VARCHAR(50), '
+                           'expression LONGTEXT')
+        set_columns = ('name', 'expression')
+    elif object_name == 'link':
+        staging_columns = ('user_id BIGINT NOT NULL, name VARCHAR(50), '
+                           'origin BIGINT, destination BIGINT, vdf INT, '
+                           'length DOUBLE, lanes DOUBLE, speed DOUBLE, '
+                           'capacity DOUBLE')
+        set_columns = ('name', 'origin', 'destination', 'vdf', 'length',
+                       'lanes', 'speed', 'capacity')
+    if object_name == 'function':
+        table = '`Function`'
+        owner = 'owner_functionset_id'
+    else:
+        table = object_name.capitalize()
+        owner = 'owner_network_id'
+    rows = list(zip(*[df[col].tolist() for col in df.columns]))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE object_staging "
+            "({}, PRIMARY KEY (user_id));".format(staging_columns)
+        )
+        try:
+            chunk_size = 10000
+            for x in range(0, len(rows), chunk_size):
+                cursor.executemany(
+                    "INSERT INTO object_staging VALUES ({});".format(
+                        ', '.join(['%s'] * len(df.columns))),
+                    rows[x:x + chunk_size]
                 )
-            query.model.functionset.through.objects.bulk_create(
-                relations, batch_size=chunk_size
+            cursor.execute(
+                "UPDATE {table} "
+                "JOIN object_staging "
+                "ON {table}.{owner} = %s "
+                "AND {table}.user_id = object_staging.user_id "
+                "SET {columns};".format(
+                    table=table, owner=owner,
+                    columns=', '.join(
+                        '{0}.{1} = object_staging.{1}'.format(table, col)
+                        for col in set_columns
+                    ),
+                ),
+                [parent.id]
             )
-        else:
-            # Pass arguments as dict to avoid more if conditions.
-            object_id = '{}_id'.format(object_name)
-            for new_id in new_ids:
-                relations.append(
-                    query.model.network.through(
-                        **{'network_id': parent.id, object_id: new_id}
-                    )
+        finally:
+            cursor.execute("DROP TEMPORARY TABLE IF EXISTS object_staging;")
+
+
+def read_matrix_file(encoded_file, simulation, column):
+    """Function to read a file representing an OD matrix.
+
+    Parameters
+    ----------
+    encoded_file: File object.
+        Input file, as given by request.FILES.
+    simulation: Simulation object.
+        Simulation of the matrix.
+    column: str.
+        Name of the column with the values of the OD pairs.
+
+    Return a pandas DataFrame with columns p, q (ids of the origin and
+    destination centroids) and r (value of the pair). The rows whose origin
+    or destination is unknown are ignored. If an OD pair is given multiple
+    times, the last value is used.
+    """
+    if encoded_file.name.split(".")[-1] == 'tsv':
+        sep = '\t'
+    else:
+        sep = ','
+    try:
+        data = pd.read_csv(
+            encoded_file, sep=sep, engine='c',
+            usecols=['origin', 'destination', column],
+            dtype={'origin': np.int64, 'destination': np.int64,
+                   column: np.float64},
+        )
+    except pd.errors.EmptyDataError:
+        data = pd.DataFrame(columns=['origin', 'destination', column])
+    # Map the centroid user ids with the centroid ids.
+    centroids = get_query('centroid', simulation)
+    centroid_id_mapping = dict(centroids.values_list('user_id', 'id'))
+    pairs = pd.DataFrame({
+        'p': data['origin'].map(centroid_id_mapping),
+        'q': data['destination'].map(centroid_id_mapping),
+        'r': data[column],
+    })
+    # Unable to find centroid origin or destination.
+    pairs = pairs.dropna(subset=['p', 'q'])
+    pairs = pairs.astype({'p': np.int64, 'q': np.int64})
+    pairs = pairs.drop_duplicates(subset=['p', 'q'], keep='last')
+    return pairs
+
+
+def load_matrix_pairs(matrix, pairs, keep_zeros=False, progress=None):
+    """Function to write OD pairs in a matrix with set-based queries.
+
+    Parameters
+    ----------
+    matrix: Matrices object.
+        Matrix to modify.
+    pairs: DataFrame.
+        OD pairs to write, with columns p, q and r (see read_matrix_file).
+    keep_zeros: bool.
+        If False, the OD pairs with a value of 0 are deleted from the matrix
+        instead of being stored.
+    progress: Function, optional.
+        Function called with the number of OD pairs written in the staging
+        table so far.
+
+    The pairs are inserted in a temporary staging table with multi-row
+    INSERT statements. Then, the zero pairs are deleted with one query
+    joining the staging table and the Matrix table and the other pairs are
+    inserted or updated with one query (using the unique key of the OD
+    pairs).
+    The unique key must exist: without it, the existing pairs are not updated
+    but inserted again. The key is created once the duplicate pairs have been
+    removed by the remove_duplicate_pairs command (see run.sh).
+    """
+    rows = list(zip(pairs['p'].tolist(), pairs['q'].tolist(),
+                    pairs['r'].tolist()))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE matrix_staging "
+            "(p BIGINT NOT NULL, q BIGINT NOT NULL, r DOUBLE NOT NULL, "
+            "PRIMARY KEY (p, q));"
+        )
+        try:
+            # The chunk size is limited by the MySQL engine (the multi-row
+            # INSERT must not be larger than max_allowed_packet).
+            chunk_size = 20000
+            for x in range(0, len(rows), chunk_size):
+                cursor.executemany(
+                    "INSERT INTO matrix_staging (p, q, r) "
+                    "VALUES (%s, %s, %s);",
+                    rows[x:x + chunk_size]
+                )
+                if progress is not None:
+                    progress(min(x + chunk_size, len(rows)))
+            if not keep_zeros:
+                # Delete the existing pairs with a new value of 0.
+                cursor.execute(
+                    "DELETE Matrix "
+                    "FROM Matrix JOIN matrix_staging "
+                    "ON Matrix.p = matrix_staging.p "
+                    "AND Matrix.q = matrix_staging.q "
+                    "WHERE Matrix.matrices_id = %s "
+                    "AND matrix_staging.r = 0;",
+                    [matrix.id]
                 )
-            query.model.network.through.objects.bulk_create(
-                relations, batch_size=chunk_size
+                cursor.execute(
+                    "DELETE FROM matrix_staging WHERE r = 0;"
+                )
+            # Insert the new pairs and update the existing pairs (the rows
+            # whose value has not changed are not written).
+            cursor.execute(
+                "INSERT INTO Matrix (p, q, r, matrices_id) "
+                "SELECT matrix_staging.p, matrix_staging.q, "
+                "matrix_staging.r, %s "
+                "FROM matrix_staging "
+                "ON DUPLICATE KEY UPDATE r = matrix_staging.r;",
+                [matrix.id]
             )
-    simulation.has_changed = True
-    simulation.save()
+        finally:
+            cursor.execute("DROP TEMPORARY TABLE IF EXISTS matrix_staging;")
 
 
-def matrix_import_function(encoded_file, simulation, demandsegment):
+def save_matrix_changes(simulation, matrix, changes, keep_zeros=False):
+    """Function to write the OD pairs modified in the edit page of an OD
+    matrix.
+
+    Parameters
+    ----------
+    simulation: Simulation object.
+        Simulation of the matrix.
+    matrix: Matrices object.
+        Matrix to modify (OD matrix of a demand segment or public-transit
+        travel times).
+    changes: list.
+        List of tuples (origin id, destination id, value), see
+        MatrixChangesForm.
+    keep_zeros: bool.
+        If False, the pairs with a value of 0 are deleted from the matrix
+        instead of being stored (a travel time of 0 is a valid value for the
+        public-transit matrix).
+
+    Only the modified pairs are written, with a single upsert (see
+    load_matrix_pairs). The pairs whose origin or destination is not a
+    centroid of the simulation are ignored.
+    """
+    pairs = pd.DataFrame(changes, columns=['p', 'q', 'r'])
+    centroids = get_query('centroid', simulation)
+    centroid_ids = list(centroids.values_list('id', flat=True))
+    pairs = pairs[pairs['p'].isin(centroid_ids)
+                  & pairs['q'].isin(centroid_ids)
+                  & (pairs['p'] != pairs['q'])]
+    pairs = pairs.drop_duplicates(subset=['p', 'q'], keep='last')
+    if pairs.empty:
+        return
+    with transaction.atomic():
+        load_matrix_pairs(matrix, pairs, keep_zeros=keep_zeros)
+
+
+def matrix_import_function(encoded_file, simulation, demandsegment,
+                           progress=None):
     """Function to import a file representing the OD matrix of a usertype.
 
     Parameters
@@ -667,108 +1895,23 @@ def matrix_import_function(encoded_file, simulation, demandsegment):
         Simulation to modify.
     demandsegment: DemandSegment object.
         Demand segment for which the OD matrix must be modified.
+    progress: Function, optional.
+        Function called with the number of OD pairs processed so far.
 
-    This function could be much more simple but I tried to use as little as
-    possible Django ORM (the querysets). When written with standard Django
-    querysets and save methods, it took hours to import a large OD matrix.
-    Basicaly, this view looks at each row in the imported file to know if the
-    OD pair of the row already exists or needs to be created. If it already
-    exists, the view looks at the population value to know if the value needs
-    to be updated. To update values, we simply delete the previous entries in
-    the database and insert the new ones.
+    The file is parsed with pandas and written in the database with a
+    staging table (see load_matrix_pairs) so that no Django object is created
+    for the OD pairs. OD pairs with a population of 0 are removed from the
+    matrix.
     """
-    tsv_file = StringIO(encoded_file.read().decode())
+    pairs = read_matrix_file(encoded_file, simulation, 'population')
     # Do not do anything if the file is empty.
-    num_lines = sum(1 for row in tsv_file)
-    if num_lines <= 1:
+    if pairs.empty:
         return
-    tsv_file.seek(0)
-    # Convert the imported file to a csv DictReader.
-    if encoded_file.name.split(".")[-1] == 'tsv':
-        reader = csv.DictReader(tsv_file, delimiter='\t')
-    else:
-        reader = csv.DictReader(tsv_file, delimiter=',')
-    # Create a set with all existing OD pairs in the OD matrix.
     matrix = demandsegment.matrix
-    pairs = models.Matrix.objects.filter(matrices=matrix)
-    existing_pairs = set(pairs.values_list('p_id', 'q_id'))
-    # Create a dictionary to map the centroid user ids with the centroid
-    # objects.
-    centroids = get_query('centroid', simulation)
-    centroid_mapping = dict()
-    centroid_id_mapping = dict()
-    for centroid in centroids:
-        centroid_mapping[centroid.user_id] = centroid
-        centroid_id_mapping[centroid.user_id] = centroid.id
-    # For each imported OD pair, if the pair already exists in t
-    # For each imported OD pair, if the pair already exists in the OD Matrix,
-    # it is stored to be updated, else it is stored to be created.
-    to_be_updated = set()
-    to_be_created = list()
-    for row in reader:
-        try:
-            pair = (
-                centroid_id_mapping[int(row['origin'])],
-                centroid_id_mapping[int(row['destination'])]
-            )
-        except KeyError:
-            # Unable to find centroid origin or destination.
-            continue
-        if pair in existing_pairs:
-            to_be_updated.add((*pair, float(row['population'])))
-        elif float(row['population']) > 0:
-            to_be_created.append(
-                models.Matrix(
-                    p=centroid_mapping[int(row['origin'])],
-                    q=centroid_mapping[int(row['destination'])],
-                    r=float(row['population']), matrices=matrix,
-                )
-            )
-    if to_be_updated:
-        # Create a mapping between the values (p, q, r) and the ids.
-        pair_values = set(pairs.values_list('id', 'p_id', 'q_id'))
-        pair_mapping = dict()
-        for pair in pair_values:
-            pair_mapping[pair[1:]] = pair[0]
-        pair_values = set(pairs.values_list('id', 'p_id', 'q_id', 'r'))
-        # Find the pairs that really need to be updated (i.e. r is also
-        # different).
-        pair_values = set(pairs.values_list('p_id', 'q_id', 'r'))
-        to_be_updated = to_be_updated.difference(pair_values)
-        # Retrieve the ids of the pairs to be updated with the mapping and
-        # delete them.
-        to_be_updated_ids = [pair_mapping[pair[:2]] for pair in to_be_updated]
-        with connection.cursor() as cursor:
-            chunk_size = 20000
-            chunks = [to_be_updated_ids[x:x + chunk_size]
-                      for x in range(0, len(to_be_updated_ids), chunk_size)]
-            for chunk in chunks:
-                cursor.execute(
-                    "DELETE FROM Matrix "
-                    "WHERE id IN %s;",
-                    [chunk]
-                )
-        # Create a mapping between the centroids ids and the centroid objects.
-        centroid_id_mapping = dict()
-        for centroid in centroids:
-            centroid_id_mapping[centroid.id] = centroid
-        # Now, create the updated pairs with the new values.
-        to_be_created += [
-            models.Matrix(
-                p=centroid_id_mapping[pair[0]], q=centroid_id_mapping[pair[1]],
-                r=pair[2], matrices=matrix,
-            )
-            for pair in to_be_updated
-        ]
-    # Create the new OD pairs in bulk.
-    # The chunk size is limited by the MySQL engine (timeout if it is too big).
-    chunk_size = 20000
-    chunks = [to_be_created[x:x + chunk_size]
-              for x in range(0, len(to_be_created), chunk_size)]
-    for chunk in chunks:
-        models.Matrix.objects.bulk_create(chunk, chunk_size)
+    with transaction.atomic():
+        load_matrix_pairs(matrix, pairs, progress=progress)
     # Update total.
-    pairs = pairs.all()  # Update queryset from database.
+    pairs = models.Matrix.objects.filter(matrices=matrix)
     if pairs.exists():
         matrix.total = int(
             demandsegment.scale * pairs.aggregate(Sum('r'))['r__sum']
@@ -776,8 +1919,7 @@ def matrix_import_function(encoded_file, simulation, demandsegment):
     else:
         matrix.total = 0
     matrix.save()
-    simulation.has_changed = True
-    simulation.save()
+    simulation_changed(simulation, 'demand')
 
 
 def pricing_import_function(encoded_file, simulation):
@@ -892,7 +2034,7 @@ def pricing_import_function(encoded_file, simulation):
         toll.save()
 
 
-def public_transit_import_function(encoded_file, simulation):
+def public_transit_import_function(encoded_file, simulation, progress=None):
     """Function to import a file as a public transit matrix in the database.
 
     Parameters
@@ -901,91 +2043,16 @@ def public_transit_import_function(encoded_file, simulation):
         Input file, as given by request.FILES.
     simulation: Simulation object.
         Simulation to modify.
+    progress: Function, optional.
+        Function called with the number of OD pairs processed so far.
     """
-    tsv_file = StringIO(encoded_file.read().decode())
+    pairs = read_matrix_file(encoded_file, simulation, 'travel time')
     # Do not do anything if the file is empty.
-    num_lines = sum(1 for row in tsv_file)
-    if num_lines <= 1:
+    if pairs.empty:
         return
-    tsv_file.seek(0)
-    # Convert the imported file to a csv DictReader.
-    if encoded_file.name.split(".")[-1] == 'tsv':
-        reader = csv.DictReader(tsv_file, delimiter='\t')
-    else:
-        reader = csv.DictReader(tsv_file, delimiter=',')
-    # Create a set with all existing OD pairs in the OD matrix.
     matrix = simulation.scenario.supply.pttimes
-    pairs = get_query('public_transit', simulation)
-    existing_pairs = set(pairs.values_list('p_id', 'q_id'))
-    # Create a dictionary to map the centroid user ids with the centroid
-    # objects.
-    centroids = get_query('centroid', simulation)
-    centroid_mapping = dict()
-    centroid_id_mapping = dict()
-    for centroid in centroids:
-        centroid_mapping[centroid.user_id] = centroid
-        centroid_id_mapping[centroid.user_id] = centroid.id
-    # For each imported OD pair, if the pair already exists in the OD Matrix,
-    # it is stored to be updated, else it is stored to be created.
-    to_be_updated = set()
-    to_be_created = list()
-    for row in reader:
-        pair = (
-            centroid_id_mapping[int(row['origin'])],
-            centroid_id_mapping[int(row['destination'])]
-        )
-        if pair in existing_pairs:
-            to_be_updated.add((*pair, float(row['travel time'])))
-        else:
-            to_be_created.append(
-                models.Matrix(
-                    p=centroid_mapping[int(row['origin'])],
-                    q=centroid_mapping[int(row['destination'])],
-                    r=float(row['travel time']), matrices=matrix,
-                )
-            )
-    if to_be_updated:
-        # Create a mapping between the values (p, q, r) and the ids.
-        pair_values = set(pairs.values_list('id', 'p_id', 'q_id'))
-        pair_mapping = dict()
-        for pair in pair_values:
-            pair_mapping[pair[1:]] = pair[0]
-        # Find the pairs that really need to be updated (i.e. r is also
-        # different).
-        pair_values = set(pairs.values_list('p_id', 'q_id', 'r'))
-        to_be_updated = to_be_updated.difference(pair_values)
-        # Retrieve the ids of the pairs to be updated with the mapping and
-        # delete them.
-        to_be_updated_ids = [pair_mapping[pair[:2]] for pair in to_be_updated]
-        with connection.cursor() as cursor:
-            chunk_size = 20000
-            chunks = [to_be_updated_ids[x:x + chunk_size]
-                      for x in range(0, len(to_be_updated_ids), chunk_size)]
-            for chunk in chunks:
-                cursor.execute(
-                    "DELETE FROM Matrix "
-                    "WHERE id IN %s;",
-                    [chunk]
-                )
-        # Create a mapping between the centroids ids and the centroid objects.
-        centroid_id_mapping = dict()
-        for centroid in centroids:
-            centroid_id_mapping[centroid.id] = centroid
-        # Now, create the updated pairs with the new values.
-        to_be_created += [
-            models.Matrix(
-                p=centroid_id_mapping[pair[0]], q=centroid_id_mapping[pair[1]],
-                r=pair[2], matrices=matrix,
-            )
-            for pair in to_be_updated
-        ]
-    # Create the new OD pairs in bulk.
-    # The chunk size is limited by the MySQL engine (timeout if it is too big).
-    chunk_size = 20000
-    chunks = [to_be_created[x:x + chunk_size]
-              for x in range(0, len(to_be_created), chunk_size)]
-    for chunk in chunks:
-        models.Matrix.objects.bulk_create(chunk, chunk_size)
+    with transaction.atomic():
+        load_matrix_pairs(matrix, pairs, keep_zeros=True, progress=progress)
 
 
 def usertype_import_function(encoded_file, simulation):
@@ -1138,6 +2205,7 @@ def usertype_import_function(encoded_file, simulation):
             demandsegment = models.DemandSegment()
             demandsegment.usertype = usertype
             demandsegment.matrix = matrix
+            demandsegment.owner_demand = simulation.scenario.demand
             demandsegment.save()
             demandsegment.demand.add(simulation.scenario.demand)
         else:
@@ -1155,6 +2223,36 @@ def usertype_import_function(encoded_file, simulation):
 ######################
 
 
+def get_dense_matrix(matrix_points, centroids):
+    """Return the O-D pairs of a matrix as a list of rows (used to display
+    the matrix as a grid).
+
+    Each row is a tuple with the origin centroid and the list of the values of
+    the O-D pairs for each destination centroid (0 for the missing pairs and
+    -1 for the pairs with identical origin and destination).
+    The pairs are fetched with a single query and scattered into a dense
+    numpy array.
+    """
+    centroids = list(centroids)
+    ids = np.array([centroid.id for centroid in centroids], dtype=np.int64)
+    order = np.argsort(ids)
+    sorted_ids = ids[order]
+    values = np.zeros((len(ids), len(ids)))
+    pairs = np.array(list(matrix_points.values_list('p_id', 'q_id', 'r')),
+                     dtype=np.float64).reshape(-1, 3)
+    if len(pairs) and len(ids):
+        p = pairs[:, 0].astype(np.int64)
+        q = pairs[:, 1].astype(np.int64)
+        # Find the index of the origin and of the destination of each pair
+        # (the pairs with an unknown centroid are ignored).
+        p_pos = np.minimum(np.searchsorted(sorted_ids, p), len(ids) - 1)
+        q_pos = np.minimum(np.searchsorted(sorted_ids, q), len(ids) - 1)
+        known = (sorted_ids[p_pos] == p) & (sorted_ids[q_pos] == q)
+        values[order[p_pos[known]], order[q_pos[known]]] = pairs[known, 2]
+    np.fill_diagonal(values, -1)
+    return list(zip(centroids, values.tolist()))
+
+
 def matrix_export_function(simulation, demandsegment, dir_name):
     """Function to save the OD matrix as a tsv file."""
     matrix = demandsegment.matrix
@@ -0,0 +1,161 @@
+"""Script run in the background to import the files uploaded by the users.
+
+The script imports, one after the other, all the queued ImportJob of the
+simulation given as argument.
+"""
+
+import os
+import sys
+import threading
+import django
+from django.utils import timezone
+
+# Load the django website.
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_ROOT)
+os.environ.setdefault(
+    "DJANGO_SETTINGS_MODULE", "metropolis_web_interface.settings")
+django.setup()
+
+from django.db import connection
+
+from metro_app import models, functions
+
+
+def claim_next_job(simulation_id):
+    """Return the oldest queued ImportJob of the simulation and mark it as
+    running (or return None if there is no queued job).
+
+    The status is changed with a conditional update so that a job is never
+    imported by two scripts.
+    """
+    jobs = models.ImportJob.objects.filter(
+        simulation_id=simulation_id, status='Queued'
+    ).order_by('id')
+    for job in jobs:
+        claimed = models.ImportJob.objects.filter(
+            pk=job.id, status='Queued'
+        ).update(status='Running', start_time=timezone.now(),
+                 heartbeat=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def save_progress(job_id, rows):
+    """Save the number of rows processed by an ImportJob."""
+    models.ImportJob.objects.filter(pk=job_id).update(rows_processed=rows)
+    connection.close()
+
+
+def heartbeat(job_id, stop):
+    """Update the heartbeat of a running ImportJob every IMPORT_HEARTBEAT
+    seconds, until stop is set (see functions.run_import)."""
+    while not stop.wait(functions.IMPORT_HEARTBEAT):
+        models.ImportJob.objects.filter(pk=job_id).update(
+            heartbeat=timezone.now())
+    connection.close()
+
+
+def import_job(job):
+    """Import the file of an ImportJob in its simulation (or copy the source
+    simulation for the jobs of kind 'copy')."""
+    simulation = job.simulation
+
+    def progress(rows):
+        # The imports and the copies run in transactions so the progress is
+        # saved from another thread (i.e. with another database connection)
+        # to be visible before the end of the transaction.
+        thread = threading.Thread(target=save_progress, args=(job.id, rows))
+        thread.start()
+        thread.join()
+
+    # The simulations sharing the supply or the demand of the simulation must
+    # not be modified by the import.
+    if job.kind in ('centroid', 'crossing', 'link', 'function',
+                    'public_transit', 'simulation'):
+        functions.detach(simulation, 'supply')
+    if job.kind in ('matrix', 'usertype', 'traveler', 'simulation'):
+        functions.detach(simulation, 'demand')
+    if job.kind == 'copy':
+        job.rows_total = functions.count_copy_rows(job.source)
+        job.save(update_fields=['rows_total'])
+        functions.copy_simulation(job.source, simulation, progress=progress)
+        return
+    f = job.import_file
+    f.open('rb')
+    try:
+        job.rows_total = functions.count_file_rows(f)
+        job.save(update_fields=['rows_total'])
+        if job.kind in ('centroid', 'crossing', 'link', 'function'):
+            functions.object_import_function(
+                f, simulation, job.kind, progress=progress)
+        elif job.kind == 'matrix':
+            functions.matrix_import_function(
+                f, simulation, job.demandsegment, progress=progress)
+        elif job.kind == 'public_transit':
+            functions.public_transit_import_function(
+                f, simulation, progress=progress)
+        elif job.kind == 'pricing':
+            functions.pricing_import_function(f, simulation)
+        elif job.kind == 'usertype':
+            functions.usertype_import_function(f, simulation)
+        elif job.kind == 'traveler':
+            functions.traveler_zip_file(simulation, f, progress=progress)
+        elif job.kind == 'simulation':
+            functions.simulation_import(simulation, f, progress=progress)
+        else:
+            raise ValueError('Unknown import kind: {}'.format(job.kind))
+    finally:
+        f.close()
+
+
+print('Starting script...')
+
+# Read argument of the script call.
+try:
+    simulation_id = int(sys.argv[1])
+except IndexError:
+    raise SystemExit('MetroArgError: This script must be executed with the id '
+                     + 'of the simulation has an argument.')
+
+job = claim_next_job(simulation_id)
+while job is not None:
+    if job.kind == 'copy':
+        print('Copying simulation {}'.format(job.source_id))
+    else:
+        print('Importing file {} ({})'.format(job.import_file.name,
+                                              job.kind))
+    fields = ['status', 'end_time']
+    # The heartbeat is updated from another thread (i.e. with another
+    # database connection) to be visible during the transactions of the
+    # import.
+    stop = threading.Event()
+    thread = threading.Thread(target=heartbeat, args=(job.id, stop))
+    thread.start()
+    try:
+        import_job(job)
+    except Exception as e:
+        print('Exception when importing file: {}'.format(e))
+        job.status = 'Failed'
+    else:
+        print('Import finished')
+        job.status = 'Over'
+        job.rows_processed = job.rows_total
+        fields.append('rows_processed')
+    finally:
+        stop.set()
+        thread.join()
+    job.end_time = timezone.now()
+    job.save(update_fields=fields)
+    # Compute the counts of the simulation view now rather than when the page
+    # is loaded.
+    functions.invalidate_stats(job.simulation)
+    functions.get_simulation_stats(job.simulation)
+    # The file is not needed anymore.
+    if job.import_file:
+        job.import_file.delete(save=False)
+    job = claim_next_job(simulation_id)
+
+print('No more file to import')
@@ -0,0 +1,41 @@
+"""Command setting the owner keys of the objects created before the keys were
+added (see functions.get_query).
+
+The owner keys are read from the many-to-many tables. Only the objects
+without owner key are updated so the command can be run at each start of the
+website (see run.sh).
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+# Table, owner key, many-to-many table, column of the owner and column of the
+# object in the many-to-many table.
+OWNER_KEYS = (
+    ('Centroid', 'owner_network_id', 'Network_Centroid', 'network_id',
+     'centroid_id'),
+    ('Crossing', 'owner_network_id', 'Network_Crossing', 'network_id',
+     'crossing_id'),
+    ('Link', 'owner_network_id', 'Network_Link', 'network_id', 'link_id'),
+    ('`Function`', 'owner_functionset_id', 'FunctionSet_Function',
+     'functionset_id', 'function_id'),
+    ('DemandSegment', 'owner_demand_id', 'Demand_DemandSegment', 'demand_id',
+     'demandsegment_id'),
+)
+
+
+class Command(BaseCommand):
+    help = 'Set the owner keys of the objects from the many-to-many tables.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connection.cursor() as cursor:
+            for table, owner, relation, parent, child in OWNER_KEYS:
+                cursor.execute(
+                    "UPDATE {0} "
+                    "JOIN {2} ON {2}.{4} = {0}.id "
+                    "SET {0}.{1} = {2}.{3} "
+                    "WHERE {0}.{1} IS NULL;".format(
+                        table, owner, relation, parent, child)
+                )
+                self.stdout.write('{}: {} rows updated'.format(
+                    table.strip('`'), cursor.rowcount))
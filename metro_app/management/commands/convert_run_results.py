@@ -0,0 +1,30 @@
+"""Command converting the network results of the runs built before the
+results were stored as binary numpy files (see functions.convert_run_results).
+
+Only the runs without converted results are read so the command can be run
+at each start of the website (see run.sh).
+"""
+
+from django.core.management.base import BaseCommand
+
+from metro_app import functions, models, plots
+
+
+class Command(BaseCommand):
+    help = 'Convert the network results of the old runs.'
+
+    def handle(self, *args, **options):
+        runs = models.SimulationRun.objects.filter(
+            status='Over').select_related('simulation')
+        nb_converted = 0
+        for run in runs.iterator():
+            if functions.has_run_results(run):
+                continue
+            try:
+                converted = functions.convert_run_results(
+                    run, 'congestion', plots.PALETTE_SIZE)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.stderr.write('Run {}: {}'.format(run.id, e))
+                continue
+            nb_converted += converted
+        self.stdout.write('{} runs converted'.format(nb_converted))
@@ -0,0 +1,36 @@
+"""Command removing the duplicate OD pairs of the matrices before the unique
+key of the OD pairs is created (see models.Matrix).
+
+The last pair inserted is kept. Nothing is done if the Matrix table does not
+exist yet or if it already has the unique key so the command can be run at
+each start of the website, before the migrations (see run.sh).
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+CONSTRAINT_NAME = 'Matrix_pair_unique'
+
+
+class Command(BaseCommand):
+    help = 'Remove the duplicate OD pairs of the matrices.'
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            tables = connection.introspection.table_names(cursor)
+            if 'Matrix' not in tables:
+                return
+            constraints = connection.introspection.get_constraints(
+                cursor, 'Matrix')
+            if CONSTRAINT_NAME in constraints:
+                return
+            cursor.execute(
+                "DELETE m1 "
+                "FROM Matrix m1 JOIN Matrix m2 "
+                "ON m1.matrices_id = m2.matrices_id "
+                "AND m1.p = m2.p "
+                "AND m1.q = m2.q "
+                "AND m1.id < m2.id;"
+            )
+            self.stdout.write('{} duplicate OD pairs removed'.format(
+                cursor.rowcount))
@@ -55,10 +55,25 @@ class Function(models.Model):
         help_text='Expression of the congestion function'
     )
     user_id = models.IntegerField(default=0, verbose_name='Id')
+    # Tag of the bulk insert which created the object and id of the copied
+    # object (see functions.new_batch_tag). Both are reset once the relations
+    # of the new objects are created.
+    batch_tag = models.BigIntegerField(blank=True, null=True)
+    copy_of = models.BigIntegerField(blank=True, null=True)
     functionset = models.ManyToManyField(
         FunctionSet,
         db_table='FunctionSet_Function'
     )
+    # Owner of the object (also stored in the many-to-many relation) so that
+    # the objects of a simulation are selected without joining the relation
+    # table (see functions.get_query).
+    owner_functionset = models.ForeignKey(
+        FunctionSet,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='+',
+    )
 
     def __str__(self):
         if self.name:
@@ -68,6 +83,12 @@ class Function(models.Model):
 
     class Meta:
         db_table = 'Function'
+        indexes = [
+            models.Index(fields=['batch_tag', 'copy_of']),
+            # Objects of a simulation selected by user id (imports).
+            models.Index(fields=['owner_functionset', 'user_id'],
+                         name='Function_owner_user_idx'),
+        ]
 
 
 class Supply(models.Model):
@@ -343,6 +364,16 @@ class DemandSegment(models.Model):
     )
     scale = models.FloatField(default=1)
     demand = models.ManyToManyField(Demand, db_table='Demand_DemandSegment')
+    # Owner of the object (also stored in the many-to-many relation) so that
+    # the objects of a simulation are selected without joining the relation
+    # table (see functions.get_query).
+    owner_demand = models.ForeignKey(
+        Demand,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='+',
+    )
 
     def __str__(self):
         return str(self.id)
@@ -381,7 +412,22 @@ class Centroid(models.Model):
     uz2 = models.FloatField(default=0)
     uz3 = models.FloatField(default=0)
     user_id = models.IntegerField(default=0, verbose_name='Id')
+    # Tag of the bulk insert which created the object and id of the copied
+    # object (see functions.new_batch_tag). Both are reset once the relations
+    # of the new objects are created.
+    batch_tag = models.BigIntegerField(blank=True, null=True)
+    copy_of = models.BigIntegerField(blank=True, null=True)
     network = models.ManyToManyField(Network, db_table='Network_Centroid')
+    # Owner of the object (also stored in the many-to-many relation) so that
+    # the objects of a simulation are selected without joining the relation
+    # table (see functions.get_query).
+    owner_network = models.ForeignKey(
+        Network,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='+',
+    )
 
     def __str__(self):
         if self.name and self.name != 'NULL':
@@ -392,6 +438,12 @@ class Centroid(models.Model):
 
     class Meta:
         db_table = 'Centroid'
+        indexes = [
+            models.Index(fields=['batch_tag', 'copy_of']),
+            # Objects of a simulation selected by user id (imports).
+            models.Index(fields=['owner_network', 'user_id'],
+                         name='Centroid_owner_user_idx'),
+        ]
 
 
 class CentroidSelection(models.Model):
@@ -424,7 +476,22 @@ class Crossing(models.Model):
     un2 = models.FloatField(default=0)
     un3 = models.FloatField(default=0)
     user_id = models.IntegerField(default=0, verbose_name='Id')
+    # Tag of the bulk insert which created the object and id of the copied
+    # object (see functions.new_batch_tag). Both are reset once the relations
+    # of the new objects are created.
+    batch_tag = models.BigIntegerField(blank=True, null=True)
+    copy_of = models.BigIntegerField(blank=True, null=True)
     network = models.ManyToManyField(Network, db_table='Network_Crossing')
+    # Owner of the object (also stored in the many-to-many relation) so that
+    # the objects of a simulation are selected without joining the relation
+    # table (see functions.get_query).
+    owner_network = models.ForeignKey(
+        Network,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='+',
+    )
 
     def __str__(self):
         if self.name and self.name != 'NULL':
@@ -435,6 +502,12 @@ class Crossing(models.Model):
 
     class Meta:
         db_table = 'Crossing'
+        indexes = [
+            models.Index(fields=['batch_tag', 'copy_of']),
+            # Objects of a simulation selected by user id (imports).
+            models.Index(fields=['owner_network', 'user_id'],
+                         name='Crossing_owner_user_idx'),
+        ]
 
 
 class CrossingSelection(models.Model):
@@ -508,13 +581,38 @@ class Link(models.Model):
     dynFlo = models.FloatField(default=0)
     staVol = models.FloatField(default=0)
     network = models.ManyToManyField(Network, db_table='Network_Link')
+    # Owner of the object (also stored in the many-to-many relation) so that
+    # the objects of a simulation are selected without joining the relation
+    # table (see functions.get_query).
+    owner_network = models.ForeignKey(
+        Network,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name='+',
+    )
     user_id = models.IntegerField(default=0, verbose_name='Id')
+    # Tag of the bulk insert which created the object and id of the copied
+    # object (see functions.new_batch_tag). Both are reset once the relations
+    # of the new objects are created.
+    batch_tag = models.BigIntegerField(blank=True, null=True)
+    copy_of = models.BigIntegerField(blank=True, null=True)
 
     def __str__(self):
         return self.name
 
     class Meta:
         db_table = 'Link'
+        indexes = [
+            models.Index(fields=['batch_tag', 'copy_of']),
+            # Objects of a simulation selected by user id (imports).
+            models.Index(fields=['owner_network', 'user_id'],
+                         name='Link_owner_user_idx'),
+            # Links deleted with their origin or destination node.
+            models.Index(fields=['origin'], name='Link_origin_idx'),
+            models.Index(fields=['destination'],
+                         name='Link_destination_idx'),
+        ]
 
 
 class LinkSelection(models.Model):
@@ -529,6 +627,11 @@ class LinkSelection(models.Model):
     definition = models.TextField(blank=True, null=True)
     link = models.ManyToManyField(Link, db_table='LinkSelection_Link')
     user_id = models.IntegerField(default=0, verbose_name='Link id')
+    # Tag of the bulk insert which created the object and id of the copied
+    # object (see functions.new_batch_tag). Both are reset once the relations
+    # of the new objects are created.
+    batch_tag = models.BigIntegerField(blank=True, null=True)
+    copy_of = models.BigIntegerField(blank=True, null=True)
 
     def __str__(self):
         if self.name:
@@ -538,6 +641,7 @@ class LinkSelection(models.Model):
 
     class Meta:
         db_table = 'LinkSelection'
+        indexes = [models.Index(fields=['batch_tag', 'copy_of'])]
 
 
 class Path(models.Model):
@@ -793,7 +897,10 @@ class Simulation(models.Model):
     environment = models.ForeignKey('Environment', blank=True, null=True,
                                     on_delete=models.CASCADE)
     has_changed = models.BooleanField(default=True)
-    locked = models.BooleanField(default=False)
+    # Incremented when the demand or the centroids of the simulation change,
+    # used as version of the cached zone demand profile (see
+    # functions.get_zone_demand_profile).
+    demand_version = models.IntegerField(default=0)
     pinned = models.BooleanField(default=False)
     random_seed = models.IntegerField(
         default=0,
@@ -807,6 +914,13 @@ class Simulation(models.Model):
         ),
     )
 
+    # Batch for which the simulation was created, as a copy of the simulation
+    # of the batch (see batch_run.py). These simulations are hidden in the
+    # simulation manager and they are deleted with the batch.
+    parent_batch = models.ForeignKey('Batch', on_delete=models.SET_NULL,
+                                     blank=True, null=True,
+                                     related_name='copies')
+
     def __str__(self):
         return self.name
 
@@ -866,6 +980,11 @@ class Policy(models.Model):
     dayStart = models.IntegerField(default=0, blank=True, null=True)
     dayEnd = models.IntegerField(default=0, blank=True, null=True)
     scenario = models.ManyToManyField(Scenario, db_table='Scenario_Policy')
+    # Tag of the bulk insert which created the object (see
+    # functions.new_batch_tag). It is reset once the relations of the new
+    # objects are created (the policies are not referred to by other copied
+    # objects so the id of the copied object is not needed).
+    batch_tag = models.BigIntegerField(blank=True, null=True)
 
     def get_value_vector(self):
         values = self.valueVector.data
@@ -885,6 +1004,7 @@ class Policy(models.Model):
 
     class Meta:
         db_table = 'Policy'
+        indexes = [models.Index(fields=['batch_tag'])]
 
 
 class Region(models.Model):
@@ -939,6 +1059,16 @@ class Matrix(models.Model):
 
     class Meta:
         db_table = 'Matrix'
+        # An OD pair appears once in a matrix (the matrix imports insert or
+        # update the pairs with this key, see functions.load_matrix_pairs).
+        constraints = [
+            models.UniqueConstraint(fields=['matrices', 'p', 'q'],
+                                    name='Matrix_pair_unique'),
+        ]
+        # Arrivals at each centroid of a matrix (the departures use the
+        # unique key).
+        indexes = [models.Index(fields=['matrices', 'q'],
+                                name='Matrix_matrices_q_idx')]
 
 
 class Vector(models.Model):
@@ -1071,11 +1201,98 @@ class SimulationRun(models.Model):
     link_output = models.BooleanField(default=False)
     user_output = models.BooleanField(default=False)
     user_path = models.BooleanField(default=False)
+    # Estimated memory used by Metrosim for the run (in MB), used by the run
+    # dispatcher to decide if the run can be started.
+    memory = models.IntegerField(blank=True, null=True)
 
     class Meta:
         db_table = 'SimulationRun'
 
 
+class RunPhase(models.Model):
+    # Resources used by one phase of a SimulationRun ('prepare', 'metrosim' or
+    # 'build'), recorded by the run dispatcher.
+    # The times are in seconds, the peak resident memory (max_rss) is in kB.
+    run = models.ForeignKey(SimulationRun, on_delete=models.CASCADE)
+    name = models.CharField(max_length=20)
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField(blank=True, null=True)
+    wall_time = models.FloatField(blank=True, null=True)
+    cpu_time = models.FloatField(blank=True, null=True)
+    max_rss = models.BigIntegerField(blank=True, null=True)
+    read_bytes = models.BigIntegerField(blank=True, null=True)
+    write_bytes = models.BigIntegerField(blank=True, null=True)
+    exit_code = models.IntegerField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'RunPhase'
+
+
+class SimulationStats(models.Model):
+    # Number of objects of a simulation, displayed in the simulation view.
+    # The row is marked as stale when the supply or the demand of the
+    # simulation changes and it is computed again when it is read (see
+    # functions.get_simulation_stats).
+    simulation = models.OneToOneField(Simulation, on_delete=models.CASCADE,
+                                      primary_key=True)
+    centroids = models.IntegerField(default=0)
+    crossings = models.IntegerField(default=0)
+    links = models.IntegerField(default=0)
+    functions = models.IntegerField(default=0)
+    usertypes = models.IntegerField(default=0)
+    travelers = models.BigIntegerField(default=0)
+    # True if the simulation has public-transit travel times.
+    public_transit = models.BooleanField(default=False)
+    # True if modal choice is enabled for one of the user types.
+    mode_choice = models.BooleanField(default=False)
+    stale = models.BooleanField(default=True)
+
+    class Meta:
+        db_table = 'SimulationStats'
+
+
+class NetworkChange(models.Model):
+    # Object of the network of a simulation which changed since the last
+    # generation of the network output file. With object_name 'all', the
+    # network output file must be generated again.
+    simulation = models.ForeignKey(Simulation, on_delete=models.CASCADE)
+    object_name = models.CharField(max_length=20)
+    object_id = models.BigIntegerField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'NetworkChange'
+
+
+class ImportJob(models.Model):
+    # Import file waiting to be imported (or being imported) in a simulation
+    # by the script import_run.py.
+    # The kind is the object name for centroids, crossings, links and
+    # functions and 'matrix', 'pricing', 'public_transit', 'usertype',
+    # 'traveler' or 'simulation' for the other imports.
+    # With kind 'copy', the job copies the source simulation in the
+    # simulation (there is no import file).
+    simulation = models.ForeignKey(Simulation, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=20)
+    demandsegment = models.ForeignKey(DemandSegment, on_delete=models.CASCADE,
+                                      blank=True, null=True)
+    source = models.ForeignKey(Simulation, on_delete=models.CASCADE,
+                               related_name='+', blank=True, null=True)
+    import_file = models.FileField(upload_to='import_files', blank=True,
+                                   null=True)
+    status = models.CharField(max_length=25, default='Queued')
+    rows_total = models.IntegerField(default=0)
+    rows_processed = models.IntegerField(default=0)
+    creation_time = models.DateTimeField(auto_now_add=True)
+    start_time = models.DateTimeField(blank=True, null=True)
+    end_time = models.DateTimeField(blank=True, null=True)
+    # Last time the script importing the job showed that it is alive (see
+    # functions.run_import).
+    heartbeat = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'ImportJob'
+
+
 class Event(models.Model):
     title = models.CharField(max_length=300, blank=False, null=False,
                              default='', db_column='name')
@@ -1181,6 +1398,8 @@ class BatchRun(models.Model):
         upload_to='import_files', blank=True, null=True)
     failed = models.BooleanField(default=False)
     canceled = models.BooleanField(default=False)
+    # Status of the batch run before the start of its SimulationRun.
+    status = models.CharField(max_length=50, default='Not started')
     batch = models.ForeignKey(Batch, on_delete=models.CASCADE)
     run = models.ForeignKey(SimulationRun, on_delete=models.CASCADE,
                             blank=True, null=True)
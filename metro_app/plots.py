@@ -1,52 +1,77 @@
 import os
+import json
 
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.colors import LinearSegmentedColormap
 
-from django.db.models import Sum
+from django.conf import settings
+from django.db.models import Q
 
-from metro_app import models
+from metro_app import functions, models
 
 # Set matplotlib config directory.
 mplconfigdir = '/home/metropolis/matplotlib'
 if os.path.isdir(mplconfigdir):
     os.environ['MPLCONFIGDIR'] = mplconfigdir
 
+# Colormaps which are not defined in matplotlib.
+COLORMAPS = {
+    # Colormap that looks good to visualize congestion.
+    'congestion': LinearSegmentedColormap.from_list('congestion', [
+        (153 / 255, 255 / 255, 102 / 255),  # light green
+        (255 / 255, 219 / 255, 77 / 255),  # yellowish
+        (255 / 255, 0, 0),  # red
+    ]),
+}
+# Colormap used for the attributes of the network.
+NETWORK_PALETTE = 'YlGnBu'
+# Number of colors of the palettes.
+PALETTE_SIZE = 500
+# Palettes already built, by colormap name, size and transparency.
+PALETTES = dict()
 
-def get_arrivals_departures(simulation):
-    # Get some objects.
-    centroids = models.Centroid.objects.filter(
-            network__supply__scenario__simulation=simulation
-    )
-    demand_segments = models.DemandSegment.objects.filter(
-            demand=simulation.scenario.demand
-    )
-    matrices = models.Matrices.objects.filter(
-        demandsegment__in=demand_segments)
-    departures_values = []
-    arrivals_values = []
-    for centroid in centroids:
-        departures = models.Matrix.objects.filter(
-            p=centroid, matrices__in=matrices)
-        arrivals = models.Matrix.objects.filter(
-            q=centroid, matrices__in=matrices)
-        if departures.exists():
-            departures_values.append(departures.aggregate(Sum('r'))['r__sum'])
-        else:
-            departures_values.append(0)
-        if arrivals.exists():
-            arrivals_values.append(arrivals.aggregate(Sum('r'))['r__sum'])
-        else:
-            arrivals_values.append(0)
-    return departures_values, arrivals_values
+
+def get_arrivals_departures(simulation, centroids=None):
+    """Return two numpy arrays with the departures and the arrivals at each
+    centroid of the simulation (in the order of centroids if given).
+    """
+    if centroids is None:
+        centroids = functions.get_query('centroid', simulation)
+    centroid_ids = np.array([centroid.id for centroid in centroids],
+                            dtype=np.int64)
+    profile = functions.get_zone_demand_profile(simulation)
+    positions, known = find_centroids(profile, centroid_ids)
+    if not known.all():
+        # The cached profile is outdated.
+        profile = functions.get_zone_demand_profile(simulation, refresh=True)
+        positions, known = find_centroids(profile, centroid_ids)
+    departures = np.zeros(len(centroid_ids))
+    arrivals = np.zeros(len(centroid_ids))
+    departures[known] = profile['departures'][positions[known]]
+    arrivals[known] = profile['arrivals'][positions[known]]
+    return departures, arrivals
 
 
-def build_colorscale(values, cmap):
-    """Convert a numpy array of values to a list of colors using a color map.
+def find_centroids(profile, centroid_ids):
+    """Return the positions of the centroids in a zone demand profile and a
+    boolean array indicating if the centroids are in the profile.
+    """
+    profile_ids = profile['centroids']
+    if not len(profile_ids):
+        return (np.zeros(len(centroid_ids), dtype=np.int64),
+                np.zeros(len(centroid_ids), dtype=bool))
+    # The centroids of the profile are sorted by id.
+    positions = np.searchsorted(profile_ids, centroid_ids)
+    positions = np.minimum(positions, len(profile_ids) - 1)
+    known = profile_ids[positions] == centroid_ids
+    return positions, known
+
 
-    Return a list of colors, a dictionary with stats and a color scale.
+def get_stats(values):
+    """Return a dictionary with descriptive statistics of a numpy array of
+    values, used to build the colors of the values.
     """
-    transparency = .8
     # Compute min, max and average.
     min_val = np.min(values)
     max_val = np.max(values)
@@ -62,23 +87,57 @@ def build_colorscale(values, cmap):
             min_val = 0
             max_val *= 2
     # Create a dictionary with descriptive statistics.
-    stats = {'min': min_val, 'max': max_val, 'average': ave_val}
+    stats = {'min': float(min_val), 'max': float(max_val),
+             'average': float(ave_val)}
+    return stats
+
+
+def get_colormap(name):
+    """Return a matplotlib colormap from its name."""
+    if name in COLORMAPS:
+        return COLORMAPS[name]
+    return plt.get_cmap(name)
+
+
+def get_palette(name, size=PALETTE_SIZE, transparency=.8):
+    """Return a list of colors sampled uniformly from a colormap.
+
+    The palettes are built once for each colormap, size and transparency.
+    """
+    key = (name, size, transparency)
+    if key not in PALETTES:
+        cmap = get_colormap(name)
+        colors = cmap(np.linspace(0, 1, size))
+        PALETTES[key] = [
+            'rgba({0}, {1}, {2}, {3})'.format(color[0]*255, color[1]*255,
+                                              color[2]*255, transparency)
+            for color in colors
+        ]
+    return PALETTES[key]
+
+
+def values_to_colors(values, stats, palette):
+    """Convert a numpy array of values to a list of colors using the stats of
+    the values.
+
+    The colors are the indices of the colors in the palette.
+    """
+    size = len(get_palette(palette))
+    colors = functions.value_to_color_index(values, stats['min'],
+                                            stats['max'], size)
+    return colors.tolist()
+
+
+def build_colorscale(values, palette):
+    """Convert a numpy array of values to a list of colors using a palette.
+
+    Return a dictionary with stats, a list of colors (indices of the palette)
+    and a color scale (the name of the palette).
+    """
+    stats = get_stats(values)
     # Compute the list of colors.
-    values = (values - min_val) / (max_val - min_val)
-    colors = [cmap(val) for val in values]
-    colors = ['rgba({0}, {1}, {2}, {3})'.format(int(color[0]*255),
-                                                int(color[1]*255),
-                                                int(color[2]*255),
-                                                transparency)
-              for color in colors]
-    # Compute the color scale.
-    size = 500
-    colorscale_values = np.arange(0, size, 1)
-    colorscale = [cmap(val/(size-1)) for val in colorscale_values]
-    colorscale = ['rgba({0}, {1}, {2}, {3})'.format(color[0]*255, color[1]*255,
-                                                    color[2]*255, transparency)
-                  for color in colorscale]
-    return stats, colors, colorscale
+    colors = values_to_colors(values, stats, palette)
+    return stats, colors, palette
 
 
 def build_qualitative_colorscale(ids, names):
@@ -113,188 +172,379 @@ def build_qualitative_colorscale(ids, names):
     return stats, colors, colorscale
 
 
-def network_output(simulation, large_network):
-    output = dict()
-    output['stats'] = dict()
-    output['colorscales'] = dict()
-    output['graph'] = dict()
+def centroid_node(centroid, large_network):
+    """Return the node of a centroid (without the demand attributes)."""
+    # With large networks, the y axis is reversed.
+    y = -centroid.y if large_network else centroid.y
+    return {
+        'id': centroid.id, 'x': centroid.x, 'y': y, 'name': centroid.name,
+        'centroid': 'true',
+    }
+
+
+def crossing_node(crossing, large_network):
+    """Return the node of a crossing."""
+    # With large networks, the y axis is reversed.
+    y = -crossing.y if large_network else crossing.y
+    return {
+        'id': crossing.id, 'x': crossing.x, 'y': y, 'name': crossing.name,
+        'centroid': 'false',
+    }
+
+
+def get_node_coordinates(nodes):
+    """Return two numpy arrays with the coordinates of the nodes, indexed by
+    the id of the nodes (nan for unused ids).
+
+    If a crossing and a centroid have the same id, the coordinates of the
+    crossing are used.
+    """
+    size = max([node['id'] for node in nodes], default=-1) + 1
+    x = np.full(size, np.nan)
+    y = np.full(size, np.nan)
+    for node in sorted(nodes, key=lambda n: n['centroid'] == 'false'):
+        x[node['id']] = node['x']
+        y[node['id']] = node['y']
+    return x, y
 
-    # Get a color map from matplotlib.
-    cmap = plt.get_cmap('YlGnBu')
 
-    centroids = models.Centroid.objects.filter(
-            network__supply__scenario__simulation=simulation)
+def link_edges(links, large_network, nodes=None):
+    """Return the edges of some links (without the colors of the attributes).
+
+    With small networks, the nodes of the network output are required to
+    compute the coordinates of the edges. The coordinates of all the edges are
+    computed at once. The 'dummy' links (links with the same origin and
+    destination coordinates) and the links whose nodes do not exist are
+    ignored.
+    """
+    edges = [
+        {
+            'source': link.origin, 'target': link.destination,
+            'name': link.name, 'id': link.id,
+            'lanes': {'values': link.lanes},
+            'length': {'values': link.length},
+            'speed': {'values': link.speed},
+            'capacity': {'values': link.capacity},
+            'type': {'name': link.vdf.name, 'id': link.vdf.id},
+        }
+        for link in links
+    ]
+    if large_network:
+        for edge in edges:
+            edge['size'] = 1
+        return edges
+    if not edges:
+        return edges
+    # Get coordinates.
+    node_x, node_y = get_node_coordinates(nodes)
+    origins = np.array([edge['source'] for edge in edges], dtype=np.int64)
+    destinations = np.array([edge['target'] for edge in edges],
+                            dtype=np.int64)
+    # Links whose nodes are unknown have nan coordinates.
+    known = ((origins >= 0) & (origins < len(node_x))
+             & (destinations >= 0) & (destinations < len(node_x)))
+    origins = np.where(known, origins, 0)
+    destinations = np.where(known, destinations, 0)
+    x1 = np.where(known, node_x[origins], np.nan)
+    x2 = np.where(known, node_x[destinations], np.nan)
+    y1 = np.where(known, node_y[origins], np.nan)
+    y2 = np.where(known, node_y[destinations], np.nan)
+    # Get the link vectors and normalize them.
+    dx = x2 - x1
+    dy = y2 - y1
+    norm = np.hypot(dx, dy)
+    # Ignore 'dummy' links (and links with unknown nodes).
+    valid = ~np.isnan(norm) & (norm != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # The vectors are reversed.
+        new_dx = dy / norm
+        new_dy = dx / norm
+    attributes = {
+        'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2, 'dx': new_dx, 'dy': new_dy,
+        'norm': norm,
+    }
+    attributes = {key: values.tolist() for key, values in attributes.items()}
+    valid_edges = []
+    for i in np.flatnonzero(valid):
+        edge = edges[i]
+        for key, values in attributes.items():
+            edge[key] = values[i]
+        valid_edges.append(edge)
+    return valid_edges
+
+
+def set_centroid_demand(output, simulation, palette):
+    """Compute the departures, the arrivals and their colors for all the
+    centroid nodes of the network output.
+    """
+    centroids = list(functions.get_query('centroid', simulation))
     # Retrieve departures and arrivals at each centroid.
-    departures, arrivals = get_arrivals_departures(simulation)
+    departures, arrivals = get_arrivals_departures(simulation, centroids)
     departures = np.array(departures, dtype=float)
     arrivals = np.array(arrivals, dtype=float)
     averages = (departures + arrivals) / 2
-    # Compute stats, colors and colorscales.
-    stats, departures_colors, colorscale = build_colorscale(departures, cmap)
-    output['stats']['departures'] = stats
-    output['colorscales']['departures'] = colorscale
-    stats, arrivals_colors, colorscale = build_colorscale(arrivals, cmap)
-    output['stats']['arrivals'] = stats
-    output['colorscales']['arrivals'] = colorscale
-    stats, averages_colors, colorscale = build_colorscale(averages, cmap)
-    output['stats']['averages'] = stats
-    output['colorscales']['averages'] = colorscale
-    # Build dictionary of attributes for the centroids.
-    if large_network:
-        centroid_nodes = [
-                {
-                    'id': centroid.id, 'x': centroid.x, 'y': -centroid.y,
-                    'name': centroid.name, 'centroid': 'true',
-                    'departures': {'values': departures[i],
-                                   'colors': departures_colors[i]},
-                    'arrivals': {'values': arrivals[i],
-                                 'colors': arrivals_colors[i]},
-                    'averages': {'values': averages[i],
-                                 'colors': averages_colors[i]}
-                }
-                for (i, centroid) in enumerate(centroids)
-        ]
-    else:
-        centroid_nodes = [
-                {
-                    'id': centroid.id, 'x': centroid.x, 'y': centroid.y,
-                    'name': centroid.name, 'centroid': 'true',
-                    'departures': {'values': departures[i],
-                                   'colors': departures_colors[i]},
-                    'arrivals': {'values': arrivals[i],
-                                 'colors': arrivals_colors[i]},
-                    'averages': {'values': averages[i],
-                                 'colors': averages_colors[i]}
-                }
-                for (i, centroid) in enumerate(centroids)
-        ]
-    output['graph']['nodes'] = centroid_nodes
+    demand = {
+        centroid.id: i for i, centroid in enumerate(centroids)
+    }
+    attributes = (
+        ('departures', departures),
+        ('arrivals', arrivals),
+        ('averages', averages),
+    )
+    centroid_nodes = [node for node in output['graph']['nodes']
+                      if node['centroid'] == 'true']
+    for name, values in attributes:
+        # Compute stats, colors and colorscales.
+        stats, colors, colorscale = build_colorscale(values, palette)
+        output['stats'][name] = stats
+        output['colorscales'][name] = colorscale
+        for node in centroid_nodes:
+            i = demand[node['id']]
+            node[name] = {'values': values[i], 'colors': colors[i]}
 
-    crossings = models.Crossing.objects.filter(
-            network__supply__scenario__simulation=simulation)
-    if large_network:
-        crossing_nodes = [
-                {
-                    'id': crossing.id, 'x': crossing.x, 'y': -crossing.y,
-                    'name': crossing.name, 'centroid': 'false'
-                }
-                for crossing in crossings
-        ]
-    else:
-        crossing_nodes = [
-                {
-                    'id': crossing.id, 'x': crossing.x, 'y': crossing.y,
-                    'name': crossing.name, 'centroid': 'false'
-                }
-                for crossing in crossings
-        ]
-    output['graph']['nodes'] += crossing_nodes
-
-    links = models.Link.objects.filter(
-            network__supply__scenario__simulation=simulation)
-    # Compute stats, colors and colorscales for the attributes of the link.
-    lanes = np.array(links.values_list('lanes', flat=True))
-    stats, lanes_colors, colorscale = build_colorscale(lanes, cmap)
-    output['stats']['lanes'] = stats
-    output['colorscales']['lanes'] = colorscale
-    length = np.array(links.values_list('length', flat=True))
-    stats, length_colors, colorscale = build_colorscale(length, cmap)
-    output['stats']['length'] = stats
-    output['colorscales']['length'] = colorscale
-    speed = np.array(links.values_list('speed', flat=True))
-    stats, speed_colors, colorscale = build_colorscale(speed, cmap)
-    output['stats']['speed'] = stats
-    output['colorscales']['speed'] = colorscale
-    capacity = np.array(links.values_list('capacity', flat=True))
-    stats, capacity_colors, colorscale = build_colorscale(capacity, cmap)
-    output['stats']['capacity'] = stats
-    output['colorscales']['capacity'] = colorscale
+
+def set_link_colors(output, palette, changed_edges=None):
+    """Compute the stats and colors of the attributes of the links.
+
+    If changed_edges is a list of edges, the colors of the other edges are
+    only computed again when the stats of an attribute change.
+    """
+    edges = output['graph']['edges']
+    for name in ('lanes', 'length', 'speed', 'capacity'):
+        values = np.array([edge[name]['values'] for edge in edges],
+                          dtype=float)
+        if not len(values):
+            continue
+        stats, colors, colorscale = build_colorscale(values, palette)
+        old_stats = output['stats'].get(name, dict())
+        if (changed_edges is not None
+                and old_stats.get('min') == stats['min']
+                and old_stats.get('max') == stats['max']):
+            # The colors of the unchanged edges are still valid.
+            values = [edge[name]['values'] for edge in changed_edges]
+            colors = values_to_colors(values, stats, palette)
+            for edge, color in zip(changed_edges, colors):
+                edge[name]['colors'] = color
+        else:
+            for edge, color in zip(edges, colors):
+                edge[name]['colors'] = color
+        output['stats'][name] = stats
+        output['colorscales'][name] = colorscale
+
+
+def set_link_types(output):
+    """Compute the stats and colors of the type (congestion function) of the
+    links.
+    """
+    edges = output['graph']['edges']
     # Instead of returning the id of the function for each link, we return a
     # pseudo-id which is between 0 and the number of function minus 1.
-    function_ids = list(np.unique(links.values_list('vdf_id', flat=True)))
-    function_names = list(np.unique(links.values_list('vdf__name', flat=True)))
+    function_ids = sorted({edge['type']['id'] for edge in edges})
+    function_names = sorted({edge['type']['name'] for edge in edges})
     stats, type_colors, colorscale = build_qualitative_colorscale(
         function_ids, function_names)
     output['stats']['type'] = stats
     output['colorscales']['type'] = colorscale
-    if large_network:
-        link_edges = [
-            ({
-                'source': link.origin, 'target': link.destination,
-                'name': link.name, 'id': link.id,
-                'lanes': {'values': lanes[i], 'colors': lanes_colors[i]},
-                'length': {'values': length[i], 'colors': length_colors[i]},
-                'speed': {'values': speed[i], 'colors': speed_colors[i]},
-                'capacity': {'values': capacity[i],
-                             'colors': capacity_colors[i]},
-                'type': {'name': link.vdf.name,
-                         'colors': type_colors[link.vdf.id]},
-                'size': 1,
-            })
-            for i, link in enumerate(links)
-        ]
-    else:
-        link_edges = []
-        for (i, link) in enumerate(links):
-            # Find origin and destination nodes.
-            try:
-                origin = models.Crossing.objects.get(pk=link.origin)
-            except models.Crossing.DoesNotExist:
-                origin = models.Centroid.objects.get(pk=link.origin)
-            try:
-                destination = models.Crossing.objects.get(pk=link.destination)
-            except models.Crossing.DoesNotExist:
-                destination = models.Centroid.objects.get(pk=link.destination)
-            # Get coordinates.
-            x1 = origin.x
-            x2 = destination.x
-            y1 = origin.y
-            y2 = destination.y
-            # Get the link vector and normalize it.
-            dx = x2 - x1
-            dy = y2 - y1
-            delta = np.array([dx, dy])
-            norm = np.linalg.norm(delta)
-            # Ignore 'dummy' links.
-            if norm != 0:
-                delta /= norm
-                # Reverse the vector.
-                delta = delta[::-1]
-                dx, dy = delta
-                link_edge = {
-                    'source': link.origin, 'target': link.destination,
-                    'x1': x1, 'x2': x2, 'y1': y1, 'y2': y2, 'dx': dx, 'dy': dy,
-                    'name': link.name, 'id': link.id, 'norm': norm,
-                    'lanes': {'values': lanes[i], 'colors': lanes_colors[i]},
-                    'length': {'values': length[i],
-                               'colors': length_colors[i]},
-                    'speed': {'values': speed[i], 'colors': speed_colors[i]},
-                    'capacity': {'values': capacity[i],
-                                 'colors': capacity_colors[i]},
-                    'type': {'name': link.vdf.name,
-                             'colors': type_colors[link.vdf.id]}
-                }
-                link_edges.append(link_edge)
-    output['graph']['edges'] = link_edges
+    for edge in edges:
+        edge['type']['colors'] = type_colors[edge['type']['id']]
+
+
+def set_network_stats(output):
+    """Compute the descriptive statistics of the coordinates of the nodes and
+    of the norm of the edges."""
+    nodes = output['graph']['nodes']
+    large_network = output['large_network']
+    x = [node['x'] for node in nodes]
+    # With large networks, the y axis of the nodes is reversed.
+    y = [-node['y'] if large_network else node['y'] for node in nodes]
+    if x:
+        output['stats']['x'] = {'min': min(x), 'max': max(x)}
+        output['stats']['y'] = {'min': min(y), 'max': max(y)}
+    edges = output['graph']['edges']
+    if not large_network and edges:
+        norms = [edge['norm'] for edge in edges]
+        output['stats']['norm'] = {'min': min(norms), 'max': max(norms),
+                                   'ave': np.mean(norms)}
+
+
+def network_output(simulation, large_network):
+    """Build the network output of a simulation, used to draw the network.
+    """
+    output = dict()
+    output['large_network'] = large_network
+    output['stats'] = dict()
+    output['colorscales'] = dict()
+    output['graph'] = dict()
+
+    # The colors of the attributes are indices of the palette, the palette is
+    # stored once in the output.
+    palette = NETWORK_PALETTE
+    output['palettes'] = {palette: get_palette(palette)}
+
+    centroids = functions.get_query('centroid', simulation)
+    crossings = functions.get_query('crossing', simulation)
+    output['graph']['nodes'] = (
+        [centroid_node(centroid, large_network) for centroid in centroids]
+        + [crossing_node(crossing, large_network) for crossing in crossings]
+    )
+    set_centroid_demand(output, simulation, palette)
+
+    links = functions.get_query('link', simulation).select_related('vdf')
+    output['graph']['edges'] = link_edges(links, large_network,
+                                          output['graph']['nodes'])
+    set_link_colors(output, palette)
+    set_link_types(output)
 
     # Compute more descriptive statistics.
-    min_x = np.min(centroids.values_list('x', flat=True))
-    max_x = np.max(centroids.values_list('x', flat=True))
-    min_x = min(min_x, np.min(crossings.values_list('x', flat=True)))
-    max_x = max(max_x, np.max(crossings.values_list('x', flat=True)))
-    min_y = np.min(centroids.values_list('y', flat=True))
-    max_y = np.max(centroids.values_list('y', flat=True))
-    min_y = min(min_y, np.min(crossings.values_list('y', flat=True)))
-    max_y = max(max_y, np.max(crossings.values_list('y', flat=True)))
-    output['stats']['x'] = {'min': min_x, 'max': max_x}
-    output['stats']['y'] = {'min': min_y, 'max': max_y}
-    if not large_network:
-        min_norm = min(output['graph']['edges'],
-                       key=lambda x: x['norm'])['norm']
-        max_norm = max(output['graph']['edges'],
-                       key=lambda x: x['norm'])['norm']
-        ave_norm = np.mean([x['norm'] for x in output['graph']['edges']])
-        output['stats']['norm'] = {'min': min_norm, 'max': max_norm,
-                                   'ave': ave_norm}
+    set_network_stats(output)
+
+    return output
+
+
+def update_network_output(simulation, output, changes):
+    """Patch the network output of a simulation with the changes of the
+    network.
+
+    The argument changes is a dictionary mapping the object names
+    ('centroid', 'crossing', 'link', 'function' or 'demand') to the set of
+    ids of the changed objects.
+    Only the nodes and edges of the changed objects are built again, then the
+    stats and colorscales are updated.
+    """
+    large_network = output['large_network']
+    network = simulation.scenario.supply.network
+    palette = NETWORK_PALETTE
+    nodes = output['graph']['nodes']
+    edges = output['graph']['edges']
 
+    # Update the nodes of the changed centroids and crossings.
+    node_types = (
+        ('centroid', 'true', models.Centroid, centroid_node),
+        ('crossing', 'false', models.Crossing, crossing_node),
+    )
+    changed_nodes = set()
+    for object_name, flag, model, builder in node_types:
+        ids = changes.get(object_name, set())
+        if not ids:
+            continue
+        changed_nodes |= ids
+        new_nodes = {
+            obj.id: builder(obj, large_network)
+            for obj in model.objects.filter(pk__in=ids, network=network)
+        }
+        kept_nodes = []
+        for node in nodes:
+            if node['centroid'] == flag and node['id'] in ids:
+                if node['id'] not in new_nodes:
+                    # The object has been deleted.
+                    continue
+                node.update(new_nodes.pop(node['id']))
+            kept_nodes.append(node)
+        nodes = kept_nodes + list(new_nodes.values())
+    output['graph']['nodes'] = nodes
+
+    # Update the edges of the changed links and of the links connected to the
+    # changed nodes.
+    link_ids = set(changes.get('link', set()))
+    if changed_nodes:
+        link_ids |= {edge['id'] for edge in edges
+                     if edge['source'] in changed_nodes
+                     or edge['target'] in changed_nodes}
+        # Some links connected to the changed nodes might not be in the
+        # output (e.g. 'dummy' links).
+        link_ids |= set(models.Link.objects.filter(
+            Q(origin__in=changed_nodes) | Q(destination__in=changed_nodes),
+            network=network,
+        ).values_list('id', flat=True))
+    changed_edges = []
+    if link_ids:
+        links = models.Link.objects.filter(
+            pk__in=link_ids, network=network).select_related('vdf')
+        new_edges = {edge['id']: edge
+                     for edge in link_edges(links, large_network, nodes)}
+        kept_edges = []
+        for edge in edges:
+            if edge['id'] in link_ids:
+                if edge['id'] not in new_edges:
+                    # The link has been deleted or is a 'dummy' link.
+                    continue
+                edge = new_edges.pop(edge['id'])
+                changed_edges.append(edge)
+            kept_edges.append(edge)
+        kept_edges += new_edges.values()
+        changed_edges += new_edges.values()
+        edges = kept_edges
+    output['graph']['edges'] = edges
+
+    if 'function' in changes:
+        # The names of the functions might have changed.
+        names = dict(
+            models.Function.objects.filter(
+                functionset=simulation.scenario.supply.functionset
+            ).values_list('id', 'name')
+        )
+        for edge in edges:
+            edge['type']['name'] = names.get(edge['type']['id'],
+                                             edge['type']['name'])
+
+    if 'demand' in changes or 'centroid' in changes:
+        set_centroid_demand(output, simulation, palette)
+    set_link_colors(output, palette, changed_edges)
+    set_link_types(output)
+    set_network_stats(output)
+
+    return output
+
+
+def get_network_output(simulation, large_network):
+    """Return the network output of a simulation.
+
+    The network output is stored in a json file. The file is generated if it
+    does not exist, patched if some objects of the network have changed (see
+    functions.simulation_changed) and generated again if the changes are
+    unknown.
+    """
+    output_file = (
+        '{0}/website_files/network_output/network_{1!s}.json'
+    ).format(settings.BASE_DIR, simulation.id)
+    changes_query = models.NetworkChange.objects.filter(simulation=simulation)
+    if (not functions.network_has_changed(simulation)
+            and os.path.isfile(output_file)):
+        # Use data from the existing output file.
+        with open(output_file, 'r') as f:
+            output = json.load(f)
+        return output
+    changes_list = list(changes_query.values_list('id', 'object_name',
+                                                  'object_id'))
+    changes = dict()
+    for _, object_name, object_id in changes_list:
+        changes.setdefault(object_name, set())
+        if object_id is not None:
+            changes[object_name].add(object_id)
+    output = None
+    if (os.path.isfile(output_file) and changes_list
+            and 'all' not in changes):
+        with open(output_file, 'r') as f:
+            output = json.load(f)
+        if output.get('large_network') != large_network:
+            # The format of the output is different.
+            output = None
+        else:
+            output = update_network_output(simulation, output, changes)
+    if output is None:
+        # Generate a new output file.
+        output = network_output(simulation, large_network)
+    with open(output_file, 'w') as f:
+        json.dump(output, f)
+    # Do not generate a new output file the next time (unless the
+    # simulation changes).
+    if changes_list:
+        last_id = max(change[0] for change in changes_list)
+        changes_query.filter(id__lte=last_id).delete()
+    # The changes recorded during the generation are kept for the next time
+    # and the flag is cleared only if there are none.
+    if not changes_query.exists():
+        models.Simulation.objects.filter(pk=simulation.id).update(
+            has_changed=False)
+        simulation.has_changed = False
     return output
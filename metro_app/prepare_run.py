@@ -14,7 +14,6 @@ from shutil import copyfile
 
 import django
 from django.conf import settings
-from django.db.models import Sum
 
 # Load the django website.
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -27,78 +26,79 @@ from metro_app import models, functions, plots
 from metro_app.views import NETWORK_THRESHOLD
 TRAVELERS_THRESHOLD = 10000000  # 10 millions
 
-print('Starting script...')
 
-# Read argument of the script call.
-try:
-    run_id = int(sys.argv[1])
-except IndexError:
-    raise SystemExit('MetroArgError: This script must be executed with the id '
-                     + 'of the SimulationRun has an argument.')
+def main(run_id):
+    """Prepare the SimulationRun with the given id (this function is also
+    called by the run dispatcher, without starting a new interpreter)."""
+    # Get the SimulationRun object of the argument.
+    try:
+        run = models.SimulationRun.objects.get(pk=run_id)
+    except models.SimulationRun.DoesNotExist:
+        raise SystemExit('MetroDoesNotExist: No SimulationRun object '
+                         + 'corresponding to the given id.')
 
-# Get the SimulationRun object of the argument.
-try:
-    run = models.SimulationRun.objects.get(pk=run_id)
-except models.SimulationRun.DoesNotExist:
-    raise SystemExit('MetroDoesNotExist: No SimulationRun object corresponding'
-                     + ' to the given id.')
+    simulation = run.simulation
 
-simulation = run.simulation
+    # Output user-specific results only if the population is small.
+    # I believe that Metropolis does not output the file correctly if the
+    # population is large.
+    nb_links, nb_travelers = functions.get_run_size(simulation)
+    if nb_travelers > TRAVELERS_THRESHOLD:
+        simulation.outputUsersTimes = 'false'
+        simulation.outputUsersPaths = 'false'
+    else:
+        simulation.outputUsersTimes = 'true'
+        simulation.outputUsersPaths = 'true'
+    simulation.save(update_fields=['outputUsersTimes', 'outputUsersPaths'])
 
-# Output user-specific results only if the population is small.
-# I believe that Metropolis does not output the file correctly if the
-# population is large.
-matrices = functions.get_query('matrices', simulation)
-nb_travelers = matrices.aggregate(Sum('total'))['total__sum']
-if nb_travelers > TRAVELERS_THRESHOLD:
-    simulation.outputUsersTimes = 'false'
-    simulation.outputUsersPaths = 'false'
-else:
-    simulation.outputUsersTimes = 'true'
-    simulation.outputUsersPaths = 'true'
-simulation.save()
+    # Use the existing network output file if it exists.
+    simulation_network = (
+        '{0}/website_files/network_output/network_{1}.json'
+        .format(settings.BASE_DIR, simulation.id)
+    )
+    if (functions.network_has_changed(simulation)
+            or not os.path.isfile(simulation_network)):
+        # Generate a new output file or patch the existing one.
+        print('Network file is not up to date, updating it...')
+        large_network = nb_links > NETWORK_THRESHOLD
+        plots.get_network_output(simulation, large_network)
+    # The current network of the simulation is stored as the network of the
+    # run.
+    print('Copying the network json file...')
+    run_network = (
+        '{0}/website_files/network_output/network_{1}_{2}.json'
+        .format(settings.BASE_DIR, simulation.id, run.id)
+    )
+    copyfile(simulation_network, run_network)
 
-# Use the existing network output file if it exists.
-simulation_network = (
-    '{0}/website_files/network_output/network_{1}.json'
-    .format(settings.BASE_DIR, simulation.id)
-)
-if simulation.has_changed or not os.path.isfile(simulation_network):
-    # Generate a new output file.
-    print('Network file does not exist, generating a new one...')
-    links = functions.get_query('link', simulation)
-    large_network = links.count() > NETWORK_THRESHOLD
-    output = plots.network_output(simulation, large_network)
-    with open(simulation_network, 'w') as f:
-        json.dump(output, f)
-    # Do not generate a new output file the next time (unless the
-    # simulation changes).
-    simulation.has_changed = False
-    simulation.save()
-# The current network of the simulation is stored as the network of the
-# run.
-print('Copying the network json file...')
-run_network = (
-    '{0}/website_files/network_output/network_{1}_{2}.json'
-    .format(settings.BASE_DIR, simulation.id, run.id)
-)
-copyfile(simulation_network, run_network)
+    # Store the current parameters of the simulation in a file.
+    print('Storing the parameters of the simulation...')
+    run_parameters = (
+        '{0}/website_files/network_output/parameters_{1}_{2}.json'
+        .format(settings.BASE_DIR, simulation.id, run.id)
+    )
+    periods = (simulation.lastRecord - simulation.startTime) \
+        / simulation.recordsInterval
+    parameters = dict(startTime=simulation.startTime,
+                      stopTime=simulation.lastRecord,
+                      intervalTime=simulation.recordsInterval,
+                      periods=periods)
+    with open(run_parameters, 'w') as f:
+        json.dump(parameters, f)
 
-# Store the current parameters of the simulation in a file.
-print('Storing the parameters of the simulation...')
-run_parameters = (
-    '{0}/website_files/network_output/parameters_{1}_{2}.json'
-    .format(settings.BASE_DIR, simulation.id, run.id)
-)
-periods = (simulation.lastRecord - simulation.startTime) \
-    / simulation.recordsInterval
-parameters = dict(startTime=simulation.startTime,
-                  stopTime=simulation.lastRecord,
-                  intervalTime=simulation.recordsInterval,
-                  periods=periods)
-with open(run_parameters, 'w') as f:
-    json.dump(parameters, f)
+    # Change the status of the run (unless it has been canceled).
+    models.SimulationRun.objects.filter(
+        pk=run.id, status='Preparing').update(status='Running')
 
-# Change the status of the run.
-run.status = 'Running'
-run.save()
+
+if __name__ == '__main__':
+    print('Starting script...')
+
+    # Read argument of the script call.
+    try:
+        run_id = int(sys.argv[1])
+    except IndexError:
+        raise SystemExit('MetroArgError: This script must be executed with '
+                         + 'the id of the SimulationRun has an argument.')
+
+    main(run_id)
@@ -0,0 +1,304 @@
+"""Daemon starting and supervising the runs of all the simulations.
+
+The script runs forever. Every DISPATCHER_INTERVAL seconds, it starts the
+queued SimulationRun objects (in the order given by functions.run_queue) as
+long as there are less than MAX_RUNS runs in progress and as long as the
+estimated memory of the runs in progress is lower than RUN_MEMORY_LIMIT.
+
+A run has three phases: 'prepare' (see prepare_run.py), 'metrosim' and
+'build' (see build_results.py). Django and the modules of the scripts are
+loaded once by the dispatcher and the two python phases are run in forked
+processes, so that they do not pay the start-up of a new interpreter.
+Metrosim is run as a child process. The resources used by each phase are
+recorded in a RunPhase object.
+The current phase of a run is killed when the run is aborted (see
+functions.stop_run) or when the phase lasts more than its timeout (see
+RUN_PHASE_TIMEOUTS). When the dispatcher receives SIGTERM, all the runs in
+progress are aborted. A run is marked as failed if one of its phases cannot
+be started. When the dispatcher starts, the runs left in progress
+by a previous dispatcher are marked as failed.
+The script must be started with the website (see run.sh).
+"""
+
+import os
+import sys
+import time
+import signal
+import traceback
+import subprocess
+import django
+from django.utils import timezone
+
+# Load the django website.
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_ROOT)
+os.environ.setdefault(
+    "DJANGO_SETTINGS_MODULE", "metropolis_web_interface.settings")
+django.setup()
+
+from django.conf import settings
+from django.db import connections
+
+from metro_app import models, functions, prepare_run, build_results
+
+# Phases of a run, in order.
+PHASES = ('prepare', 'metrosim', 'build')
+# Number of seconds between SIGTERM and SIGKILL when a phase is killed.
+KILL_DELAY = 30
+# Size of the blocks counted by getrusage (in bytes).
+BLOCK_SIZE = 512
+
+
+def get_log_file(run_id):
+    """Return the path of the log file of the scripts of a run."""
+    return '{0}/website_files/script_logs/run_{1}.txt'.format(
+        settings.BASE_DIR, run_id)
+
+
+def fork_phase(function, run_id):
+    """Run function(run_id) in a forked process and return its pid.
+
+    The output of the process is written in the log file of the run.
+    """
+    # The database connections must not be shared with the forked process.
+    connections.close_all()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+    # Child process: it is the leader of a new process group so that the
+    # processes it starts are killed with it.
+    code = 1
+    try:
+        os.setpgid(0, 0)
+        fd = os.open(get_log_file(run_id),
+                     os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        function(run_id)
+        code = 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def start_phase(state):
+    """Start the current phase of a run.
+
+    Return False if the phase could not be started (the run is then marked as
+    failed).
+    """
+    run = state['run']
+    name = PHASES[state['phase']]
+    print('Starting phase {} of run {}'.format(name, run.id))
+    state['record'] = None
+    try:
+        if state['phase'] == 0:
+            # Start a new log file.
+            open(get_log_file(run.id), 'w').close()
+        state['record'] = models.RunPhase(run=run, name=name,
+                                          start_time=timezone.now())
+        state['record'].save()
+        if name == 'prepare':
+            state['pid'] = fork_phase(prepare_run.main, run.id)
+        elif name == 'metrosim':
+            metrosim_file = (settings.BASE_DIR
+                             + '/metrosim_files/execs/metrosim')
+            arg_file = functions.write_arg_file(run)
+            with open(get_log_file(run.id), 'a') as f:
+                process = subprocess.Popen(
+                    [metrosim_file, arg_file], stdout=f, stderr=f,
+                    start_new_session=True,
+                )
+            # The Popen object is kept so that the subprocess module does not
+            # wait for the process itself.
+            state['process'] = process
+            state['pid'] = process.pid
+        else:
+            state['pid'] = fork_phase(build_results.main, run.id)
+    except Exception:
+        traceback.print_exc()
+        fail_phase(state)
+        return False
+    state['start'] = time.monotonic()
+    state['killed'] = None
+    return True
+
+
+def fail_phase(state):
+    """Close the record of a phase which could not be started and mark its
+    run as failed."""
+    run = state['run']
+    record = state['record']
+    if record is not None and record.pk is not None:
+        record.end_time = timezone.now()
+        record.wall_time = 0
+        record.save()
+    models.SimulationRun.objects.filter(
+        pk=run.id, status__in=functions.RUN_IN_PROGRESS
+    ).update(status='Failed', end_time=timezone.now())
+    print('Phase {} of run {} could not be started, the run failed'.format(
+        PHASES[state['phase']], run.id))
+
+
+def kill_phase(state):
+    """Kill the current phase of a run (and the processes it started)."""
+    now = time.monotonic()
+    if state['killed'] is None:
+        state['killed'] = now
+        sig = signal.SIGTERM
+    elif now - state['killed'] > KILL_DELAY:
+        sig = signal.SIGKILL
+    else:
+        return
+    try:
+        os.killpg(state['pid'], sig)
+    except ProcessLookupError:
+        pass
+
+
+def end_phase(state, status, usage):
+    """Record the resources used by the phase which just ended and return
+    its exit code."""
+    record = state['record']
+    record.end_time = timezone.now()
+    record.wall_time = time.monotonic() - state['start']
+    record.cpu_time = usage.ru_utime + usage.ru_stime
+    record.max_rss = usage.ru_maxrss
+    record.read_bytes = usage.ru_inblock * BLOCK_SIZE
+    record.write_bytes = usage.ru_oublock * BLOCK_SIZE
+    record.exit_code = os.waitstatus_to_exitcode(status)
+    record.save()
+    print('Phase {} of run {} ended with code {} ({:.1f} s)'.format(
+        record.name, record.run_id, record.exit_code, record.wall_time))
+    return record.exit_code
+
+
+def supervise(supervised, aborted):
+    """Check the phases of the runs in progress, start the next phases and
+    kill the phases of the aborted runs or the phases that timed out.
+
+    Return the ids of the runs which are over.
+    """
+    over = []
+    for run_id, state in supervised.items():
+        pid, status, usage = os.wait4(state['pid'], os.WNOHANG)
+        if pid == 0:
+            # The phase is still running.
+            name = PHASES[state['phase']]
+            timeout = settings.RUN_PHASE_TIMEOUTS.get(name)
+            if run_id in aborted:
+                kill_phase(state)
+            elif timeout and time.monotonic() - state['start'] > timeout:
+                print('Phase {} of run {} timed out'.format(name, run_id))
+                kill_phase(state)
+            continue
+        code = end_phase(state, status, usage)
+        if code == 0 and run_id not in aborted \
+                and state['phase'] + 1 < len(PHASES):
+            state['phase'] += 1
+            if start_phase(state):
+                continue
+        over.append(run_id)
+        if code != 0 and run_id not in aborted:
+            # The run stopped before its end (build_results.py marks the run
+            # as failed itself but not if it was killed).
+            models.SimulationRun.objects.filter(
+                pk=run_id, status__in=functions.RUN_IN_PROGRESS
+            ).update(status='Failed', end_time=timezone.now())
+            print('Run {} failed'.format(run_id))
+    return over
+
+
+def claim_run(run):
+    """Mark a queued SimulationRun as started and return True (or return
+    False if the run is not queued anymore, e.g. it has been canceled)."""
+    claimed = models.SimulationRun.objects.filter(
+        pk=run.id, status='Queued'
+    ).update(status='Preparing', start_time=timezone.now())
+    return claimed > 0
+
+
+def dispatch(supervised):
+    """Start the queued runs while there are enough free resources."""
+    in_progress = list(models.SimulationRun.objects.filter(
+        status__in=functions.RUN_IN_PROGRESS).exclude(pk__in=list(supervised)))
+    # The supervised runs keep their resources until the end of their current
+    # phase, even if they are aborted.
+    in_progress += [state['run'] for state in supervised.values()]
+    memory = sum(run.memory or 0 for run in in_progress)
+    nb_runs = len(in_progress)
+    while nb_runs < settings.MAX_RUNS:
+        queue = functions.run_queue()
+        if not queue:
+            break
+        run = queue[0]
+        if nb_runs and memory + (run.memory or 0) > settings.RUN_MEMORY_LIMIT:
+            # The next run must wait for the end of other runs (the following
+            # runs are not started so that large runs are not delayed
+            # forever).
+            break
+        if claim_run(run):
+            print('Starting run {} ({} MB)'.format(run.id, run.memory))
+            supervised[run.id] = dict(run=run, phase=0)
+            if not start_phase(supervised[run.id]):
+                # The run failed, the dispatcher goes on with the next run.
+                del supervised[run.id]
+                continue
+            memory += run.memory or 0
+            nb_runs += 1
+
+
+def fail_orphaned_runs():
+    """Mark as failed the runs left in progress by a previous dispatcher
+    (e.g. if it crashed or if the server rebooted).
+
+    Only one dispatcher runs at a time so no process supervises these runs
+    anymore. Otherwise, they would count in the resources used forever.
+    """
+    orphaned = models.SimulationRun.objects.filter(
+        status__in=functions.RUN_IN_PROGRESS)
+    for run_id in orphaned.values_list('id', flat=True):
+        print('Run {} was left in progress, marking it as failed'.format(
+            run_id))
+    orphaned.update(status='Failed', end_time=timezone.now())
+
+
+def shutdown(signum, frame):
+    """Stop the dispatcher at the end of the current loop."""
+    global STOPPING
+    STOPPING = True
+
+
+if __name__ == '__main__':
+    print('Starting script...')
+
+    STOPPING = False
+    signal.signal(signal.SIGTERM, shutdown)
+    fail_orphaned_runs()
+    supervised = dict()
+    last_dispatch = 0
+    while not STOPPING:
+        aborted = set(models.SimulationRun.objects.filter(
+            pk__in=list(supervised), status='Aborted'
+        ).values_list('id', flat=True))
+        for run_id in supervise(supervised, aborted):
+            del supervised[run_id]
+        if time.monotonic() - last_dispatch > settings.DISPATCHER_INTERVAL:
+            dispatch(supervised)
+            last_dispatch = time.monotonic()
+        time.sleep(1)
+
+    print('Aborting the runs in progress...')
+    models.SimulationRun.objects.filter(
+        pk__in=list(supervised)).update(status='Aborted')
+    while supervised:
+        for run_id in supervise(supervised, set(supervised)):
+            del supervised[run_id]
+        time.sleep(1)
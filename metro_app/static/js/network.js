@@ -6,6 +6,11 @@
  * In particular, the scripts manage the controls and the legends.
  */
 
+// The colorscales of the attributes are names of the palettes stored in
+// output.palettes and the colors of the nodes and edges are indices of these
+// palettes, they are replaced by the actual colors
+resolveColors();
+
 // Ensure that the legend bars fill the page when window size is updated
 redraw();
 $( window ).resize(redraw);
@@ -101,6 +106,24 @@ function drawLinkLegend(colorscale, min, max) {
 		 .call(d3.axisRight().scale(legendAxis).ticks(10))
 }
 
+function resolveColors() {
+	var palettes = output.palettes || {};
+	var attributes = [];
+	for (var name in output.colorscales) {
+		if (typeof output.colorscales[name] === 'string') {
+			output.colorscales[name] = palettes[output.colorscales[name]];
+			attributes.push(name);
+		}
+	}
+	output.graph.nodes.concat(output.graph.edges).forEach(function(d) {
+		attributes.forEach(function(name) {
+			if (d[name] !== undefined && typeof d[name].colors === 'number') {
+				d[name].colors = output.colorscales[name][d[name].colors];
+			}
+		});
+	});
+}
+
 function redraw() {
 	var controlsHeight = document.getElementById('controls').offsetHeight;
 	var labelHeight = document.getElementById('zoneLabel').offsetHeight;
@@ -142,6 +165,53 @@ if (typeof results !== 'undefined') {
 		return string
 	}
 
+	// Map the id of each link to its row in the results arrays
+	var linkIndex = {};
+	results.link_ids.forEach(function(id, i) { linkIndex[id] = i });
+
+	// Results already fetched, for each output type and period (the results
+	// of a period are the color indices of the links)
+	var resultSlices = {};
+	// Number of periods fetched at once
+	var resultWindow = 6;
+
+	function fetchResults(outputType, period) {
+		// Fetch the results of a window of periods starting at the given
+		// period, then redraw the links
+		if (resultSlices[outputType] === undefined) { resultSlices[outputType] = {} }
+		var slices = resultSlices[outputType];
+		var nbPeriods = Math.min(resultWindow, parameters.periods - period);
+		// Mark the periods as pending to avoid fetching them twice
+		var pending = [];
+		for (var p = period; p < period + nbPeriods; p++) {
+			if (slices[p] === undefined) { slices[p] = null; pending.push(p) }
+		}
+		var url = resultsUrl + '?type=' + outputType + '&period=' + period + '&window=' + nbPeriods;
+		d3.json(url).then(function(data) {
+			data.colors.forEach(function(colors, i) { slices[data.start + i] = colors });
+			drawLinks();
+		}).catch(function(error) {
+			// The periods are not pending anymore so that they are fetched
+			// again when needed
+			pending.forEach(function(p) {
+				if (slices[p] === null) { slices[p] = undefined }
+			});
+		});
+	}
+
+	function resultColor(outputType, id, period) {
+		// Return the color of a link for an output type and a period, the
+		// results are fetched if they are not available yet
+		period = +period;
+		var slices = resultSlices[outputType];
+		if (slices === undefined || slices[period] === undefined) {
+			fetchResults(outputType, period);
+			return undefined
+		}
+		if (slices[period] === null) { return undefined }
+		return results.colorscale[slices[period][linkIndex[id]]]
+	}
+
 	if (largeNetwork == false) {
 		var hssDiv = document.getElementById("hssDiv")
 		var hsSelector = document.getElementById("HSSelector")
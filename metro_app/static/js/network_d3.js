@@ -202,28 +202,28 @@ function drawLinks() {
 		markerPaths.attr('fill', function(d) { return d.type.colors});
 	} else if (selectorValue == 'phi_in' && hsValue == 'h'){
 		drawLinkLegend(results.colorscale, results.stats.phi_in_H.min, results.stats.phi_in_H.max);
-		lines.style("stroke", function(d) { return results.phi_in_H.colors[d['id']][period]});
-		markerPaths.attr('fill', function(d) { return results.phi_in_H.colors[d['id']][period]});
+		lines.style("stroke", function(d) { return resultColor('phi_in_H', d['id'], period)});
+		markerPaths.attr('fill', function(d) { return resultColor('phi_in_H', d['id'], period)});
 	} else if (selectorValue == 'phi_in' && hsValue == 's'){
 		drawLinkLegend(results.colorscale, results.stats.phi_in_S.min, results.stats.phi_in_S.max);
-		lines.style("stroke", function(d) { return results.phi_in_S.colors[d['id']][period]});
-		markerPaths.attr('fill', function(d) { return results.phi_in_S.colors[d['id']][period]});
+		lines.style("stroke", function(d) { return resultColor('phi_in_S', d['id'], period)});
+		markerPaths.attr('fill', function(d) { return resultColor('phi_in_S', d['id'], period)});
 	} else if (selectorValue == 'phi_out' && hsValue == 'h'){
 		drawLinkLegend(results.colorscale, results.stats.phi_out_H.min, results.stats.phi_out_H.max);
-		lines.style("stroke", function(d) { return results.phi_out_H.colors[d['id']][period]});
-		markerPaths.attr('fill', function(d) { return results.phi_out_H.colors[d['id']][period]});
+		lines.style("stroke", function(d) { return resultColor('phi_out_H', d['id'], period)});
+		markerPaths.attr('fill', function(d) { return resultColor('phi_out_H', d['id'], period)});
 	} else if (selectorValue == 'phi_out' && hsValue == 's'){
 		drawLinkLegend(results.colorscale, results.stats.phi_out_S.min, results.stats.phi_out_S.max);
-		lines.style("stroke", function(d) { return results.phi_out_S.colors[d['id']][period]});
-		markerPaths.attr('fill', function(d) { return results.phi_out_S.colors[d['id']][period]});
+		lines.style("stroke", function(d) { return resultColor('phi_out_S', d['id'], period)});
+		markerPaths.attr('fill', function(d) { return resultColor('phi_out_S', d['id'], period)});
 	} else if (selectorValue == 'ttime' && hsValue == 'h'){
 		drawLinkLegend(results.colorscale, results.stats.ttime_H.min, results.stats.ttime_H.max);
-		lines.style("stroke", function(d) { return results.ttime_H.colors[d['id']][period]});
-		markerPaths.attr('fill', function(d) { return results.ttime_H.colors[d['id']][period]});
+		lines.style("stroke", function(d) { return resultColor('ttime_H', d['id'], period)});
+		markerPaths.attr('fill', function(d) { return resultColor('ttime_H', d['id'], period)});
 	} else if (selectorValue == 'ttime' && hsValue == 's'){
 		drawLinkLegend(results.colorscale, results.stats.ttime_S.min, results.stats.ttime_S.max);
-		lines.style("stroke", function(d) { return results.ttime_S.colors[d['id']][period]});
-		markerPaths.attr('fill', function(d) { return results.ttime_S.colors[d['id']][period]});
+		lines.style("stroke", function(d) { return resultColor('ttime_S', d['id'], period)});
+		markerPaths.attr('fill', function(d) { return resultColor('ttime_S', d['id'], period)});
 	}
 }
 
@@ -123,32 +123,32 @@ function drawLinks() {
 		s.refresh();
 	} else if (selectorValue == 'phi_in'){
 		drawLinkLegend(results.colorscale, results.stats.phi_in_H.min, results.stats.phi_in_H.max);
-		edges.forEach(function(e) { e.color=results.phi_in_H.colors[e.id][period] });
+		edges.forEach(function(e) { e.color=resultColor('phi_in_H', e.id, period) });
 		s.refresh();
 	} else if (selectorValue == 'ttime'){
 		drawLinkLegend(results.colorscale, results.stats.ttime_H.min, results.stats.ttime_H.max);
-		edges.forEach(function(e) { e.color=results.ttime_H.colors[e.id][period] });
+		edges.forEach(function(e) { e.color=resultColor('ttime_H', e.id, period) });
 		s.refresh();
 	/*
 	} else if (selectorValue == 'phi_in' && hsValue == 's'){
 		drawLinkLegend(results.colorscale, results.stats.phi_in_S.min, results.stats.phi_in_S.max);
-		edges.forEach(function(e) { e.color=results.phi_in_S.colors[e.id][period] });
+		edges.forEach(function(e) { e.color=resultColor('phi_in_S', e.id, period) });
 		s.refresh();
 	} else if (selectorValue == 'phi_out' && hsValue == 'h'){
 		drawLinkLegend(results.colorscale, results.stats.phi_out_H.min, results.stats.phi_out_H.max);
-		edges.forEach(function(e) { e.color=results.phi_out_H.colors[e.id][period] });
+		edges.forEach(function(e) { e.color=resultColor('phi_out_H', e.id, period) });
 		s.refresh();
 	} else if (selectorValue == 'phi_out' && hsValue == 's'){
 		drawLinkLegend(results.colorscale, results.stats.phi_out_S.min, results.stats.phi_out_S.max);
-		edges.forEach(function(e) { e.color=results.phi_out_S.colors[e.id][period] });
+		edges.forEach(function(e) { e.color=resultColor('phi_out_S', e.id, period) });
 		s.refresh();
 	} else if (selectorValue == 'ttime' && hsValue == 'h'){
 		drawLinkLegend(results.colorscale, results.stats.ttime_H.min, results.stats.ttime_H.max);
-		edges.forEach(function(e) { e.color=results.ttime_H.colors[e.id][period] });
+		edges.forEach(function(e) { e.color=resultColor('ttime_H', e.id, period) });
 		s.refresh();
 	} else if (selectorValue == 'ttime' && hsValue == 's'){
 		drawLinkLegend(results.colorscale, results.stats.ttime_S.min, results.stats.ttime_S.max);
-		edges.forEach(function(e) { e.color=results.ttime_S.colors[e.id][period] });
+		edges.forEach(function(e) { e.color=resultColor('ttime_S', e.id, period) });
 		s.refresh();
 	*/
 	}
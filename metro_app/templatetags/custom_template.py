@@ -1,5 +1,6 @@
 from django import template
 from django.urls import reverse
+from django.utils.safestring import mark_safe
 
 register = template.Library()
 
@@ -66,3 +67,30 @@ def type_mu_to_text(choice):
     elif choice == 'MINTTCOST':
         string += '<strong>adaptive to the free flow travel cost</strong>'
     return string
+
+@register.filter
+def matrix_row_cells(row):
+    """Filter to output the cells of a row of a dense O-D matrix (see
+    functions.get_dense_matrix).
+
+    The cells are rendered in python because the template loops are too slow
+    for matrices with hundreds of zones.
+    """
+    # The values are numbers so they do not need to be escaped.
+    return mark_safe(''.join(
+        '<td class="table-secondary"></td>' if value == -1
+        else '<td>{}</td>'.format(value)
+        for value in row
+    ))
+
+@register.filter
+def matrix_row_inputs(row):
+    """Filter to output the cells of a row of a dense O-D matrix as inputs
+    (see matrix_row_cells)."""
+    # The values are numbers so they do not need to be escaped.
+    return mark_safe(''.join(
+        '<td class="table-secondary"></td>' if value == -1
+        else ('<td class="p-1"><input type="number" step="any" '
+              'class="form-control" min="0" value="{}"></td>').format(value)
+        for value in row
+    ))
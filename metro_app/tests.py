@@ -0,0 +1,314 @@
+"""Tests of the metro_app application.
+
+The index tests run EXPLAIN on the hot queries of the website and check that
+the expected index is used (with MySQL, the index chosen by the optimizer is
+read from the JSON plan; with SQLite, from the query plan).
+"""
+
+import json
+
+import numpy as np
+import pandas as pd
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Sum
+from django.test import SimpleTestCase, TestCase
+from unittest import skipUnless
+
+from metro_app import models, functions, forms
+
+# Number of objects created in each network.
+NB_CENTROIDS = 30
+NB_CROSSINGS = 30
+NB_LINKS = 200
+
+
+def get_used_indexes(query):
+    """Return the names of the indexes used to execute a QuerySet."""
+    if connection.vendor == 'mysql':
+        plan = json.loads(query.explain(format='json'))
+        indexes = set()
+        nodes = [plan]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, dict):
+                if 'key' in node:
+                    indexes.add(node['key'])
+                nodes.extend(node.values())
+            elif isinstance(node, list):
+                nodes.extend(node)
+        return indexes
+    # With SQLite, each row of the plan reads '... USING [COVERING] INDEX
+    # name (...)'.
+    indexes = set()
+    for line in query.explain().splitlines():
+        words = line.split()
+        if 'INDEX' in words:
+            indexes.add(get_constraint_name(words[words.index('INDEX') + 1]))
+    return indexes
+
+
+def get_constraint_name(index):
+    """Return the name of the unique constraint of an index automatically
+    created by SQLite (or the name of the index for the other indexes)."""
+    prefix = 'sqlite_autoindex_'
+    if not index.startswith(prefix):
+        return index
+    table = index[len(prefix):].rsplit('_', 1)[0]
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA index_info("{}")'.format(index))
+        columns = [row[2] for row in cursor.fetchall()]
+        constraints = connection.introspection.get_constraints(cursor, table)
+    for name, constraint in constraints.items():
+        if constraint['unique'] and constraint['columns'] == columns:
+            return name
+    return index
+
+
+def create_network(name, function):
+    """Create a network with its centroids, crossings and links, and an OD
+    matrix with a pair for each couple of centroids.
+
+    Return the network, the matrix and the ids of the centroids.
+    """
+    network = models.Network.objects.create(name=name)
+    models.Centroid.objects.bulk_create([
+        models.Centroid(user_id=i, owner_network=network)
+        for i in range(NB_CENTROIDS)
+    ])
+    models.Crossing.objects.bulk_create([
+        models.Crossing(user_id=i, owner_network=network)
+        for i in range(NB_CROSSINGS)
+    ])
+    centroid_ids = [centroid.id for centroid in
+                    models.Centroid.objects.filter(owner_network=network)]
+    models.Link.objects.bulk_create([
+        models.Link(user_id=i, owner_network=network, vdf=function,
+                    origin=centroid_ids[i % NB_CENTROIDS],
+                    destination=centroid_ids[(i + 1) % NB_CENTROIDS])
+        for i in range(NB_LINKS)
+    ])
+    matrix = models.Matrices.objects.create()
+    models.Matrix.objects.bulk_create([
+        models.Matrix(matrices=matrix, p_id=p, q_id=q, r=1)
+        for p in centroid_ids for q in centroid_ids if p != q
+    ])
+    return network, matrix, centroid_ids
+
+
+class IndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # Create two networks so that the queries must select the objects of
+        # one network.
+        function = models.Function.objects.create()
+        cls.networks = [create_network(str(n), function) for n in range(2)]
+
+    def test_matrix_pair(self):
+        network, matrix, centroid_ids = self.networks[0]
+        query = models.Matrix.objects.filter(
+            matrices=matrix, p=centroid_ids[0], q=centroid_ids[1])
+        self.assertIn('Matrix_pair_unique', get_used_indexes(query))
+
+    def test_matrix_arrivals(self):
+        network, matrix, centroid_ids = self.networks[0]
+        query = models.Matrix.objects.filter(matrices=matrix).values(
+            'q').annotate(total=Sum('r')).order_by()
+        self.assertIn('Matrix_matrices_q_idx', get_used_indexes(query))
+
+    def test_owner_user_id(self):
+        network = self.networks[0][0]
+        for model in (models.Centroid, models.Crossing, models.Link):
+            query = model.objects.filter(owner_network=network, user_id=3)
+            self.assertIn('{}_owner_user_idx'.format(model.__name__),
+                          get_used_indexes(query))
+
+    def test_link_nodes(self):
+        centroid_ids = self.networks[0][2]
+        query = models.Link.objects.filter(origin__in=centroid_ids[:2])
+        self.assertIn('Link_origin_idx', get_used_indexes(query))
+        query = models.Link.objects.filter(destination__in=centroid_ids[:2])
+        self.assertIn('Link_destination_idx', get_used_indexes(query))
+
+
+
+class LoadMatrixPairsTests(TestCase):
+    """Tests of the upsert of OD pairs (see functions.load_matrix_pairs).
+
+    The upsert relies on the unique key of the OD pairs: without it, the
+    ON DUPLICATE KEY clause never applies and duplicate pairs are inserted.
+    The key is created by the migrations, once the duplicate pairs of the
+    existing matrices have been removed by the remove_duplicate_pairs command
+    (see run.sh).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        function = models.Function.objects.create()
+        cls.network, cls.matrix, cls.centroid_ids = create_network(
+            '0', function)
+
+    def test_unique_key(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, models.Matrix._meta.db_table)
+        self.assertIn('Matrix_pair_unique', constraints)
+        constraint = constraints['Matrix_pair_unique']
+        self.assertTrue(constraint['unique'])
+        self.assertEqual(constraint['columns'], ['matrices_id', 'p', 'q'])
+
+    @skipUnless(connection.vendor == 'mysql',
+                'load_matrix_pairs uses MySQL-specific queries')
+    def test_load_matrix_pairs(self):
+        matrix, centroid_ids = self.matrix, self.centroid_ids
+        p, q = centroid_ids[0], centroid_ids[1]
+        models.Matrix.objects.filter(matrices=matrix, p=p, q=q).delete()
+        pairs = pd.DataFrame({
+            'p': [p, q, centroid_ids[2]],
+            'q': [q, p, centroid_ids[3]],
+            'r': [5., 7., 0.],
+        })
+        functions.load_matrix_pairs(matrix, pairs)
+        points = models.Matrix.objects.filter(matrices=matrix)
+        # New pair inserted, existing pair updated and zero pair deleted.
+        self.assertEqual(points.get(p=p, q=q).r, 5)
+        self.assertEqual(points.get(p=q, q=p).r, 7)
+        self.assertFalse(
+            points.filter(p=centroid_ids[2], q=centroid_ids[3]).exists())
+        self.assertEqual(points.count(), NB_CENTROIDS * (NB_CENTROIDS - 1) - 1)
+
+
+class MatrixChangesFormTests(TestCase):
+
+    def clean(self, changes):
+        form = forms.MatrixChangesForm({'changes': changes})
+        form.is_valid()
+        return form
+
+    def test_valid(self):
+        form = self.clean('[[1, 2, 3.5], ["3", "4", 0]]')
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['changes'],
+                         [(1, 2, 3.5), (3, 4, 0.)])
+        self.assertEqual(self.clean('').cleaned_data['changes'], [])
+
+    def test_invalid_values(self):
+        # json.loads accepts NaN and Infinity.
+        for value in ('NaN', 'Infinity', '-Infinity', '-1', '1e400'):
+            form = self.clean('[[1, 2, {}]]'.format(value))
+            self.assertFalse(form.is_valid(), value)
+            self.assertIn('changes', form.errors)
+
+    def test_malformed(self):
+        for changes in ('[[1, 2', '{"p": 1}', '[[1, 2]]', '[["a", 2, 3]]',
+                        '[[1, 2, null]]', '3'):
+            form = self.clean(changes)
+            self.assertFalse(form.is_valid(), changes)
+            self.assertEqual(form.errors['changes'], ['Invalid OD pairs.'])
+
+
+def create_simulation(user, name):
+    """Create an empty simulation owned by user."""
+    form = forms.BaseSimulationForm(user, {'name': name, 'public': False})
+    assert form.is_valid(), form.errors
+    return functions.create_simulation(user, form)
+
+
+class RunQueueTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.simulations = dict()
+        for name in ('a', 'b'):
+            user = User.objects.create_user(username=name)
+            cls.simulations[name] = create_simulation(user, name)
+
+    def add_runs(self, *names, status='Queued'):
+        """Create one run for each name, in the simulation of the user with
+        this name."""
+        return [models.SimulationRun.objects.create(
+            name=name, simulation=self.simulations[name], status=status)
+            for name in names]
+
+    def test_fair_order(self):
+        # The users take turns and the oldest run of a user goes first.
+        a1, a2, a3, b1 = self.add_runs('a', 'a', 'a', 'b')
+        self.assertEqual(functions.run_queue(), [a1, b1, a2, a3])
+
+    def test_runs_in_progress(self):
+        # The runs in progress count against their user.
+        self.add_runs('a', status='Running')
+        a1, b1, b2, b3 = self.add_runs('a', 'b', 'b', 'b')
+        self.assertEqual(functions.run_queue(), [b1, a1, b2, b3])
+        # The other runs do not count.
+        self.add_runs('b', 'b', status='Over')
+        self.add_runs('b', status='Aborted')
+        self.assertEqual(functions.run_queue(), [b1, a1, b2, b3])
+
+    def test_queue_position(self):
+        a1, a2, b1 = self.add_runs('a', 'a', 'b')
+        running, = self.add_runs('b', status='Running')
+        self.assertEqual(functions.queue_position(a1), 1)
+        self.assertEqual(functions.queue_position(a2), 2)
+        self.assertEqual(functions.queue_position(b1), 3)
+        self.assertIsNone(functions.queue_position(running))
+
+    def test_claim_canceled_run(self):
+        # The script is imported here as it loads django itself.
+        from metro_app import run_dispatcher
+        a1, b1 = self.add_runs('a', 'b')
+        queue = functions.run_queue()
+        # The run is canceled by the user after the dispatcher read the queue.
+        functions.stop_run(models.SimulationRun.objects.get(pk=a1.id))
+        self.assertFalse(run_dispatcher.claim_run(queue[0]))
+        a1.refresh_from_db()
+        self.assertEqual(a1.status, 'Aborted')
+        self.assertTrue(run_dispatcher.claim_run(queue[1]))
+        b1.refresh_from_db()
+        self.assertEqual(b1.status, 'Preparing')
+        self.assertEqual(functions.run_queue(), [])
+
+
+class RunResultsTests(SimpleTestCase):
+
+    def setUp(self):
+        # 3 links and 4 periods.
+        self.results = {
+            'palette_size': 11,
+            'stats': {'ttime_H': {'max': 10}},
+            'arrays': {'ttime_H': np.arange(12, dtype=np.int16).reshape(3, 4)},
+        }
+
+    def test_color_index(self):
+        colors = functions.value_to_color_index([0, 2.4, 2.6, 10], 0, 10, 11)
+        self.assertEqual(colors.tolist(), [0, 2, 3, 10])
+        self.assertEqual(colors.dtype, np.int16)
+
+    def test_color_index_equal_values(self):
+        # With a range of 0, all the values have the first color.
+        colors = functions.value_to_color_index(
+            np.full((2, 3), 5.), 5, 5, 11)
+        self.assertEqual(colors.tolist(), [[0, 0, 0], [0, 0, 0]])
+
+    def test_color_index_clipping(self):
+        colors = functions.value_to_color_index([-5, 15, 1000], 0, 10, 11)
+        self.assertEqual(colors.tolist(), [0, 10, 10])
+
+    def test_slice(self):
+        values, colors = functions.slice_run_results(self.results, 'ttime_H')
+        self.assertEqual(values.tolist(),
+                         self.results['arrays']['ttime_H'].tolist())
+        # The values above the maximum have the last color.
+        self.assertEqual(colors[2].tolist(), [8, 9, 10, 10])
+
+    def test_slice_window(self):
+        values, colors = functions.slice_run_results(
+            self.results, 'ttime_H', periods=slice(1, 3))
+        self.assertEqual(values.tolist(), [[1, 2], [5, 6], [9, 10]])
+        self.assertEqual(colors.shape, (3, 2))
+        values, colors = functions.slice_run_results(
+            self.results, 'ttime_H', periods=slice(3, 4),
+            links=np.array([0, 2]))
+        self.assertEqual(values.tolist(), [[3], [11]])
+        self.assertEqual(colors.tolist(), [[3], [10]])
@@ -75,6 +75,8 @@ urlpatterns = [
          views.network_view, name='network_view'),
     path(r'<int:simulation_id>/run/<int:run_id>/network',
          views.network_view_run, name='network_view_run'),
+    path(r'<int:simulation_id>/run/<int:run_id>/network/results',
+         views.network_view_run_results, name='network_view_run_results'),
     path(r'<int:simulation_id>/matrices/<int:demandsegment_id>/',
          views.matrix_main, name='matrix_main'),
     path(r'<int:simulation_id>/matrices/<int:demandsegment_id>/view/',
@@ -111,6 +113,10 @@ urlpatterns = [
          views.simulation_run_stop, name='simulation_run_stop'),
     path(r'<int:simulation_id>/run/<int:run_id>',
          views.simulation_run_view, name='simulation_run_view'),
+    path(r'<int:simulation_id>/import/<int:job_id>',
+         views.import_job_view, name='import_job_view'),
+    path(r'<int:simulation_id>/import/<int:job_id>/status',
+         views.import_job_status, name='import_job_status'),
     path(r'<int:simulation_id>/run_list',
          views.simulation_run_list, name='simulation_run_list'),
     path(r'<int:simulation_id>/run/<int:run_id>/link_output',
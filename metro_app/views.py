@@ -3,7 +3,6 @@
 Author: Lucas Javaudin
 E-mail: lucas.javaudin@ens-paris-saclay.fr
 """
-import time
 import os
 import shutil
 from io import BytesIO
@@ -13,7 +12,7 @@ import codecs
 from math import sqrt
 
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.http import Http404
 from django.urls import reverse, reverse_lazy
 from django.views.decorators.http import require_POST
@@ -22,10 +21,12 @@ from django.contrib.auth import authenticate, logout, login
 from django.contrib.auth import views as auth_views
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.core.exceptions import ValidationError
 from django.db.models import Sum
 from django.dispatch import receiver
 from django.db.models.signals import pre_delete
 from django.db import connection
+from django.utils import timezone
 
 from django_filters.views import FilterView
 from django_tables2.views import SingleTableMixin
@@ -40,8 +41,12 @@ import datetime
 logger = logging.getLogger(__name__)
 
 # Thresholds for the number of centroids required for a simulation to be
-# considered as having a large OD Matrix.
-MATRIX_THRESHOLD = 10
+# considered as having a large OD Matrix (which cannot be edited in the
+# website).
+MATRIX_THRESHOLD = 200
+# Thresholds for the number of centroids above which the OD Matrix is displayed
+# as a table of O-D pairs instead of a grid.
+MATRIX_VIEW_THRESHOLD = 300
 # Thresholds for the number of links required for a simulation to be
 # considered as having a large network (for network view).
 NETWORK_THRESHOLD = 1000
@@ -51,6 +56,9 @@ LINK_THRESHOLD = 50000
 # Maximum number of instances that can be edited at the same time in the
 # object_edit view.
 OBJECT_THRESHOLD = 80
+# Maximum number of periods of network results that can be requested at the
+# same time in the network_view_run_results view.
+RESULTS_WINDOW_MAX = 24
 
 
 # ====================
@@ -67,7 +75,10 @@ def public_required(view):
     def wrap(*args, **kwargs):
         user = args[0].user  # The first arg is the request object.
         simulation_id = kwargs.pop('simulation_id')
-        simulation = get_object_or_404(models.Simulation, pk=simulation_id)
+        simulation = get_object_or_404(
+            models.Simulation.objects.select_related('scenario__supply'),
+            pk=simulation_id,
+        )
         if functions.can_view(user, simulation):
             return view(*args, simulation=simulation, **kwargs)
         else:
@@ -86,7 +97,10 @@ def owner_required(view):
     def wrap(*args, **kwargs):
         user = args[0].user  # The first arg is the request object.
         simulation_id = kwargs.pop('simulation_id')
-        simulation = get_object_or_404(models.Simulation, pk=simulation_id)
+        simulation = get_object_or_404(
+            models.Simulation.objects.select_related('scenario__supply'),
+            pk=simulation_id,
+        )
         if functions.can_edit(user, simulation):
             return view(*args, simulation=simulation, **kwargs)
         else:
@@ -95,6 +109,37 @@ def owner_required(view):
     return wrap
 
 
+def copy_on_write(part):
+    """Decorator used in the views modifying the supply or the demand (part is
+    'supply' or 'demand') of a simulation, to ensure that the other
+    simulations sharing it are not modified (see functions.detach).
+    The decorator must be used after owner_required.
+    The view is not executed if the supply or the demand cannot be copied
+    because a simulation sharing it is running.
+    """
+
+    def decorator(view):
+
+        def wrap(*args, **kwargs):
+            simulation = kwargs['simulation']
+            try:
+                functions.detach(simulation, part)
+            except ValidationError as e:
+                context = {
+                    'simulation': simulation,
+                    'error': e.message,
+                }
+                return render(args[0], 'metro_app/errors.html', context)
+            response = view(*args, **kwargs)
+            # The counts of the simulation view must be computed again.
+            functions.invalidate_stats(simulation)
+            return response
+
+        return wrap
+
+    return decorator
+
+
 def check_demand_relation(view):
     """Decorator used in the demand views to ensure that the demand segment and
     the simulation are related.
@@ -184,6 +229,27 @@ def check_batch_relation(view):
     return wrap
 
 
+def check_import_relation(view):
+    """Decorator used in the import views to ensure that the import job and
+    the simulation are related.
+    The decorator also converts the job id to an ImportJob object.
+    """
+
+    def wrap(*args, **kwargs):
+        # The decorator is run after public_required or owner_required so
+        # simulation_id has already been converted to a Simulation object.
+        simulation = kwargs.pop('simulation')
+        job_id = kwargs.pop('job_id')
+        job = get_object_or_404(models.ImportJob, pk=job_id)
+        if job.simulation == simulation:
+            return view(*args, **kwargs, simulation=simulation, job=job)
+        else:
+            # The import job is not related to the simulation.
+            return HttpResponseRedirect(reverse('metro:simulation_manager'))
+
+    return wrap
+
+
 def environment_owner_required(view):
     """Decorator to execute a function only if the requesting user has edit
     access to the environment.
@@ -226,23 +292,25 @@ def simulation_manager(request):
     This view shows lists of simulations and proposes a form to create a new
     simulation.
     """
-    # Create lists of simulations.
-    sim_user_list = models.Simulation.objects.filter(user_id=request.user.id)
-    sim_public_list = models.Simulation.objects.filter(public=True)
+    # Create lists of simulations (the simulations created for the runs of a
+    # batch are only shown in the batch view).
+    simulations = models.Simulation.objects.filter(parent_batch__isnull=True)
+    sim_user_list = simulations.filter(user_id=request.user.id)
+    sim_public_list = simulations.filter(public=True)
     sim_public_list = sim_public_list.exclude(user_id=request.user.id)
-    sim_pinned_list = models.Simulation.objects.filter(public=True)
+    sim_pinned_list = simulations.filter(public=True)
     sim_pinned_list = sim_pinned_list.filter(pinned=True)
     env_list = models.Environment.objects.filter(users=request.user.id)
     simulation_env_list = []
 
     for env in env_list:
-        sim = models.Simulation.objects.filter(environment=env)
+        sim = simulations.filter(environment=env)
         simulation_env_list.append((env, sim))
 
     sim_private_list = None
     if request.user.is_superuser:
         # Superuser can see private simulations.
-        sim_private_list = models.Simulation.objects.filter(public=False)
+        sim_private_list = simulations.filter(public=False)
         sim_private_list = sim_private_list.exclude(user=request.user)
     # Create a form for new simulations.
     # Added one more form for the Import Simulation Button By Shubham
@@ -252,7 +320,7 @@ def simulation_manager(request):
     # Create a form for copied simulations (the form has the same fields as the
     # form for new simulations, we add the prefix copy to differentiate the
     # two).
-    copy_form = forms.BaseSimulationForm(request.user, prefix='copy')
+    copy_form = forms.CopySimulationForm(request.user, prefix='copy')
     context = {
         'simulation_user_list': sim_user_list,
         'simulation_env_list': simulation_env_list,
@@ -422,432 +490,33 @@ def simulation_add_action(request):
 @login_required
 def copy_simulation(request):
     """View used to create a copy of another simulation.
-    Django ORM is too slow for bulk operations on the database so we use mainly
-    raw SQL query.
-    To copy an object using Django, we set its primary key to None and we save
-    it again.  This will generate a new id for the object. We must ensure that
-    all relations between the objects remain consistent.
 
-    For now, Policy objects are not copied.
+    The view creates a new (empty) simulation and the copy of the supply, the
+    demand and the policies is done in the background (see
+    functions.copy_simulation).
+    With a shared copy, the new simulation uses the supply and the demand of
+    the copied simulation (see functions.share_simulation) so the copy is
+    done immediately.
     """
-    copy_form = forms.BaseSimulationForm(
+    copy_form = forms.CopySimulationForm(
         request.user, request.POST, prefix='copy')
     if copy_form.is_valid():
         # The simulation id is hidden in an input of the pop-up (the id is
         # changed by javascript.
         simulation_id = request.POST['copy_id']
         simulation = get_object_or_404(models.Simulation, pk=simulation_id)
-        # There are timeouts if the same simulation is copied twice
-        # simultaneously so we wait until the simulation is unlocked.
-        while simulation.locked:
-            # Wait 5 seconds.
-            time.sleep(5)
-            simulation = get_object_or_404(models.Simulation, pk=simulation_id)
-        # Lock the simulation.
-        simulation.locked = True
-        simulation.save()
-        # Use a direct access to the database.
-        with connection.cursor() as cursor:
-            # Copy all the models associated with the new simulation.
-            # (1) Supply.
-            functionset = models.FunctionSet.objects.get(
-                pk=simulation.scenario.supply.functionset.id)
-            functionset.pk = None
-            functionset.save()
-            network = models.Network.objects.get(
-                pk=simulation.scenario.supply.network.id)
-            network.pk = None
-            network.save()
-            # (1.1) Links.
-            # Find last link id right before executing the raw SQL query.
-            link_last_id = models.Link.objects.last().id
-            # Copy all links of the old network.
-            cursor.execute(
-                "INSERT INTO Link (name, destination, lanes, length, origin, "
-                "speed, ul1, ul2, ul3, capacity, dynVol, dynFlo, staVol, vdf, "
-                "user_id) "
-                "SELECT Link.name, Link.destination, Link.lanes, "
-                "Link.length, Link.origin, Link.speed, Link.ul1, Link.ul2, "
-                "Link.ul3, Link.capacity, Link.dynVol, Link.dynFlo, "
-                "Link.staVol, Link.vdf, Link.user_id "
-                "FROM Link "
-                "JOIN Network_Link "
-                "ON Link.id = Network_Link.link_id "
-                "WHERE Network_Link.network_id = %s;",
-                [simulation.scenario.supply.network.id]
-            )
-            # Find id of last inserted link. It might be better to find the
-            # copy of the last link of the old network in case other links
-            # where added at the same time.
-            new_link_last_id = models.Link.objects.last().id
-            # Add the many-to-many relations between links and network.
-            cursor.execute(
-                "INSERT INTO Network_Link (network_id, link_id) "
-                "SELECT '%s', id FROM Link WHERE id > %s and id <= %s;",
-                [network.id, link_last_id, new_link_last_id]
-            )
-            # (1.2) Functions.
-            # Find last function id.
-            last_id = models.Function.objects.last().id
-            # Copy all functions.
-            cursor.execute(
-                "INSERT INTO `Function` (name, expression, user_id, vdf_id) "
-                "SELECT `Function`.name, `Function`.expression, `Function`.user_id, "
-                " `Function`.vdf_id "
-                "FROM `Function` JOIN FunctionSet_Function "
-                "ON `Function`.id = FunctionSet_Function.function_id "
-                "WHERE FunctionSet_Function.functionset_id = %s;",
-                [simulation.scenario.supply.functionset.id]
-            )
-            # Find id of last inserted function.
-            new_last_id = models.Function.objects.last().id
-            # Add the many-to-many relations betweens functions and
-            # functionset.
-            cursor.execute(
-                "INSERT INTO FunctionSet_Function "
-                "(functionset_id, function_id) SELECT '%s', id FROM `Function` "
-                "WHERE id > %s and id <= %s;",
-                [functionset.id, last_id, new_last_id]
-            )
-            # Set vdf_id equal to the id of the functions.
-            cursor.execute(
-                "UPDATE `Function` "
-                "JOIN FunctionSet_Function "
-                "ON `Function`.id = FunctionSet_Function.function_id "
-                "SET `Function`.vdf_id = `Function`.id "
-                "WHERE FunctionSet_Function.functionset_id = %s;",
-                [functionset.id]
-            )
-            # Create a temporary table to map old function ids with new
-            # function ids.
-            cursor.execute(
-                "CREATE TEMPORARY TABLE function_ids "
-                "(id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, "
-                "old INT, new INT);"
-            )
-            # Add the id of the old functions.
-            cursor.execute(
-                "INSERT INTO function_ids (old) "
-                "SELECT `Function`.id "
-                "FROM `Function` "
-                "JOIN FunctionSet_Function "
-                "ON `Function`.id = FunctionSet_Function.function_id "
-                "WHERE FunctionSet_Function.functionset_id = %s;",
-                [simulation.scenario.supply.functionset.id]
-            )
-            # Add the ids of the new functions.
-            cursor.execute(
-                "UPDATE function_ids, "
-                "(SELECT @i:=@i+1 as r, `Function`.id "
-                "FROM (SELECT @i:=0) AS a, `Function` "
-                "JOIN FunctionSet_Function "
-                "ON `Function`.id = FunctionSet_Function.function_id "
-                "WHERE FunctionSet_Function.functionset_id = %s) AS src "
-                "SET function_ids.new = src.id "
-                "WHERE function_ids.id = src.r;",
-                [functionset.id]
-            )
-            # Update the function of the new links using the mapping table.
-            cursor.execute(
-                "UPDATE Link "
-                "JOIN function_ids "
-                "ON Link.vdf = function_ids.old "
-                "JOIN Network_Link "
-                "ON Link.id = Network_Link.link_id "
-                "SET Link.vdf = function_ids.new "
-                "WHERE Network_Link.network_id = %s;",
-                [network.id]
-            )
-            # (1.3) Centroids.
-            # Find last centroid id.
-            last_id = models.Centroid.objects.last().id
-            # Copy all centroids of the old network.
-            cursor.execute(
-                "INSERT INTO Centroid (name, x, y, uz1, uz2, uz3, user_id) "
-                "SELECT Centroid.name, Centroid.x, Centroid.y, Centroid.uz1, "
-                "Centroid.uz2, Centroid.uz3, Centroid.user_id "
-                "FROM Centroid "
-                "JOIN Network_Centroid "
-                "ON Centroid.id = Network_Centroid.centroid_id "
-                "WHERE Network_Centroid.network_id = %s;",
-                [simulation.scenario.supply.network.id]
-            )
-            # Find id of last inserted centroid.
-            new_last_id = models.Centroid.objects.last().id
-            # Add the many-to-many relations between centroids and network.
-            cursor.execute(
-                "INSERT INTO Network_Centroid (network_id, centroid_id) "
-                "SELECT '%s', id FROM Centroid WHERE id > %s and id <= %s;",
-                [network.id, last_id, new_last_id]
-            )
-            # Create a temporary table to map old centroid ids with new
-            # centroid ids.
-            cursor.execute(
-                "CREATE TEMPORARY TABLE centroid_ids "
-                "(id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, "
-                "old INT, new INT);"
-            )
-            # Add the id of the old centroids.
-            cursor.execute(
-                "INSERT INTO centroid_ids (old) "
-                "SELECT Centroid.id "
-                "FROM Centroid "
-                "JOIN Network_Centroid "
-                "ON Centroid.id = Network_Centroid.centroid_id "
-                "WHERE Network_Centroid.network_id = %s;",
-                [simulation.scenario.supply.network.id]
-            )
-            # Add the id of the old centroids.
-            cursor.execute(
-                "UPDATE centroid_ids, "
-                "(SELECT @i:=@i+1 as r, Centroid.id "
-                "FROM (SELECT @i:=0) AS a, Centroid "
-                "JOIN Network_Centroid "
-                "ON Centroid.id = Network_Centroid.centroid_id "
-                "WHERE Network_Centroid.network_id = %s) AS src "
-                "SET centroid_ids.new = src.id "
-                "WHERE centroid_ids.id = src.r;",
-                [network.id]
-            )
-            # Update the origin and destination of the new links using the
-            # mapping table.
-            cursor.execute(
-                "UPDATE Link "
-                "JOIN centroid_ids "
-                "ON Link.origin = centroid_ids.old "
-                "SET Link.origin = centroid_ids.new "
-                "WHERE Link.id > %s AND Link.id <= %s;",
-                [link_last_id, new_link_last_id]
-            )
-            cursor.execute(
-                "UPDATE Link "
-                "JOIN centroid_ids "
-                "ON Link.destination = centroid_ids.old "
-                "SET Link.destination = centroid_ids.new "
-                "WHERE Link.id > %s AND Link.id <= %s;",
-                [link_last_id, new_link_last_id]
-            )
-            # (1.4) Crossings.
-            # Find last crossing id.
-            last_id = models.Crossing.objects.last().id
-            # Copy all crossings of the old network.
-            cursor.execute(
-                "INSERT INTO Crossing (name, x, y, un1, un2, un3, user_id) "
-                "SELECT Crossing.name, Crossing.x, Crossing.y, Crossing.un1, "
-                "Crossing.un2, Crossing.un3, Crossing.user_id "
-                "FROM Crossing "
-                "JOIN Network_Crossing "
-                "ON Crossing.id = Network_Crossing.crossing_id "
-                "WHERE Network_Crossing.network_id = %s;",
-                [simulation.scenario.supply.network.id]
-            )
-            # Find id of last inserted crossing.
-            new_last_id = models.Crossing.objects.last().id
-            # Add the many-to-many relations between crossings and network.
-            cursor.execute(
-                "INSERT INTO Network_Crossing (network_id, crossing_id) "
-                "SELECT '%s', id FROM Crossing WHERE id > %s and id <= %s;",
-                [network.id, last_id, new_last_id]
-            )
-            # Create a temporary table to map old crossing ids with new
-            # crossing ids.
-            cursor.execute(
-                "CREATE TEMPORARY TABLE crossing_ids "
-                "(id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, "
-                "old INT, new INT);"
-            )
-            # Add the id of the old crossings.
-            cursor.execute(
-                "INSERT INTO crossing_ids (old) "
-                "SELECT Crossing.id "
-                "FROM Crossing "
-                "JOIN Network_Crossing "
-                "ON Crossing.id = Network_Crossing.crossing_id "
-                "WHERE Network_Crossing.network_id = %s;",
-                [simulation.scenario.supply.network.id]
-            )
-            # Add the id of the old crossings.
-            cursor.execute(
-                "UPDATE crossing_ids, "
-                "(SELECT @i:=@i+1 as r, Crossing.id "
-                "FROM (SELECT @i:=0) AS a, Crossing "
-                "JOIN Network_Crossing "
-                "ON Crossing.id = Network_Crossing.crossing_id "
-                "WHERE Network_Crossing.network_id = %s) AS src "
-                "SET crossing_ids.new = src.id "
-                "WHERE crossing_ids.id = src.r;",
-                [network.id]
-            )
-            # Update the origin and destination of the new links using the
-            # mapping table.
-            cursor.execute(
-                "UPDATE Link "
-                "JOIN crossing_ids "
-                "ON Link.origin = crossing_ids.old "
-                "SET Link.origin = crossing_ids.new "
-                "WHERE Link.id > %s AND Link.id <= %s;",
-                [link_last_id, new_link_last_id]
-            )
-            cursor.execute(
-                "UPDATE Link "
-                "JOIN crossing_ids "
-                "ON Link.destination = crossing_ids.old "
-                "SET Link.destination = crossing_ids.new "
-                "WHERE Link.id > %s AND Link.id <= %s;",
-                [link_last_id, new_link_last_id]
-            )
-            # (1.5) Public transit.
-            pttimes = models.Matrices.objects.get(
-                pk=simulation.scenario.supply.pttimes.id)
-            pttimes.pk = None
-            pttimes.save()
-            cursor.execute(
-                "INSERT INTO Matrix (r, p, q, matrices_id) "
-                "SELECT r, p, q, '%s' FROM Matrix "
-                "WHERE matrices_id = %s;",
-                [pttimes.id, simulation.scenario.supply.pttimes.id]
-            )
-            # Update origin and destination ids of the OD pairs.
-            cursor.execute(
-                "UPDATE Matrix "
-                "JOIN centroid_ids "
-                "ON Matrix.p = centroid_ids.old "
-                "SET Matrix.p = centroid_ids.new "
-                "WHERE Matrix.matrices_id = %s;",
-                [pttimes.id]
-            )
-            cursor.execute(
-                "UPDATE Matrix "
-                "JOIN centroid_ids "
-                "ON Matrix.q = centroid_ids.old "
-                "SET Matrix.q = centroid_ids.new "
-                "WHERE Matrix.matrices_id = %s;",
-                [pttimes.id]
+        copy = functions.create_simulation(request.user, copy_form)
+        if copy_form.cleaned_data['shared']:
+            functions.share_simulation(simulation, copy)
+            return HttpResponseRedirect(
+                reverse('metro:simulation_view', args=(copy.id,))
             )
-            supply = models.Supply.objects.get(
-                pk=simulation.scenario.supply.id)
-            supply.pk = None
-            supply.network = network
-            supply.functionset = functionset
-            supply.pttimes = pttimes
-            supply.save()
-            # (2) Demand.
-            demand = models.Demand.objects.get(
-                pk=simulation.scenario.demand.id)
-            demand_segments = demand.demandsegment_set.all()
-            demand.pk = None
-            demand.save()
-            for demand_segment in demand_segments:
-                # (2.1) UserType.
-                usertype = models.UserType.objects.get(
-                    pk=demand_segment.usertype.id)
-                usertype.pk = None
-                usertype.save()
-                # Copy all distributions.
-                alphaTI = usertype.alphaTI
-                alphaTI.pk = None
-                alphaTI.save()
-                usertype.alphaTI = alphaTI
-                alphaTP = usertype.alphaTP
-                alphaTP.pk = None
-                alphaTP.save()
-                usertype.alphaTP = alphaTP
-                beta = usertype.beta
-                beta.pk = None
-                beta.save()
-                usertype.beta = beta
-                delta = usertype.delta
-                delta.pk = None
-                delta.save()
-                usertype.delta = delta
-                departureMu = usertype.departureMu
-                departureMu.pk = None
-                departureMu.save()
-                usertype.departureMu = departureMu
-                gamma = usertype.gamma
-                gamma.pk = None
-                gamma.save()
-                usertype.gamma = gamma
-                modeMu = usertype.modeMu
-                modeMu.pk = None
-                modeMu.save()
-                usertype.modeMu = modeMu
-                penaltyTP = usertype.penaltyTP
-                penaltyTP.pk = None
-                penaltyTP.save()
-                usertype.penaltyTP = penaltyTP
-                routeMu = usertype.routeMu
-                routeMu.pk = None
-                routeMu.save()
-                usertype.routeMu = routeMu
-                tstar = usertype.tstar
-                tstar.pk = None
-                tstar.save()
-                usertype.tstar = tstar
-                usertype.save()
-                # (2.2) OD Matrix.
-                matrix = models.Matrices.objects.get(
-                    pk=demand_segment.matrix.id)
-                matrix.pk = None
-                matrix.save()
-                # (2.3) OD Matrix pairs.
-                # Copy all OD pairs and change the Matrix foreign key.
-                cursor.execute(
-                    "INSERT INTO Matrix (r, p, q, matrices_id) "
-                    "SELECT r, p, q, '%s' FROM Matrix "
-                    "WHERE matrices_id = %s;",
-                    [matrix.id, demand_segment.matrix.id]
-                )
-                # Update origin and destination ids of the OD pairs.
-                cursor.execute(
-                    "UPDATE Matrix "
-                    "JOIN centroid_ids "
-                    "ON Matrix.p = centroid_ids.old "
-                    "SET Matrix.p = centroid_ids.new "
-                    "WHERE Matrix.matrices_id = %s;",
-                    [matrix.id]
-                )
-                cursor.execute(
-                    "UPDATE Matrix "
-                    "JOIN centroid_ids "
-                    "ON Matrix.q = centroid_ids.old "
-                    "SET Matrix.q = centroid_ids.new "
-                    "WHERE Matrix.matrices_id = %s;",
-                    [matrix.id]
-                )
-                # (2.4) Demand Segment.
-                demand_segment.pk = None
-                demand_segment.usertype = usertype
-                demand_segment.matrix = matrix
-                demand_segment.save()
-                # (2.5) Add the relations.
-                demand_segment.demand.clear()
-                demand_segment.demand.add(demand)
-            # (3) Scenario.
-            scenario = models.Scenario.objects.get(pk=simulation.scenario.id)
-            scenario.pk = None
-            scenario.supply = supply
-            scenario.demand = demand
-            scenario.save()
-            # Unlock the simulation before copying it.
-            simulation.locked = False
-            simulation.save()
-            # (4) Simulation.
-            simulation.pk = None
-            simulation.scenario = scenario
-            simulation.user = request.user
-            simulation.name = copy_form.cleaned_data['name']
-            simulation.comment = copy_form.cleaned_data['comment']
-            simulation.public = copy_form.cleaned_data['public']
-            simulation.pinned = False
-            # Here, we could copy the json file of the copied simulation if the
-            # copied simulation has not changed. For now, I only put
-            # has_changed to True for the new simulation so that a new json
-            # file will be generated.
-            simulation.has_changed = True
-            simulation.save()
+        job = models.ImportJob(simulation=copy, kind='copy',
+                               source=simulation)
+        job.save()
+        functions.run_import(job)
         return HttpResponseRedirect(
-            reverse('metro:simulation_view', args=(simulation.id,))
+            reverse('metro:import_job_view', args=(copy.id, job.id,))
         )
     return HttpResponseRedirect(reverse('metro:simulation_manager'))
 
@@ -856,15 +525,10 @@ def copy_simulation(request):
 def simulation_delete(request, simulation):
     """View used to delete a simulation.
 
-    The view deletes the Simulation object and all objects associated with it.
+    The view deletes the Simulation object and all objects associated with it
+    (see functions.delete_simulation).
     """
-    models.SimulationMOEs.objects.filter(simulation=simulation.id).delete()
-    network = simulation.scenario.supply.network
-    functionset = simulation.scenario.supply.functionset
-    demand = simulation.scenario.demand
-    network.delete()
-    functionset.delete()
-    demand.delete()
+    functions.delete_simulation(simulation)
     return HttpResponseRedirect(reverse('metro:simulation_manager'))
 
 
@@ -874,35 +538,28 @@ def simulation_view(request, simulation):
     # Some elements are only displayed if the user owns the simulation.
     owner = functions.can_edit(request.user, simulation)
     # Create the form to copy the simulation.
-    copy_form = forms.BaseSimulationForm(request.user, prefix='copy')
+    copy_form = forms.CopySimulationForm(request.user, prefix='copy')
     # Create the form to edit name, comment and public.
     edit_form = forms.BaseSimulationForm(request.user, instance=simulation)
     # Create the form to edit the parameters.
     simulation_form = forms.ParametersSimulationForm(
         owner=owner, instance=simulation)
-    # Count the number of each elements in the network.
+    # Get the number of each elements in the network and of travelers.
+    stats = functions.get_simulation_stats(simulation)
     network = dict()
-    network['centroids'] = functions.get_query('centroid', simulation).count()
-    network['crossings'] = functions.get_query('crossing', simulation).count()
-    network['links'] = functions.get_query('link', simulation).count()
-    network['functions'] = functions.get_query('function', simulation).count()
+    network['centroids'] = stats.centroids
+    network['crossings'] = stats.crossings
+    network['links'] = stats.links
+    network['functions'] = stats.functions
     # File where the data for the network are stored.
     output_file = (
         '{0}/website_files/network_output/network_{1!s}.json'
     ).format(settings.BASE_DIR, simulation.id)
     network['generated'] = (os.path.isfile(output_file)
-                            and not simulation.has_changed)
-    # Count the number of user types.
+                            and not functions.network_has_changed(simulation))
     travelers = dict()
-    travelers['type'] = functions.get_query('usertype', simulation).count()
-    # Count the number of travelers
-    matrices = functions.get_query('matrices', simulation)
-    nb_travelers = matrices.aggregate(Sum('total'))['total__sum']
-    if nb_travelers is None:
-        nb_travelers = 0
-    else:
-        nb_travelers = int(nb_travelers)
-    travelers['nb_travelers'] = nb_travelers
+    travelers['type'] = stats.usertypes
+    travelers['nb_travelers'] = stats.travelers
     # Count the number of policies.
     policy = dict()
     policy['count'] = functions.get_query('policy', simulation).count()
@@ -911,7 +568,8 @@ def simulation_view(request, simulation):
     runs = dict()
     runs['nb_run'] = simulation_runs.count()
     # Check if a run is in progress.
-    run_in_progress = simulation_runs.filter(status__in=('Preparing',
+    run_in_progress = simulation_runs.filter(status__in=('Queued',
+                                                         'Preparing',
                                                          'Running',
                                                          'Ending'))
     runs['in_progress'] = run_in_progress.exists()
@@ -925,15 +583,7 @@ def simulation_view(request, simulation):
     complete_simulation = complete_network and travelers['nb_travelers'] > 0
     # Check if there is a public transit network (in case modal choice is
     # enabled).
-    good_pt = True
-    if not functions.get_query('public_transit', simulation).exists():
-        usertypes = functions.get_query('usertype', simulation)
-        modal_choice = False
-        for usertype in usertypes:
-            if usertype.modeChoice == 'true':
-                modal_choice = True
-        if modal_choice:
-            good_pt = False
+    good_pt = stats.public_transit or not stats.mode_choice
     # Count the number of batches.
     batches = functions.get_query('batch', simulation)
     batch_dict = dict()
@@ -1050,6 +700,7 @@ def demand_view(request, simulation):
 
 
 @owner_required
+@copy_on_write('demand')
 def usertype_add(request, simulation):
     """Add a new user type and initiate its distributions with default values.
     """
@@ -1105,6 +756,7 @@ def usertype_add(request, simulation):
     demandsegment = models.DemandSegment()
     demandsegment.usertype = usertype
     demandsegment.matrix = matrix
+    demandsegment.owner_demand = simulation.scenario.demand
     demandsegment.save()
     demandsegment.demand.add(simulation.scenario.demand)
     # Return the view to edit the new user type.
@@ -1128,6 +780,7 @@ def usertype_edit(request, simulation, demandsegment):
 
 @require_POST
 @owner_required
+@copy_on_write('demand')
 @check_demand_relation
 def usertype_edit_save(request, simulation, demandsegment):
     """Save the parameters of an user type."""
@@ -1148,8 +801,7 @@ def usertype_edit_save(request, simulation, demandsegment):
                 matrix.total = (demandsegment.scale
                                 * matrix_points.aggregate(Sum('r'))['r__sum'])
                 matrix.save()
-                simulation.has_changed = True
-                simulation.save()
+                functions.simulation_changed(simulation, 'demand')
         return HttpResponseRedirect(
             reverse('metro:demand_view',
                     args=(simulation.id,))
@@ -1164,14 +816,14 @@ def usertype_edit_save(request, simulation, demandsegment):
 
 
 @owner_required
+@copy_on_write('demand')
 @check_demand_relation
 def usertype_delete(request, simulation, demandsegment):
     """Delete an user type and all related objects."""
     # With CASCADE attribute, everything should be delete (demand segment, user
     # type, distributions, matrix and matrix points).
     demandsegment.delete()
-    simulation.has_changed = True
-    simulation.save()
+    functions.simulation_changed(simulation, 'demand')
     return HttpResponseRedirect(
         reverse('metro:demand_view', args=(simulation.id,))
     )
@@ -1222,7 +874,7 @@ def matrix_main(request, simulation, demandsegment):
 def matrix_view(request, simulation, demandsegment):
     """View to display the OD Matrix of an user type."""
     centroids = functions.get_query('centroid', simulation)
-    if centroids.count() > MATRIX_THRESHOLD:
+    if centroids.count() > MATRIX_VIEW_THRESHOLD:
         # Large matrix, return a table instead.
         return MatrixListView.as_view()(request, simulation=simulation,
                                         demandsegment=demandsegment)
@@ -1230,29 +882,7 @@ def matrix_view(request, simulation, demandsegment):
         # Small matrix, return it.
         matrix = demandsegment.matrix
         matrix_points = models.Matrix.objects.filter(matrices=matrix)
-        od_matrix = []
-        # For each row, we build an array which will be appended to the
-        # od_matrix array.
-        # The row array has the origin centroid as first value.
-        # The subsequent values are the population value of the od pairs.
-        # For od pair with identical origin and destination, we append -1 to
-        # the row array.
-        for row_centroid in centroids:
-            row = [row_centroid]
-            for column_centroid in centroids:
-                if row_centroid == column_centroid:
-                    row.append(-1)
-                else:
-                    try:
-                        couple_object = matrix_points.get(
-                            p=row_centroid,
-                            q=column_centroid,
-                            matrices=matrix
-                        )
-                        row.append(couple_object.r)
-                    except models.Matrix.DoesNotExist:
-                        row.append(0)
-            od_matrix.append(row)
+        od_matrix = functions.get_dense_matrix(matrix_points, centroids)
         # Get total population.
         total = matrix.total
         context = {
@@ -1268,39 +898,18 @@ def matrix_view(request, simulation, demandsegment):
 @owner_required
 @check_demand_relation
 def matrix_edit(request, simulation, demandsegment):
-    """View to edit the OD Matrix of an user type."""
+    """View to edit the OD Matrix of an user type.
+
+    The grid is built from the existing OD pairs (see
+    functions.get_dense_matrix) and only the cells modified by the user are
+    sent to matrix_save.
+    """
     # Get some objects.
     matrix = demandsegment.matrix
     matrix_points = models.Matrix.objects.filter(matrices=matrix)
     centroids = functions.get_query('centroid', simulation)
-    od_matrix = []
-    # For each row, we build an array which will be appended to the od_matrix
-    # array.
-    # The row array has the origin centroid as first value.
-    # The subsequent values are tuples with the id of the od pair, the
-    # population value of the od pair and the index of the form (used by django
-    # to save the formset).
-    # For od pair with identical origin and destination, we append 0 to the row
-    # array.
-    i = 0
-    for row_centroid in centroids:
-        row = [row_centroid]
-        for column_centroid in centroids:
-            if row_centroid == column_centroid:
-                row.append(0)
-            else:
-                couple_object, created = matrix_points.get_or_create(
-                    p=row_centroid,
-                    q=column_centroid,
-                    matrices=matrix
-                )
-                row.append((couple_object.id, couple_object.r, i))
-                i += 1
-        od_matrix.append(row)
-    # Create a formset to obtain the management form.
-    formset = forms.MatrixFormSet(
-        queryset=models.Matrix.objects.filter(matrices=matrix),
-    )
+    od_matrix = functions.get_dense_matrix(matrix_points, centroids)
+    form = forms.MatrixChangesForm()
     # Get total population.
     total = int(matrix.total)
     context = {
@@ -1308,7 +917,7 @@ def matrix_edit(request, simulation, demandsegment):
         'centroids': centroids,
         'demandsegment': demandsegment,
         'od_matrix': od_matrix,
-        'formset': formset,
+        'form': form,
         'total': total
     }
     return render(request, 'metro_app/matrix_edit.html', context)
@@ -1316,26 +925,27 @@ def matrix_edit(request, simulation, demandsegment):
 
 @require_POST
 @owner_required
+@copy_on_write('demand')
 @check_demand_relation
 def matrix_save(request, simulation, demandsegment):
-    """View to save the OD Matrix of an user type."""
+    """View to save the OD pairs modified in the edit page of the OD Matrix
+    of an user type."""
     matrix = demandsegment.matrix
-    # Get the formset from the POST data and save it.
-    formset = forms.MatrixFormSet(request.POST)
-    if formset.is_valid():
-        formset.save()
+    form = forms.MatrixChangesForm(request.POST)
+    if form.is_valid():
+        functions.save_matrix_changes(
+            simulation, matrix, form.cleaned_data['changes'])
         # Update total.
         matrix_points = models.Matrix.objects.filter(matrices=matrix)
-        matrix.total = \
-            demandsegment.scale * matrix_points.aggregate(Sum('r'))['r__sum']
+        matrix.total = demandsegment.scale * (
+            matrix_points.aggregate(Sum('r'))['r__sum'] or 0)
         matrix.save()
-        simulation.has_changed = True
-        simulation.save()
+        functions.simulation_changed(simulation, 'demand')
     else:
         # Redirect to a page with the errors.
         context = {
             'simulation': simulation,
-            'form': formset,
+            'form': form,
         }
         return render(request, 'metro_app/errors.html', context)
     return HttpResponseRedirect(reverse(
@@ -1371,8 +981,8 @@ def matrix_import(request, simulation, demandsegment):
     """View to convert the imported file to an O-D matrix in the database."""
     try:
         encoded_file = request.FILES['import_file']
-        functions.matrix_import_function(
-            encoded_file, simulation, demandsegment)
+        job = functions.queue_import(simulation, 'matrix', encoded_file,
+                                     demandsegment=demandsegment)
     except Exception as e:
         print(e)
         context = {
@@ -1382,11 +992,12 @@ def matrix_import(request, simulation, demandsegment):
         return render(request, 'metro_app/import_error.html', context)
     else:
         return HttpResponseRedirect(reverse(
-            'metro:matrix_view', args=(simulation.id, demandsegment.id,)
+            'metro:import_job_view', args=(simulation.id, job.id,)
         ))
 
 
 @owner_required
+@copy_on_write('demand')
 @check_demand_relation
 def matrix_reset(request, simulation, demandsegment):
     """View to reset all OD pairs of an O-D matrix."""
@@ -1465,8 +1076,7 @@ def pricing_save(request, simulation):
     if formset.is_valid():
         # Save the formset (updated values and newly created objects).
         formset.save()
-        simulation.has_changed = True
-        simulation.save()
+        functions.simulation_changed(simulation, 'policy')
     else:
         # Redirect to a page with the errors.
         context = {
@@ -1503,7 +1113,7 @@ def pricing_import(request, simulation):
     """View to convert the imported file to tolls in the database."""
     try:
         encoded_file = request.FILES['import_file']
-        functions.pricing_import_function(encoded_file, simulation)
+        job = functions.queue_import(simulation, 'pricing', encoded_file)
     except Exception as e:
         # Catch any exception while importing the file and return an error page
         # if there is any.
@@ -1515,7 +1125,7 @@ def pricing_import(request, simulation):
         return render(request, 'metro_app/import_error.html', context)
     else:
         return HttpResponseRedirect(reverse(
-            'metro:pricing_main', args=(simulation.id,)
+            'metro:import_job_view', args=(simulation.id, job.id,)
         ))
 
 
@@ -1567,34 +1177,13 @@ def public_transit_view(request, simulation):
 def public_transit_list(request, simulation):
     """View to display the public-transit travel times."""
     centroids = functions.get_query('centroid', simulation)
-    if centroids.count() > MATRIX_THRESHOLD:
+    if centroids.count() > MATRIX_VIEW_THRESHOLD:
         # Large matrix, return a table instead.
         return PTMatrixListView.as_view()(request, simulation=simulation)
     else:
         # Small matrix, return it.
         matrix_points = functions.get_query('public_transit', simulation)
-        od_matrix = []
-        # For each row, we build an array which will be appended to the
-        # od_matrix array.
-        # The row array has the origin centroid as first value.
-        # The subsequent values are the population value of the od pairs.
-        # For od pair with identical origin and destination, we append -1 to
-        # the row array.
-        for row_centroid in centroids:
-            row = [row_centroid]
-            for column_centroid in centroids:
-                if row_centroid == column_centroid:
-                    row.append(-1)
-                else:
-                    try:
-                        couple_object = matrix_points.get(
-                            p=row_centroid,
-                            q=column_centroid,
-                        )
-                        row.append(couple_object.r)
-                    except models.Matrix.DoesNotExist:
-                        row.append(0)
-            od_matrix.append(row)
+        od_matrix = functions.get_dense_matrix(matrix_points, centroids)
         demandsegment = functions.get_query('demandsegment', simulation)
         context = {
             'simulation': simulation,
@@ -1608,47 +1197,16 @@ def public_transit_list(request, simulation):
 
 @owner_required
 def public_transit_edit(request, simulation):
-    """View to edit the public transit OD Matrix."""
-    matrix = simulation.scenario.supply.pttimes
+    """View to edit the public transit OD Matrix (see matrix_edit)."""
     matrix_points = functions.get_query('public_transit', simulation)
     centroids = functions.get_query('centroid', simulation)
-    od_matrix = []
-    # For each row, we build an array which will be appended to the od_matrix
-    # array.
-    # The row array has the origin centroid as first value.
-    # The subsequent values are tuples with the id of the od pair, the
-    # population value of the od pair and the index of the form (used by django
-    # to save the formset).
-    # For od pair with identical origin and destination, we append 0 to the row
-    # array.
-    i = 0
-    for row_centroid in centroids:
-        row = [row_centroid]
-        for column_centroid in centroids:
-            if row_centroid == column_centroid:
-                row.append(0)
-            else:
-                # There is a problem here. I create empty OD pairs with value 0
-                # so that it is possible to edit all cells of the matrix.
-                # However, the pairs stay in the database when the formset is
-                # set. Therefore, the website with think that the public
-                # transit system is complete even if all values are 0 (see
-                # public_transit_view).
-                couple_object, created = matrix_points.get_or_create(
-                    p=row_centroid,
-                    q=column_centroid,
-                    matrices=matrix
-                )
-                row.append((couple_object.id, couple_object.r, i))
-                i += 1
-        od_matrix.append(row)
-    # Create a formset to obtain the management form.
-    formset = forms.MatrixFormSet(queryset=matrix_points.all())
+    od_matrix = functions.get_dense_matrix(matrix_points, centroids)
+    form = forms.MatrixChangesForm()
     context = {
         'simulation': simulation,
         'centroids': centroids,
         'od_matrix': od_matrix,
-        'formset': formset,
+        'form': form,
         'public_transit': True,
     }
     return render(request, 'metro_app/matrix_edit.html', context)
@@ -1656,17 +1214,21 @@ def public_transit_edit(request, simulation):
 
 @require_POST
 @owner_required
+@copy_on_write('supply')
 def public_transit_edit_save(request, simulation):
-    """View to save the public transit OD Matrix."""
-    # Get the formset from the POST data and save it.
-    formset = forms.MatrixFormSet(request.POST)
-    if formset.is_valid():
-        formset.save()
+    """View to save the OD pairs modified in the edit page of the public
+    transit OD Matrix."""
+    matrix = simulation.scenario.supply.pttimes
+    form = forms.MatrixChangesForm(request.POST)
+    if form.is_valid():
+        functions.save_matrix_changes(
+            simulation, matrix, form.cleaned_data['changes'],
+            keep_zeros=True)
     else:
         # Redirect to a page with the errors.
         context = {
             'simulation': simulation,
-            'form': formset,
+            'form': form,
         }
         return render(request, 'metro_app/errors.html', context)
     return HttpResponseRedirect(reverse(
@@ -1675,6 +1237,7 @@ def public_transit_edit_save(request, simulation):
 
 
 @owner_required
+@copy_on_write('supply')
 def public_transit_delete(request, simulation):
     """Delete all OD pairs of the public transit OD matrix.
     The Matrices object is not deleted so that the user can add OD pairs again.
@@ -1693,7 +1256,8 @@ def public_transit_import(request, simulation):
     database."""
     try:
         encoded_file = request.FILES['import_file']
-        functions.public_transit_import_function(encoded_file, simulation)
+        job = functions.queue_import(simulation, 'public_transit',
+                                     encoded_file)
     except Exception as e:
         print(e)
         context = {
@@ -1703,7 +1267,7 @@ def public_transit_import(request, simulation):
         return render(request, 'metro_app/import_error.html', context)
     else:
         return HttpResponseRedirect(reverse(
-            'metro:public_transit_view', args=(simulation.id,)
+            'metro:import_job_view', args=(simulation.id, job.id,)
         ))
 
 
@@ -1785,12 +1349,17 @@ def object_edit(request, simulation, object_name):
 
 @require_POST
 @owner_required
+@copy_on_write('supply')
 @check_object_name
 def object_edit_save(request, simulation, object_name):
     """View to save the edited network objects."""
     # Retrieve the formset from the POST data.
     formset = gen_formset(object_name, simulation, request=request)
     if formset.is_valid():
+        # Store the ids of the deleted objects (the ids are lost once the
+        # objects are deleted).
+        deleted_ids = [form.instance.id for form in formset.deleted_forms
+                       if form.instance.id is not None]
         # Save the formset (updated values and newly created objects).
         formset.save()
         # Update the foreign keys (we cannot select the newly added forms so we
@@ -1798,12 +1367,15 @@ def object_edit_save(request, simulation, object_name):
         changed_forms = list(
             set(formset.forms) - set(formset.deleted_forms)
         )
+        changed_ids = [form.instance.id for form in changed_forms]
+        query = formset.model.objects.filter(pk__in=changed_ids)
         if object_name in ['centroid', 'crossing', 'link']:
             for form in changed_forms:
                 # Link the object to the correct network.
                 form.instance.network.add(
                     simulation.scenario.supply.network
                 )
+            query.update(owner_network=simulation.scenario.supply.network)
         elif object_name == 'function':
             for form in changed_forms:
                 # Link the function to the correct functionset.
@@ -1812,8 +1384,18 @@ def object_edit_save(request, simulation, object_name):
                 form.instance.functionset.add(
                     simulation.scenario.supply.functionset
                 )
-        simulation.has_changed = True
-        simulation.save()
+            query.update(
+                owner_functionset=simulation.scenario.supply.functionset)
+        # Record the changed objects so that the network output can be
+        # patched.
+        if object_name == 'function' and deleted_ids:
+            # The links using the deleted functions are deleted too.
+            functions.simulation_changed(simulation)
+        else:
+            ids = [form.instance.id for form in changed_forms
+                   if form.has_changed()]
+            functions.simulation_changed(simulation, object_name,
+                                         ids + deleted_ids)
         return HttpResponseRedirect(reverse(
             'metro:object_edit', args=(simulation.id, object_name,)
         ))
@@ -1833,7 +1415,7 @@ def object_import(request, simulation, object_name):
     """View to import instances of a network object."""
     encoded_file = request.FILES['import_file']
     try:
-        functions.object_import_function(encoded_file, simulation, object_name)
+        job = functions.queue_import(simulation, object_name, encoded_file)
     except Exception as e:
         print(e)
         context = {
@@ -1843,7 +1425,7 @@ def object_import(request, simulation, object_name):
         return render(request, 'metro_app/import_error.html', context)
     else:
         return HttpResponseRedirect(
-            reverse('metro:object_list', args=(simulation.id, object_name,))
+            reverse('metro:import_job_view', args=(simulation.id, job.id,))
         )
 
 
@@ -1869,6 +1451,7 @@ def object_export(request, simulation, object_name):
 
 
 @owner_required
+@copy_on_write('supply')
 @check_object_name
 def object_delete(request, simulation, object_name):
     """View to delete all instances of a network objects."""
@@ -1920,8 +1503,7 @@ def object_delete(request, simulation, object_name):
     else:
         # Let Django do the job.
         query.delete()
-    simulation.has_changed = True
-    simulation.save()
+    functions.simulation_changed(simulation)
     return HttpResponseRedirect(reverse(
         'metro:object_view', args=(simulation.id, object_name,)
     ))
@@ -1934,7 +1516,7 @@ def simulation_run_action(request, simulation):
     # Check that there is no run in progress for this simulation.
     running_simulations = models.SimulationRun.objects.filter(
         simulation=simulation
-    ).filter(status__in=('Preparing', 'Running', 'Ending'))
+    ).filter(status__in=('Queued', 'Preparing', 'Running', 'Ending'))
     if not running_simulations.exists():
         # Create a SimulationRun object to keep track of the run.
         run_form = forms.RunForm(request.POST)
@@ -1974,9 +1556,18 @@ def simulation_run_view(request, simulation, run):
     results = models.SimulationMOEs.objects.filter(runid=run.id)
     results = results.order_by('-day')
     result_table = tables.SimulationMOEsTable(results)
+    # Position of the run in the run queue (if it has not started yet).
+    position = None
+    if run.status == 'Queued':
+        position = functions.queue_position(run)
+        if position is None:
+            # The run has just been started by the run dispatcher.
+            run.refresh_from_db()
     context = {
         'simulation': simulation,
         'run': run,
+        'position': position,
+        'phases': run.runphase_set.order_by('id'),
         'log': log,
         'results': results,
         'result_table': result_table,
@@ -2060,23 +1651,9 @@ def network_view(request, simulation):
     links = functions.get_query('link', simulation)
     if links:
         large_network = links.count() > NETWORK_THRESHOLD
-        # File where the data for the network are stored.
-        output_file = (
-            '{0}/website_files/network_output/network_{1!s}.json'
-        ).format(settings.BASE_DIR, simulation.id)
-        if simulation.has_changed or not os.path.isfile(output_file):
-            # Generate a new output file.
-            output = plots.network_output(simulation, large_network)
-            with open(output_file, 'w') as f:
-                json.dump(output, f)
-            # Do not generate a new output file the next time (unless the
-            # simulation changes).
-            simulation.has_changed = False
-            simulation.save()
-        else:
-            # Use data from the existing output file.
-            with open(output_file, 'r') as f:
-                output = json.load(f)
+        # The network output is generated or patched if the simulation has
+        # changed.
+        output = plots.get_network_output(simulation, large_network)
         context = {
             'simulation': simulation,
             'output': output,
@@ -2103,25 +1680,34 @@ def network_view_run(request, simulation, run):
     parameters_file = (
         '{0}/website_files/network_output/parameters_{1}_{2}.json'
     ).format(settings.BASE_DIR, simulation.id, run.id)
-    results_file = (
-        '{0}/website_files/network_output/results_{1}_{2}.json'
-    ).format(settings.BASE_DIR, simulation.id, run.id)
+    # The results of the old runs are converted at the start of the website
+    # (see the convert_run_results command).
     if (os.path.isfile(network_file)
             and os.path.isfile(parameters_file)
-            and os.path.isfile(results_file)):
+            and functions.has_run_results(run)):
         # Load the data for the network.
         with open(network_file, 'r') as f:
             output = json.load(f)
         with open(parameters_file, 'r') as f:
             parameters = json.load(f)
-        with open(results_file, 'r') as f:
-            results = json.load(f)
+        # Only the meta data of the results are sent with the page, the
+        # results of each period are fetched by the page when needed (see
+        # network_view_run_results).
+        stored_results = functions.read_run_results(run)
+        results = {
+            'link_ids': stored_results['link_ids'].tolist(),
+            'colorscale': plots.get_palette(stored_results['palette'],
+                                            stored_results['palette_size']),
+            'stats': stored_results['stats'],
+            'output_types': stored_results['output_types'],
+        }
         context = {
             'simulation': simulation,
             'output': output,
             'large_network': large_network,
             'parameters': parameters,
             'results': results,
+            'run': run,
         }
         return render(request, 'metro_app/network.html', context)
     else:
@@ -2129,6 +1715,44 @@ def network_view_run(request, simulation, run):
         return HttpResponseRedirect(reverse('metro:simulation_manager'))
 
 
+@public_required
+@check_run_relation
+def network_view_run_results(request, simulation, run):
+    """Return in json the results of a run for one output type and a window
+    of periods.
+
+    The GET parameters are the output type (type), the first period of the
+    window (period, starting at 0) and the number of periods (window,
+    default to 1).
+    """
+    if not functions.has_run_results(run):
+        raise Http404()
+    results = functions.read_run_results(run)
+    output_type = request.GET.get('type')
+    if output_type not in results['output_types']:
+        raise Http404()
+    try:
+        period = int(request.GET.get('period', 0))
+        window = int(request.GET.get('window', 1))
+    except ValueError:
+        raise Http404()
+    nb_periods = results['arrays'][output_type].shape[1]
+    if period < 0 or period >= nb_periods or window < 1:
+        raise Http404()
+    window = min(window, RESULTS_WINDOW_MAX, nb_periods - period)
+    values, colors = functions.slice_run_results(
+        results, output_type, periods=slice(period, period + window))
+    # The arrays are transposed so that there is one list of link values for
+    # each period.
+    data = {
+        'type': output_type,
+        'start': period,
+        'values': values.T.tolist(),
+        'colors': colors.T.tolist(),
+    }
+    return JsonResponse(data)
+
+
 # ====================
 # Class-Based Views
 # ====================
@@ -2585,12 +2209,11 @@ def simulation_import_action(request):
     if form.is_valid():
         # Create a new simulation with the attributes sent.
         simulation = functions.create_simulation(request.user, form)
-        # Import the zipfile data in the simulation.
+        # Import the zipfile data in the simulation (in the background).
         encoded_file = form.cleaned_data['zipfile']
-        # function to import the simulation from a zip_file
-        functions.simulation_import(simulation, encoded_file)
+        job = functions.queue_import(simulation, 'simulation', encoded_file)
         return HttpResponseRedirect(
-            reverse('metro:simulation_view', args=(simulation.id,))
+            reverse('metro:import_job_view', args=(simulation.id, job.id,))
         )
     else:
         return HttpResponseRedirect(
@@ -2607,7 +2230,12 @@ def traveler_import_action(request, simulation):
         form = forms.ImportForm(request.POST, request.FILES)
         if form.is_valid():
             encoded_file = form.cleaned_data['import_file']
-            functions.traveler_zip_file(simulation, encoded_file)
+            job = functions.queue_import(simulation, 'traveler',
+                                         encoded_file)
+        else:
+            return HttpResponseRedirect(reverse(
+                'metro:demand_view', args=(simulation.id,)
+            ))
 
     except Exception as e:
         # Catch any exception while importing the file and return an error page
@@ -2622,7 +2250,7 @@ def traveler_import_action(request, simulation):
     else:
 
         return HttpResponseRedirect(reverse(
-            'metro:demand_view', args=(simulation.id,)
+            'metro:import_job_view', args=(simulation.id, job.id,)
         ))
 
 
@@ -2632,7 +2260,7 @@ def usertype_import(request, simulation):
     """View to convert the imported file to usertype in the database."""
     try:
         encoded_file = request.FILES['import_file']
-        functions.usertype_import_function(encoded_file, simulation)
+        job = functions.queue_import(simulation, 'usertype', encoded_file)
     except Exception as e:
         # Catch any exception while importing the file and return an error page
         # if there is any.
@@ -2644,10 +2272,77 @@ def usertype_import(request, simulation):
         return render(request, 'metro_app/import_error.html', context)
     else:
         return HttpResponseRedirect(reverse(
-            'metro:demand_view', args=(simulation.id,)
+            'metro:import_job_view', args=(simulation.id, job.id,)
         ))
 
 
+def import_job_redirect(job):
+    """Return the url of the page to display once an import job is over."""
+    simulation = job.simulation
+    if job.kind in ('centroid', 'crossing', 'link', 'function'):
+        return reverse('metro:object_list', args=(simulation.id, job.kind,))
+    elif job.kind == 'matrix':
+        return reverse('metro:matrix_view',
+                       args=(simulation.id, job.demandsegment.id,))
+    elif job.kind == 'pricing':
+        return reverse('metro:pricing_main', args=(simulation.id,))
+    elif job.kind == 'public_transit':
+        return reverse('metro:public_transit_view', args=(simulation.id,))
+    elif job.kind in ('usertype', 'traveler'):
+        return reverse('metro:demand_view', args=(simulation.id,))
+    else:
+        return reverse('metro:simulation_view', args=(simulation.id,))
+
+
+@owner_required
+@check_import_relation
+def import_job_view(request, simulation, job):
+    """View with the progress of an import job.
+
+    The user is redirected to the page of the imported objects once the import
+    is over.
+    """
+    if job.status == 'Over':
+        return HttpResponseRedirect(import_job_redirect(job))
+    elif job.status == 'Failed':
+        if job.kind in ('traveler', 'simulation'):
+            object_name = 'zipfile'
+        else:
+            object_name = job.kind
+        context = {
+            'simulation': simulation,
+            'object': object_name,
+        }
+        return render(request, 'metro_app/import_error.html', context)
+    context = {
+        'simulation': simulation,
+        'job': job,
+    }
+    return render(request, 'metro_app/import_job.html', context)
+
+
+@owner_required
+@check_import_relation
+def import_job_status(request, simulation, job):
+    """View returning the status and the progress of an import job as JSON."""
+    elapsed = 0
+    if job.start_time:
+        end_time = job.end_time or timezone.now()
+        elapsed = (end_time - job.start_time).total_seconds()
+    if elapsed > 0:
+        rows_per_second = job.rows_processed / elapsed
+    else:
+        rows_per_second = 0
+    data = {
+        'status': job.status,
+        'rows_total': job.rows_total,
+        'rows_processed': job.rows_processed,
+        'rows_per_second': round(rows_per_second, 1),
+        'elapsed': round(elapsed, 1),
+    }
+    return JsonResponse(data)
+
+
 @public_required
 @check_demand_relation
 def usertype_export(request, simulation, demandsegment):
@@ -2800,7 +2495,10 @@ def batch_edit(request, simulation, batch):
 @owner_required
 @check_batch_relation
 def batch_delete(request, simulation, batch):
-    """View to delete a batch instance."""
+    """View to delete a batch instance (and the simulations created for its
+    runs)."""
+    for copy in batch.copies.all():
+        functions.delete_simulation(copy)
     batch.delete()
     return HttpResponseRedirect(
         reverse('metro:simulation_view', args=(simulation.id,))
@@ -2819,7 +2517,8 @@ def batch_run_cancel(request, simulation, batch, run_id):
         if batch_run.run:
             functions.stop_run(batch_run.run)
         batch_run.canceled = True
-        batch_run.save()
+        # The other fields are updated by the script running the batch.
+        batch_run.save(update_fields=['canceled'])
     return HttpResponseRedirect(reverse(
         'metro:batch_view', args=(simulation.id, batch.id,)
     ))
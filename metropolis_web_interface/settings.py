@@ -165,6 +165,36 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 DEFAULT_FROM_EMAIL = 'metropolis@localhost'
 
+# Number of processes used to build the results of a run once Metrosim is
+# over.
+
+RESULTS_WORKERS = 4
+
+# Number of runs of a batch executed at the same time.
+
+BATCH_WORKERS = 4
+
+# The runs are started by the run dispatcher (metro_app/run_dispatcher.py).
+# At most MAX_RUNS runs are in progress at the same time and a run is started
+# only if the estimated memory of the runs in progress stays below
+# RUN_MEMORY_LIMIT (in MB). The dispatcher checks the queue every
+# DISPATCHER_INTERVAL seconds.
+
+MAX_RUNS = 8
+
+RUN_MEMORY_LIMIT = 32000
+
+DISPATCHER_INTERVAL = 5
+
+# Maximum duration (in seconds) of each phase of a run. The phase is killed
+# after this duration.
+
+RUN_PHASE_TIMEOUTS = {
+    'prepare': 3600,
+    'metrosim': 7 * 24 * 3600,
+    'build': 6 * 3600,
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20
@@ -1,6 +1,10 @@
 #!/bin/bash
 
 python3 manage.py collectstatic --noinput &&
+python3 manage.py remove_duplicate_pairs &&
 python3 manage.py makemigrations metro_app &&
 python3 manage.py migrate &&
+python3 manage.py backfill_owner_keys &&
+python3 manage.py convert_run_results &&
+(python3 metro_app/run_dispatcher.py > website_files/script_logs/run_dispatcher.txt 2>&1 &) &&
 python3 manage.py runserver 0.0.0.0:8000